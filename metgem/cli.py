@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import json
+import os
 import sys
 import warnings
 
@@ -9,10 +11,15 @@ import numpy as np
 import pandas as pd
 
 from metgem.config import RADIUS
+from metgem.utils.candidates import CANDIDATES_METHODS
+from metgem.utils.matrix import SCORE_DTYPES
+from metgem.utils.scoring import ENGINES, SCORINGS, get_scorings
 from metgem.utils.network import Network, generate_id
+from metgem.utils.spectra import PackedSpectra
 from metgem.workers.core import (ReadDataWorker, ComputeScoresWorker,
                                  ForceDirectedGraphWorker, ForceDirectedWorker, MaxConnectedComponentsWorker,
                                  TSNEWorker, SaveProjectWorker)
+from metgem.workers.core.score import build_matrix, build_matrices, get_tile_size, get_tiles, split_tiles
 from metgem.workers.options import (ScoreComputationOptions, ForceDirectedVisualizationOptions,
                                     TSNEVisualizationOptions)
 
@@ -25,40 +32,46 @@ class Project(object):
         self.graphs = {}
 
 
-@click.group(chain=True, invoke_without_command=True)
-@click.option('-i', '--input', required=True, help='Input file to process')
-@click.option('-o', '--output', default='output.npz', help='Output filename')
-@click.option('--ms1-data/--ms2-data', default=False, is_flag=True,
-              help="Use this option if the precursor ion's mass is unknown. Only fragments will be compared.")
-@click.option('--min-intensity', type=int, default=0,
-              help="Filter out peaks with relative intensity below this percentage of highest intense peak")
-@click.option('--parent-filter-tolerance', type=int, default=17, help='in Da')
-@click.option('--min-matched-peaks-search', type=int, default=6,
-              help="Window rank filter's parameters: for each peak in the spectrum, "
-                   "it is kept only if it is in top `min_matched_peaks_search` in the +/- `matched_peaks_window` window")
-@click.option('--matched-peaks-window', type=int, default=50, help='in Da')
-@click.option('--min-matched-peaks', type=int, default=4,
-              help='Minimum number of common peaks between two spectra')
-@click.option('-t', '--mz-tolerance', type=float, default=0.02,
-              help='Maximum difference (in Da) between two ions masses to consider they correspond to the same ion.')
-@click.pass_context
-def cli(ctx, input, output, ms1_data, min_intensity, parent_filter_tolerance,
-        min_matched_peaks_search, matched_peaks_window,
-        min_matched_peaks, mz_tolerance):
-
-    options = {}
-    interactions = pd.DataFrame()
-
-    # +-----------+
-    # | Read Data |
-    # +-----------+
+def score_options(func):
+    """Add options used to read spectra and compute scores to a command."""
+
+    options = [
+        click.option('--ms1-data/--ms2-data', default=False, is_flag=True,
+                     help="Use this option if the precursor ion's mass is unknown. Only fragments will be compared."),
+        click.option('--min-intensity', type=int, default=0,
+                     help="Filter out peaks with relative intensity below this percentage of highest intense peak"),
+        click.option('--parent-filter-tolerance', type=int, default=17, help='in Da'),
+        click.option('--min-matched-peaks-search', type=int, default=6,
+                     help="Window rank filter's parameters: for each peak in the spectrum, it is kept only if it is "
+                          "in top `min_matched_peaks_search` in the +/- `matched_peaks_window` window"),
+        click.option('--matched-peaks-window', type=int, default=50, help='in Da'),
+        click.option('--min-matched-peaks', type=int, default=4,
+                     help='Minimum number of common peaks between two spectra'),
+        click.option('--scoring', type=click.Choice(SCORINGS), default=('cosine',), multiple=True,
+                     help='Scoring algorithm, can be given several times to compute several scores in one pass.'),
+        click.option('--engine', type=click.Choice(ENGINES), default='libmetgem',
+                     help='Implementation used to compute scores.'),
+        click.option('--score-dtype', type=click.Choice(SCORE_DTYPES), default='float32',
+                     help="Type used to store scores, 'uint8' storing scores in steps of 1/255."),
+        click.option('-t', '--mz-tolerance', type=float, default=0.02,
+                     help='Maximum difference (in Da) between two ions masses to consider they correspond to the '
+                          'same ion.'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def get_score_options(ms1_data, min_intensity, parent_filter_tolerance, min_matched_peaks_search,
+                      matched_peaks_window, min_matched_peaks, mz_tolerance, scoring=('cosine',), **kwargs):
     use_min_intensity_filter = min_intensity != 0
     use_parent_filter = parent_filter_tolerance != 0
     use_window_rank_filter = min_matched_peaks_search != 0 and min_matched_peaks_search != 0
     use_filtering = use_min_intensity_filter or use_parent_filter or use_window_rank_filter
 
-    options['score'] = ScoreComputationOptions()
-    options['score'].update({
+    options = ScoreComputationOptions()
+    options.update({
+        'scoring': scoring[0] if len(scoring) == 1 else list(dict.fromkeys(scoring)),
         'mz_tolerance': mz_tolerance,
         'min_intensity': min_intensity,
         'parent_filter_tolerance': parent_filter_tolerance,
@@ -69,26 +82,85 @@ def cli(ctx, input, output, ms1_data, min_intensity, parent_filter_tolerance,
         'use_filtering': use_filtering,
         'use_min_intensity_filter': use_min_intensity_filter,
         'use_parent_filter': use_parent_filter,
-        'use_window_rank_filter': use_window_rank_filter})
+        'use_window_rank_filter': use_window_rank_filter,
+        **kwargs})
+    return options
+
+
+@click.group(chain=True, invoke_without_command=True)
+@click.option('-i', '--input', required=True, help='Input file to process')
+@click.option('-o', '--output', default='output.npz', help='Output filename')
+@score_options
+@click.option('--max-mz-delta', type=float, default=None,
+              help='Only compute scores between spectra whose parent masses differ by at most this value (in Da).')
+@click.option('--max-rt-delta', type=float, default=None,
+              help='Only compute scores between spectra whose retention times differ by at most this value '
+                   '(in seconds).')
+@click.option('--out-of-core', default=False, is_flag=True,
+              help='Compute similarity matrix by tiles and store it in a temporary file instead of memory.')
+@click.option('--condensed', default=False, is_flag=True,
+              help='Only store upper half of dense similarity matrix.')
+@click.option('-j', '--jobs', type=int, default=1,
+              help='Number of processes used to compute scores, 0 to use all available CPUs.')
+@click.option('--top-k-scores', type=int, default=0,
+              help='Only store this number of best scores of each spectrum in a sparse similarity matrix, 0 to '
+                   'store all scores in a dense matrix.')
+@click.option('--candidates', type=int, default=0,
+              help='Only compute scores of each spectrum with this number of approximate nearest neighbours, 0 to '
+                   'score all pairs of spectra.')
+@click.option('--candidates-method', type=click.Choice(CANDIDATES_METHODS), default='lsh',
+              help='Method used to search nearest neighbours if `--candidates` is set.')
+@click.option('--lsh-tables', type=int, default=16,
+              help='Number of hash tables used to search nearest neighbours, more tables give a better recall.')
+@click.pass_context
+def cli(ctx, input, output, max_mz_delta, max_rt_delta, out_of_core, condensed, jobs, top_k_scores, candidates,
+        **kwargs):
+
+    options = {}
+    interactions = pd.DataFrame()
+
+    # +-----------+
+    # | Read Data |
+    # +-----------+
+    options['score'] = get_score_options(
+        use_mz_blocking=max_mz_delta is not None,
+        max_mz_delta=max_mz_delta if max_mz_delta is not None else 0,
+        use_rt_blocking=max_rt_delta is not None,
+        max_rt_delta=max_rt_delta if max_rt_delta is not None else 0,
+        out_of_core=out_of_core,
+        condensed=condensed,
+        use_multiprocessing=jobs != 1,
+        n_jobs=jobs,
+        dense_output=top_k_scores <= 0,
+        use_top_k=top_k_scores > 0,
+        top_k=max(top_k_scores, 0),
+        use_candidates=candidates > 0,
+        n_candidates=max(candidates, 0),
+        **kwargs)
     worker = ReadDataWorker(input, options['score'])
     try:
         mzs, spectra = worker.run()
     except NotImplementedError:
         print('Unknown file format.')
         sys.exit(1)
+    rts = worker.rts
 
     # +---------------------------+
     # | Compute Similarity Matrix |
     # +---------------------------+
-    worker = ComputeScoresWorker(mzs, spectra, options['score'])
+    worker = ComputeScoresWorker(mzs, spectra, options['score'], rts=rts)
+    worker.error.connect(lambda e: print(e))
     with click.progressbar(length=worker.max, label='Computing scores') as pbar:
         worker.updated.connect(lambda v: pbar.update(pbar.pos + v))
         scores = worker.run()
+    if scores is None:
+        sys.exit(1)
 
     network = Network()
     network.mzs = mzs
     network.spectra = spectra
-    network.scores = scores
+    network.rts = rts
+    network.set_scores(scores, options['score'].scoring)
     network.options = options
     network.interactions = interactions
 
@@ -125,20 +197,19 @@ def add_network(project, **opts):
     project.network.options[id_].update(opts)
 
     graph_worker = ForceDirectedGraphWorker(project.network.scores, project.network.mzs, graph,
-                                            project.network.options[id_])
-    max_cc_worker = MaxConnectedComponentsWorker(graph, project.network.options[id_])\
-        if opts['max_connected_nodes'] > 0 else None
-
-    fd_worker = ForceDirectedWorker(graph, radii)
+                                            project.network.options[id_], neighbors=project.network.neighbors)
 
-    with click.progressbar(length=graph_worker.max + fd_worker.max,
+    # Graph is created again by `graph_worker`, next workers are created once it is available
+    with click.progressbar(length=graph_worker.max + graph.vcount(),
                            label=f'Generating Network {add_network.counter}') as pbar:
         graph_worker.updated.connect(pbar.update)
         interactions, graph = graph_worker.run()
+        project.network.neighbors = graph_worker.neighbors
 
-        if max_cc_worker is not None:
-            graph = max_cc_worker.run()
+        if opts['max_connected_nodes'] > 0:
+            graph = MaxConnectedComponentsWorker(graph, project.network.options[id_]).run()
 
+        fd_worker = ForceDirectedWorker(graph, radii, project.network.options[id_])
         fd_worker.updated.connect(lambda v: pbar.update(graph_worker.max + v - pbar.pos))
         layout, isolated_nodes = fd_worker.run()
 
@@ -192,5 +263,176 @@ def add_tsne(project, **opts):
 add_tsne.counter = 0
 
 
+# +------------+
+# | Block jobs |
+# +------------+
+JOBS_VERSION = 1
+JOBS_MANIFEST = 'jobs.json'
+JOBS_SPECTRA = 'spectra.npz'
+
+
+def load_job_file(filename):
+    with open(filename, 'r', encoding='UTF-8') as f:
+        data = json.load(f)
+    if data.get('version') != JOBS_VERSION:
+        raise click.ClickException(f"{filename} was written by an incompatible version.")
+    return data
+
+
+def load_job_spectra(filename):
+    with np.load(filename, allow_pickle=False) as data:
+        mzs = pd.Series(data['mzs'], index=data['ids'])
+        spectra = PackedSpectra(data['peaks'], data['offsets'])
+        rts = data['rts'] if 'rts' in data.files else None
+    return mzs, spectra, rts
+
+
+@click.group('jobs')
+def block_jobs():
+    """Compute scores of a large dataset as independent block jobs, e.g. on several nodes of a cluster.
+
+    Jobs are written by `prepare`, each job file is then processed by `run` on any machine that can access the
+    jobs directory and results are assembled into a project by `merge`.
+    """
+
+
+@block_jobs.command('prepare')
+@click.option('-i', '--input', required=True, help='Input file to process')
+@click.option('-d', '--directory', required=True, type=click.Path(file_okay=False),
+              help='Directory where spectra and job files are written')
+@click.option('-n', '--num-jobs', type=click.IntRange(min=1), default=1, help='Number of jobs')
+@score_options
+def prepare_jobs(input, directory, num_jobs, **kwargs):
+    options = get_score_options(**kwargs)
+    worker = ReadDataWorker(input, options)
+    try:
+        mzs, spectra = worker.run()
+    except NotImplementedError:
+        print('Unknown file format.')
+        sys.exit(1)
+
+    os.makedirs(directory, exist_ok=True)
+    spectra = PackedSpectra.from_list(spectra)
+    ids = np.asarray(mzs.index)
+    arrays = dict(mzs=np.asarray(mzs, dtype=np.float64), ids=ids.astype(str) if ids.dtype == object else ids,
+                  peaks=spectra.peaks, offsets=spectra.offsets)
+    if worker.rts is not None:
+        arrays['rts'] = worker.rts
+    np.savez(os.path.join(directory, JOBS_SPECTRA), **arrays)
+
+    # Distribute tiles of similarity matrix between jobs
+    n = len(spectra)
+    parts = split_tiles(get_tiles(n, get_tile_size(n, num_jobs)), num_jobs)
+    job_files = []
+    for i, tiles in enumerate(parts):
+        name = f'job-{i:04d}'
+        job = {'version': JOBS_VERSION,
+               'index': i,
+               'spectra': JOBS_SPECTRA,
+               'options': dict(options),
+               'tiles': [[rows.start, rows.stop, cols.start, cols.stop] for rows, cols in tiles],
+               'output': f'{name}.npz'}
+        with open(os.path.join(directory, f'{name}.json'), 'w', encoding='UTF-8') as f:
+            json.dump(job, f)
+        job_files.append(f'{name}.json')
+
+    manifest = {'version': JOBS_VERSION,
+                'input': os.path.abspath(input),
+                'num_spectra': n,
+                'spectra': JOBS_SPECTRA,
+                'options': dict(options),
+                'jobs': job_files}
+    with open(os.path.join(directory, JOBS_MANIFEST), 'w', encoding='UTF-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f'{n} spectra and {len(job_files)} jobs written to {directory}.')
+
+
+@block_jobs.command('run')
+@click.argument('job_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('-j', '--jobs', type=int, default=1,
+              help='Number of processes used to compute scores, 0 to use all available CPUs.')
+def run_job(job_file, jobs):
+    job = load_job_file(job_file)
+    directory = os.path.dirname(os.path.abspath(job_file))
+    mzs, spectra, rts = load_job_spectra(os.path.join(directory, job['spectra']))
+
+    options = ScoreComputationOptions()
+    options.update(job['options'])
+    options.use_multiprocessing = jobs != 1
+    options.n_jobs = jobs
+
+    tiles = [(slice(r0, r1), slice(c0, c1)) for r0, r1, c0, c1 in job['tiles']]
+    worker = ComputeScoresWorker(mzs, spectra, options, rts=rts)
+    worker.error.connect(lambda e: print(e))
+    with click.progressbar(length=1, label=f"Computing scores of job {job['index']}") as pbar:
+        worker.maximumChanged.connect(lambda v: setattr(pbar, 'length', v))
+        worker.updated.connect(pbar.update)
+        result = worker.compute_tiles(tiles)
+    if result is None:
+        sys.exit(1)
+
+    # Write to a temporary file first so that partial results are never mistaken for a completed job
+    output = os.path.join(directory, job['output'])
+    rows, cols, data = result
+    with open(output + '.tmp', 'wb') as f:
+        np.savez(f, rows=rows, cols=cols, data=data)
+    os.replace(output + '.tmp', output)
+
+
+@block_jobs.command('merge')
+@click.option('-d', '--directory', required=True, type=click.Path(exists=True, file_okay=False),
+              help='Directory where jobs were prepared')
+@click.option('-o', '--output', default='output.mnz', help='Output filename')
+@click.option('--dense/--sparse', default=True, help='Store scores in a dense or a sparse matrix')
+@click.option('--out-of-core', default=False, is_flag=True,
+              help='Build dense similarity matrix in a temporary file instead of memory.')
+@click.option('--condensed', default=False, is_flag=True,
+              help='Only store upper half of dense similarity matrix.')
+@click.option('--top-k-scores', type=int, default=0,
+              help='Only store this number of best scores of each spectrum in a sparse similarity matrix, 0 to '
+                   'store all scores.')
+def merge_jobs(directory, output, dense, out_of_core, condensed, top_k_scores):
+    manifest = load_job_file(os.path.join(directory, JOBS_MANIFEST))
+    job_list = [load_job_file(os.path.join(directory, job_file)) for job_file in manifest['jobs']]
+    missing = [str(job['index']) for job in job_list if not os.path.exists(os.path.join(directory, job['output']))]
+    if missing:
+        raise click.ClickException(f"Some jobs are not completed: {', '.join(missing)}.")
+
+    mzs, spectra, rts = load_job_spectra(os.path.join(directory, manifest['spectra']))
+
+    def iter_results():
+        for job in job_list:
+            with np.load(os.path.join(directory, job['output']), allow_pickle=False) as data:
+                yield data['rows'], data['cols'], data['data']
+
+    options = {'score': ScoreComputationOptions()}
+    options['score'].update(manifest['options'])
+    options['score'].dense_output = dense and top_k_scores <= 0
+    options['score'].out_of_core = out_of_core
+    options['score'].condensed = condensed
+    options['score'].use_top_k = top_k_scores > 0
+    options['score'].top_k = max(top_k_scores, 0)
+
+    network = Network()
+    network.mzs = mzs
+    network.spectra = spectra
+    network.rts = rts
+    kwargs = dict(dense_output=options['score'].dense_output, out_of_core=out_of_core, top_k=options['score'].top_k,
+                  condensed=condensed, dtype=options['score'].score_dtype)
+    scoring = options['score'].scoring
+    if isinstance(scoring, str):
+        scores = build_matrix(manifest['num_spectra'], iter_results(), **kwargs)
+    else:
+        scorings = get_scorings(scoring)
+        scores = dict(zip(scorings, build_matrices(manifest['num_spectra'], iter_results(), len(scorings), **kwargs)))
+    network.set_scores(scores, scoring)
+    network.options = options
+    network.interactions = pd.DataFrame()
+
+    worker = SaveProjectWorker(output, network, None, network.options, {}, {})
+    worker.run()
+
+
 if __name__ == '__main__':
     cli()
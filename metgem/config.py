@@ -60,6 +60,11 @@ else:
     LOG_PATH = os.path.join(USER_PATH, 'log')
 STYLES_PATH = os.path.join(USER_PATH, 'styles')
 PLUGINS_PATH = os.path.join(USER_PATH, 'plugins')
+CACHE_PATH = os.path.join(USER_PATH, 'cache')
+SCRATCH_PATH = os.path.join(USER_PATH, 'scratch')
+
+# Default maximum size of spectra cache, in bytes
+CACHE_MAX_SIZE = 2 * 1024 ** 3
 
 
 def makedirs(path):
@@ -73,6 +78,8 @@ makedirs(DATABASES_PATH)
 makedirs(LOG_PATH)
 makedirs(STYLES_PATH)
 makedirs(PLUGINS_PATH)
+makedirs(CACHE_PATH)
+makedirs(SCRATCH_PATH)
 
 
 def get_debug_flag() -> bool:
@@ -10,7 +10,7 @@ from sqlalchemy.sql import text
 from metgem.database.models import Spectrum, Organism, Submitter, DataCollector, Instrument, Bank, Investigator
 from metgem.database.session import create_session
 from metgem.utils import grouper
-from metgem.utils.read_data import guess_file_format
+from metgem.utils.read_data import guess_file_format, get_compression, read_decompressed
 
 
 def clean_string(string):
@@ -148,6 +148,11 @@ class DataBaseBuilder:
             else:
                 raise NotImplementedError
 
+            if get_compression(path) is not None:
+                # Decompress file so that it is parsed by the same reader as uncompressed files
+                def read(filename, ignore_unknown=False, read_func=read):
+                    return read_decompressed(filename, read_func, ignore_unknown=ignore_unknown)
+
             # Read mgf file by batch of 1000 spectra
             # noinspection PyPep8,PyPep8
             for batch in chunk_read_data(path, read_func=read, chunk_size=1000):
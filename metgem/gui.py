@@ -32,6 +32,10 @@ def run():
 
     import argparse
     import importlib
+    import multiprocessing
+
+    # Processes spawned from a frozen executable should not start the application again
+    multiprocessing.freeze_support()
 
     # Make sure decimal separator is dot
     os.environ['LC_NUMERIC'] = 'C'
@@ -122,6 +126,8 @@ def run():
 
     splash.showMessage("Loading Configuration module...")
     importlib.import_module('.config', 'metgem')
+    # Remove temporary files left by previous sessions
+    importlib.import_module('.utils.matrix', 'metgem').clean_scratch()
     splash.setValue(91)
 
     splash.showMessage("Loading Errors modules...")
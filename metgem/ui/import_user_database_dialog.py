@@ -5,6 +5,7 @@ from PySide6.QtGui import QPalette, QColor, QIcon
 from PySide6.QtWidgets import QCompleter, QFileSystemModel, QDialog, QFileDialog, QDialogButtonBox, QMessageBox
 
 from metgem.ui.progress_dialog import ProgressDialog
+from metgem.utils.read_data import strip_compression_extension
 from metgem.workers.databases import ConvertDatabasesWorker
 from metgem.workers.core import WorkerQueue
 from metgem.ui.import_user_database_dialog_ui import Ui_ImportUserDatabaseDialog
@@ -64,7 +65,9 @@ class ImportUserDatabaseDialog(QDialog, Ui_ImportUserDatabaseDialog):
 
         self._dialog = QFileDialog(self)
         self._dialog.setFileMode(QFileDialog.ExistingFile)
-        self._dialog.setNameFilters(["All supported formats (*.mgf *.msp)",
+        self._dialog.setNameFilters(["All supported formats (*.mgf *.msp *.mgf.gz *.msp.gz "
+                                    "*.mgf.bz2 *.msp.bz2 *.mgf.zst *.msp.zst)",
+                               "Compressed files (*.gz *.bz2 *.zst)",
                                "Mascot Generic Format (*.mgf)",
                                "NIST Text Format of Individual Spectra (*.msp)",
                                "All files (*)"])
@@ -73,7 +76,8 @@ class ImportUserDatabaseDialog(QDialog, Ui_ImportUserDatabaseDialog):
             if result == QDialog.Accepted:
                 filename = self._dialog.selectedFiles()[0]
                 self.editInputFile.setText(filename)
-                self.editDatabaseName.setText(os.path.splitext(os.path.basename(filename))[0])
+                self.editDatabaseName.setText(
+                    os.path.splitext(os.path.basename(strip_compression_extension(filename)))[0])
                 self.editInputFile.setPalette(self.style().standardPalette())
 
         self._dialog.finished.connect(set_filename)
@@ -88,7 +92,7 @@ class ImportUserDatabaseDialog(QDialog, Ui_ImportUserDatabaseDialog):
 
         input_file = self.editInputFile.text()
         if len(input_file) == 0 or not os.path.exists(input_file) \
-                or os.path.splitext(input_file)[1].lower() not in ('.mgf', '.msp'):
+                or os.path.splitext(strip_compression_extension(input_file))[1].lower() not in ('.mgf', '.msp'):
             self.editInputFile.setPalette(self._error_palette)
 
         name = self.editDatabaseName.text()
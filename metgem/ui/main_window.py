@@ -45,6 +45,11 @@ from metgem.workers import options as workers_opts
 from metgem.ui import widgets
 from metgem.logger import logger, debug
 from metgem.utils.network import Network, generate_id
+from metgem.workers.core.read_data import get_file_label, make_unique, match_metadata
+from metgem.utils.cache import SpectraCache
+from metgem.utils.matrix import CondensedMatrix, dequantize
+from metgem.utils.scoring import use_square_root
+from metgem.utils.spectra import PackedSpectra
 from metgem.utils.emf_export import HAS_EMF_EXPORT
 
 if HAS_EMF_EXPORT:
@@ -53,6 +58,7 @@ from metgem.utils.gui import enumerateMenu, SignalGrouper, SignalBlocker
 from metgem.config import get_python_rendering_flag
 from metgem.utils import hasinstance
 from metgem.ui.main_window_ui import Ui_MainWindow
+from metgem.ui.process_data_dialog import SPECTRA_FILES_FILTERS
 from metgem.ui.widgets.search_ui import Ui_Form as Ui_SearchWidget
 
 from PySide6MolecularNetwork.node import NodePolygon
@@ -256,6 +262,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.actionAbout.triggered.connect(lambda: ui.AboutDialog().exec_())
         self.actionAboutQt.triggered.connect(lambda: QMessageBox.aboutQt(self))
         self.actionProcessFile.triggered.connect(self.on_process_file_triggered)
+        self.actionAppendSpectra.triggered.connect(self.on_append_spectra_triggered)
         self.actionImportMetadata.triggered.connect(self.on_import_metadata_triggered)
         self.actionImportGroupMapping.triggered.connect(self.on_import_group_mapping_triggered)
         self.actionCurrentParameters.triggered.connect(self.on_current_parameters_triggered)
@@ -362,6 +369,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         popup_menu.setTitle("Toolbars")
         self.menuView.addMenu(popup_menu)
 
+        # Add a menu to switch between scores computed with several algorithms
+        self.menuScoring = QMenu("Scoring", self)
+        self.menu_Network.addSeparator()
+        self.menu_Network.addMenu(self.menuScoring)
+
         # Populate list of recently opened projects
         menu = QMenu()
         self.recent_projects = []
@@ -538,6 +550,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self._network = network
 
+        self.update_scoring_menu()
         self.update_status_widgets()
 
     @property
@@ -698,6 +711,20 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self._last_table = table
 
+    @debug
+    def update_scoring_menu(self):
+        menu = self.menuScoring
+        menu.clear()
+        all_scores = getattr(self._network, 'all_scores', {})
+        group = QActionGroup(menu, exclusive=True)
+        for name in all_scores:
+            action = group.addAction(QAction(name.replace('_', ' ').capitalize(), checkable=True))
+            action.setData(name)
+            action.setChecked(name == self._network.scoring)
+            menu.addAction(action)
+        group.triggered.connect(lambda act: self.on_scoring_triggered(act.data()))
+        menu.setEnabled(len(all_scores) > 1)
+
     def update_recent_projects(self, add_fname=None, remove_fname=None, clear=False):
         if clear:
             self.recent_projects = []
@@ -1244,7 +1271,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                     QMessageBox.warning(self, None, 'Selected spectrum is empty.')
                     return
 
-                data = human_readable_data(data, square_intensities=self.network.options.score.scoring == 'cosine')
+                data = human_readable_data(data,
+                                           square_intensities=use_square_root(self.network.options.score.scoring))
 
                 if self.network.mzs is not None:
                     mz_parent = self.network.mzs.iloc[node_idx]
@@ -1259,11 +1287,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             else:
                 # Set data as first or second spectrum
                 if type_ == 'compare':
-                    score = self.network.scores[self.spectra_widget.spectrum1_index, node_idx] \
+                    score = float(dequantize(self.network.scores[self.spectra_widget.spectrum1_index, node_idx])) \
                         if self.spectra_widget.spectrum1_index is not None else None
                     set_spectrum = self.spectra_widget.set_spectrum2
                 else:
-                    score = self.network.scores[node_idx, self.spectra_widget.spectrum2_index] \
+                    score = float(dequantize(self.network.scores[node_idx, self.spectra_widget.spectrum2_index])) \
                         if self.spectra_widget.spectrum2_index is not None else None
                     set_spectrum = self.spectra_widget.set_spectrum1
                 if score is not None:
@@ -1701,8 +1729,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             QMessageBox.warning(self, None,
                                 "Insilico Databases are only available for MS/MS spectra.")
             return
-        spectrum = human_readable_data(self.network.spectra[self.network.mzs.index[list(selected_idx)[0]]],
-                                       square_intensities=self.network.options.score.scoring == 'cosine')
+        spectrum = human_readable_data(self.network.spectra[list(selected_idx)[0]],
+                                       square_intensities=use_square_root(self.network.options.score.scoring))
 
         self._dialog = dialog_class(self, mz, spectrum)
 
@@ -1759,35 +1787,60 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         def do_process(result):
             if result == QDialog.Accepted:
-                def create_compute_scores_worker(worker: workers_core.ReadDataWorker):
+                def create_compute_scores_worker(worker: Union[workers_core.ReadDataWorker,
+                                                               workers_core.FilterSpectraWorker]):
                     self.tvNodes.model().setSelection([])
                     self.tvNodes.sourceModel().beginResetModel()
                     self._network.mzs, self._network.spectra = worker.result()
+                    if isinstance(worker, workers_core.ReadDataWorker):
+                        self._network.raw_spectra = worker.raw_spectra
+                        self._network.raw_spectra_source = source if worker.raw_spectra is not None else None
+                        self._network.raw_spectra_infos = worker.infos
+                        self._network.rts = worker.rts
+                    if self._network.raw_spectra_infos is not None:
+                        self._network.infos = self._network.raw_spectra_infos.copy()
                     self.tvNodes.sourceModel().endResetModel()
                     mzs = self.network.mzs
                     if mzs is None:
                         mzs = np.zeros((len(self.network.spectra),), dtype=int)
-                    return self.prepare_compute_scores_worker(mzs, self.network.spectra)
+                    return self.prepare_compute_scores_worker(mzs, self.network.spectra, rts=self.network.rts)
 
                 def store_scores(worker: workers_core.ComputeScoresWorker):
                     self.tvEdges.model().setSelection([])
                     scores = worker.result()
-                    if not isinstance(scores, (np.ndarray, csr_matrix)):
+                    if not isinstance(scores, (np.ndarray, csr_matrix, CondensedMatrix, dict)):
                         return
 
-                    self._network.scores = scores
+                    self._network.set_scores(scores, self._network.options.score.scoring)
+                    self.update_scoring_menu()
 
                     self.tvNodes.setColumnHidden(1, self.network.db_results is None
                                                  or len(self.network.db_results) == 0)
                     self.dock_edges.toggleView(True)
                     self.dock_nodes.toggleView(True)
 
+                # Keep unfiltered spectra from previous processing, if they have been read from the same file
+                raw_spectra = self._network.raw_spectra
+                raw_spectra_source = self._network.raw_spectra_source
+                raw_spectra_infos = self._network.raw_spectra_infos
+                raw_mzs = self._network.mzs
+                raw_rts = self._network.rts
+
                 self.reset_project()
 
-                process_file, use_metadata, metadata_file, metadata_options, options, views = self._dialog.getValues()
+                process_files, use_metadata, metadata_file, metadata_options, options, views = self._dialog.getValues()
 
                 self._network.options = options
-                self._workers.append(self.prepare_read_data_worker(process_file))
+                source = self.get_data_source_key(process_files, options.score)
+                if source is not None and source == raw_spectra_source:
+                    # Only filtering options may have changed, no need to read data file again
+                    self._network.raw_spectra = raw_spectra
+                    self._network.raw_spectra_source = raw_spectra_source
+                    self._network.raw_spectra_infos = raw_spectra_infos
+                    self._network.rts = raw_rts
+                    self._workers.append(self.prepare_filter_spectra_worker(raw_mzs, raw_spectra))
+                else:
+                    self._workers.append(self.prepare_read_data_worker(process_files, keep_raw=source is not None))
                 self._workers.append(create_compute_scores_worker)
                 self._workers.append(store_scores)
                 if use_metadata:
@@ -1815,6 +1868,118 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self._dialog.finished.connect(do_process)
         self._dialog.open()
 
+    # noinspection PyUnusedLocal
+    @debug
+    def on_append_spectra_triggered(self, *args):
+        if getattr(self._network, 'scores', None) is None or getattr(self._network, 'mzs', None) is None:
+            QMessageBox.information(self, None, "No network found, please open a file first.")
+            return
+
+        self._dialog = QFileDialog(self)
+        self._dialog.setFileMode(QFileDialog.ExistingFiles)
+        self._dialog.setNameFilters(SPECTRA_FILES_FILTERS)
+
+        def do_append(result):
+            if result != QDialog.Accepted:
+                return
+
+            filenames = self._dialog.selectedFiles()
+            num_scored = self._network.scores.shape[0]
+            appended = {}
+
+            # Edges of networks before appending spectra, to find out which connected components changed
+            old_edges = {dock.widget().id: {tuple(sorted(e)) for e in dock.widget().graph.get_edgelist()}
+                         for dock in self.network_docks.values()
+                         if dock.widget().name == widgets.ForceDirectedFrame.name}
+
+            def create_append_scores_worker(worker: workers_core.ReadDataWorker):
+                mzs, spectra = worker.result()
+                network = self._network
+
+                # Make sure that ids of new spectra are not already used
+                old_ids = network.mzs.index.tolist()
+                ids = mzs.index.tolist()
+                if not set(map(str, ids)).isdisjoint(map(str, old_ids)):
+                    if len(filenames) == 1:
+                        label = get_file_label(filenames[0])
+                        ids = [f'{label}:{id_}' for id_ in ids]
+                    ids = make_unique(old_ids + ids)[len(old_ids):]
+
+                appended['mzs'] = pd.concat([network.mzs, pd.Series(mzs.values, index=ids)])
+                appended['spectra'] = PackedSpectra.concatenate([network.spectra, spectra])
+                if network.rts is not None or worker.rts is not None:
+                    appended['rts'] = np.concatenate([
+                        network.rts if network.rts is not None else np.full(num_scored, np.nan),
+                        worker.rts if worker.rts is not None else np.full(len(ids), np.nan)])
+                else:
+                    appended['rts'] = None
+                if worker.infos is not None:
+                    new_infos = worker.infos.set_axis(ids)
+                elif ids != mzs.index.tolist():
+                    # Keep ids of spectra in their data file, so that metadata can still be matched to them
+                    original_ids = [str(id_) for id_ in mzs.index]
+                    new_infos = pd.DataFrame({workers_core.ReadDataWorker.ID_COLUMN: original_ids}, index=ids)
+                else:
+                    new_infos = None
+                if network.infos is not None or new_infos is not None:
+                    infos = network.infos if network.infos is not None else pd.DataFrame(index=old_ids)
+                    new_infos = new_infos if new_infos is not None else pd.DataFrame(index=ids)
+                    appended['infos'] = pd.concat([infos, new_infos])
+                else:
+                    appended['infos'] = None
+
+                return self.prepare_compute_scores_worker(appended['mzs'], appended['spectra'],
+                                                          rts=appended['rts'],
+                                                          scores=network.all_scores or network.scores)
+
+            def store_scores(worker: workers_core.AppendScoresWorker):
+                scores = worker.result()
+                if not isinstance(scores, (np.ndarray, csr_matrix, CondensedMatrix, dict)):
+                    return
+
+                self.tvNodes.model().setSelection([])
+                self.tvEdges.model().setSelection([])
+                self.tvNodes.sourceModel().beginResetModel()
+                self._network.mzs = appended['mzs']
+                self._network.spectra = appended['spectra']
+                self._network.rts = appended['rts']
+                self._network.set_scores(scores, self._network.options.score.scoring)
+                if appended['infos'] is not None:
+                    self._network.infos = appended['infos']
+                self.update_scoring_menu()
+
+                # Spectra kept to filter them again are not up to date anymore
+                self._network.raw_spectra = None
+                self._network.raw_spectra_source = None
+                self._network.raw_spectra_infos = None
+                self.tvNodes.sourceModel().endResetModel()
+                self.has_unsaved_changes = True
+
+            def set_vertices_to_layout(widget):
+                # Only lay out again new spectra and connected components whose edges changed
+                vertices = set(range(num_scored, self._network.scores.shape[0]))
+                edges = {tuple(sorted(e)) for e in widget.graph.get_edgelist()}
+                for edge in edges.symmetric_difference(old_edges[widget.id]):
+                    vertices.update(edge)
+                widget.set_vertices_to_layout(vertices)
+
+            self._workers.append(self.prepare_read_data_worker(filenames))
+            self._workers.append(create_append_scores_worker)
+            self._workers.append(store_scores)
+            for dock in self.network_docks.values():
+                widget = dock.widget()
+                if widget.name == widgets.ForceDirectedFrame.name:
+                    self._workers.append(lambda _, w=widget: self.prepare_generate_network_worker(w))
+                    self._workers.append(lambda _, w=widget: set_vertices_to_layout(w))
+                else:
+                    widget.reset_layout()
+                self._workers.append(lambda _, w=widget: w.create_draw_worker())
+            self._workers.append(lambda _: self.update_status_widgets())
+            self._workers.start()
+
+        self._dialog.finished.connect(do_append)
+        self._dialog.open()
+
     # noinspection PyUnusedLocal
     @debug
     def on_import_metadata_triggered(self, *args):
@@ -1904,6 +2069,25 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 self._workers.append(worker)
                 self._workers.start()
 
+    @debug
+    def on_scoring_triggered(self, scoring):
+        if scoring == self._network.scoring or scoring not in self._network.all_scores:
+            return
+
+        self.tvEdges.model().setSelection([])
+        self._network.use_scoring(scoring)
+        self.has_unsaved_changes = True
+
+        # Generate networks again with the new scores
+        for dock in self.network_docks.values():
+            widget = dock.widget()
+            widget.reset_layout()
+            if widget.name == widgets.ForceDirectedFrame.name:
+                self._workers.append(lambda _, w=widget: self.prepare_generate_network_worker(w, keep_vertices=True))
+            self._workers.append(lambda _, w=widget: w.create_draw_worker())
+        self._workers.append(lambda _: self.update_status_widgets())
+        self._workers.start()
+
     @debug
     def on_edit_options_triggered(self, widget):
         if hasattr(self.network, 'scores'):
@@ -1970,8 +2154,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             path = config.SQL_PATH
             if os.path.exists(path) and os.path.isfile(path) and os.path.getsize(path) > 0:
                 try:
+                    scoring = self._network.options.score.scoring
                     spectrum = human_readable_data(self._network.spectra[row],
-                                                   square_intensities=self._network.options.score.scoring == 'cosine')
+                                                   square_intensities=use_square_root(scoring))
                 except OSError as e:
                     QMessageBox.warning(self, None,
                         f"Spectrum cannot be read because the following error occurred: {str(e)}")
@@ -2611,22 +2796,56 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 self.set_nodes_pixmaps_values(None)
 
     @debug
-    def prepare_compute_scores_worker(self, mzs, spectra):
+    def prepare_compute_scores_worker(self, mzs, spectra, rts=None, scores=None):
         def error(e):
-            if isinstance(e, OSError):
+            if isinstance(e, (OSError, workers_core.NoRetentionTimesError)):
                 QMessageBox.warning(self, None, str(e))
             elif isinstance(e, MemoryError):
                 QMessageBox.critical(self, None, "Not enough memory was available to compute scores matrix.")
             else:
                 raise e
 
-        worker = workers_core.ComputeScoresWorker(mzs, spectra, self._network.options.score)
+        if scores is not None:
+            # Only compute scores of spectra appended after the ones already scored
+            worker = workers_core.AppendScoresWorker(scores, mzs, spectra, self._network.options.score, rts=rts)
+        else:
+            worker = workers_core.ComputeScoresWorker(mzs, spectra, self._network.options.score, rts=rts)
+        worker.error.connect(error)
+
+        return worker
+
+    @staticmethod
+    def get_data_source_key(filenames, options: workers_opts.ScoreComputationOptions):
+        """Key identifying data files and the options that change how they are read, but not how they are
+        filtered"""
+
+        if not isinstance(filenames, (list, tuple)):
+            filenames = [filenames]
+
+        key = []
+        for filename in filenames:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                return
+            key.append((os.path.realpath(filename), stat.st_size, stat.st_mtime_ns))
+        return tuple(key), options.is_ms1_data
+
+    @debug
+    def prepare_filter_spectra_worker(self, mzs, raw_spectra):
+        def error(e):
+            if isinstance(e, workers_core.NoSpectraError):
+                QMessageBox.warning(self, None, "No more spectra left after filtering.")
+            else:
+                raise e
+
+        worker = workers_core.FilterSpectraWorker(mzs, raw_spectra, self._network.options.score)
         worker.error.connect(error)
 
         return worker
 
     @debug
-    def prepare_read_data_worker(self, mgf_filename):
+    def prepare_read_data_worker(self, mgf_filenames, keep_raw=False):
         def error(e):
             if isinstance(e, KeyError) and e.args[0] in ("pepmass", "precursormz"):
                 QMessageBox.warning(self, None, "File format is incorrect. At least one scan has no parent's "
@@ -2642,7 +2861,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             else:
                 QMessageBox.warning(self, None, str(e))
 
-        worker = workers_core.ReadDataWorker(mgf_filename, self._network.options.score)
+        max_size = QSettings().value('Cache/max_size', config.CACHE_MAX_SIZE, type=int)
+        worker = workers_core.ReadDataWorker(mgf_filenames, self._network.options.score,
+                                             cache=SpectraCache(max_size=max_size), keep_raw=keep_raw)
         worker.error.connect(error)
 
         return worker
@@ -2657,7 +2878,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             mzs = np.zeros(self._network.scores.shape[:1], dtype=int)
 
         worker = workers_core.ForceDirectedGraphWorker(self._network.scores, mzs, widget.graph,
-                                                       options, keep_vertices=keep_vertices)
+                                                       options, keep_vertices=keep_vertices,
+                                                       neighbors=self._network.neighbors)
 
         if options.max_connected_nodes > 0:
             results = {}
@@ -2666,6 +2888,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             def create_max_connected_components_worker(worker: workers_core.ForceDirectedGraphWorker):
                 interactions, graph = worker.result()
                 results['interactions'] = interactions
+                self._network.neighbors = worker.neighbors
                 return workers_core.MaxConnectedComponentsWorker(graph, options)
 
             # noinspection PyShadowingNames
@@ -2681,6 +2904,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 interactions, graph = worker.result()
                 widget.interactions = interactions
                 widget.graph = graph
+                self._network.neighbors = worker.neighbors
                 self._network.options[widget.id] = options
 
             return [worker, save]
@@ -2689,11 +2913,20 @@ class MainWindow(QMainWindow, Ui_MainWindow):
     def prepare_read_metadata_worker(self, filename, options):
         def file_read():
             nonlocal worker
+            df = self._network.infos
+            df2 = worker.result()
+            ids = self._network.mzs.index
+            if df2.index.intersection(ids).empty:
+                # Ids of spectra merged from several files are prefixed with the name of the file they come from
+                df2 = match_metadata(df2, df if df is not None and not df.empty else pd.DataFrame(index=ids))
+                if df2.empty:
+                    QMessageBox.warning(self, None, "Metadata were not imported because no row of the metadata file "
+                                                    "matches the id of a spectrum.")
+                    return
+
             model = self.tvNodes.sourceModel()
             model.beginResetModel()
-            df = self._network.infos
             if df is not None and not df.empty:
-                df2 = worker.result()
                 df2_columns = set(df2.columns)
                 df_columns = set(df.columns)
                 new_columns = df2_columns - df_columns
@@ -2726,8 +2959,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                         df = df.join(df2[list(new_columns)])
                     self._network.infos = df
             else:
-                df = worker.result()
-                self._network.infos = df.reindex(self._network.mzs.index)
+                self._network.infos = df2.reindex(ids)
             self.has_unsaved_changes = True
             model.endResetModel()
 
@@ -2824,7 +3056,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         else:
             mzs = [0] * len(indices)
         try:
-            spectra = [self._network.spectra[index] for index in indices]
+            spectra = self._network.spectra[list(indices)]
         except OSError as e:
             QMessageBox.warning(self, None,
                                 f"One or more spectra cannot be read because the following error occurred: {str(e)}")
@@ -1,20 +1,33 @@
 import os
 
-from PySide6.QtCore import Qt, QSize
+from PySide6.QtCore import Qt, QSize, QSettings
 from PySide6.QtGui import QPalette, QColor
-from PySide6.QtWidgets import QFileDialog, QDialog, QMenu, QListWidgetItem, QMessageBox
+from PySide6.QtWidgets import QFileDialog, QDialog, QMenu, QListWidgetItem, QMessageBox, QLabel
 
 from metgem.utils.network import generate_id
+from metgem.utils.read_data import strip_compression_extension
 from metgem.utils.gui import enumerateMenu
-from metgem.workers.core import WorkerQueue, ImportModulesWorker
+from metgem.utils.memory import (MEMORY_BUDGET_FRACTION, get_memory_budget, estimate_mean_peaks, estimate_stages,
+                                 get_peak_memory, plan_options, format_size, format_duration)
+from metgem.workers.core import WorkerQueue, ImportModulesWorker, IndexDataWorker
 from metgem.workers.options import ReadMetadataOptions, AttrDict
 
-from metgem.ui.widgets import ScoreOptionsWidget, AVAILABLE_NETWORK_WIDGETS
+from metgem.ui.widgets import ScoreOptionsWidget, ForceDirectedFrame, AVAILABLE_NETWORK_WIDGETS
 from metgem.ui.widgets.network import short_id
 from metgem.ui.progress_dialog import ProgressDialog
 from metgem.ui.import_metadata_dialog import ImportMetadataDialog
 from metgem.ui.process_data_dialog_ui import Ui_ProcessFileDialog
 
+# Separator used when several files are selected for processing
+PROCESS_FILES_SEPARATOR = ';'
+
+SPECTRA_FILES_FILTERS = ["All supported formats (*.mgf *.msp *.mgf.gz *.msp.gz "
+                         "*.mgf.bz2 *.msp.bz2 *.mgf.zst *.msp.zst)",
+                         "Compressed files (*.gz *.bz2 *.zst)",
+                         "Mascot Generic Format (*.mgf)",
+                         "NIST Text Format of Individual Spectra (*.msp)",
+                         "All files (*)"]
+
 
 class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
     """Create and open a dialog to process a new .mgf file.
@@ -40,7 +53,10 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
         self._options = options if options is not None else AttrDict()
         self._dialog = None
         self._workers = WorkerQueue(self, ProgressDialog(self))
+        # Spectra are counted in their own queue, so that a file that can't be indexed does not clear `_workers`
+        self._index_workers = WorkerQueue(self, ProgressDialog(self))
         self._create_network_menu = create_network_menu
+        self._num_spectra = 0
 
         self.setupUi(self)
         self.btBrowseProcessFile.setFocus()
@@ -65,6 +81,15 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
         #     completer.setModel(model)
         #     edit.setCompleter(completer)
 
+        # Add a label showing number of spectra in selected file
+        self.lblSpectraCount = QLabel()
+        self.gbProcess.layout().insertWidget(1, self.lblSpectraCount)
+
+        # Add a label showing estimated memory usage and time of processing
+        self.lblMemoryEstimate = QLabel()
+        self.lblMemoryEstimate.setWordWrap(True)
+        self.gbProcess.layout().insertWidget(2, self.lblMemoryEstimate)
+
         # Add score options widget
         self.score_widget = ScoreOptionsWidget()
         self.layout().addWidget(self.score_widget, self.layout().count()-2, 0)
@@ -95,6 +120,7 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
 
         # Connect events
         self.btBrowseProcessFile.clicked.connect(lambda: self.browse('process'))
+        self.editProcessFile.editingFinished.connect(self.update_spectra_count)
         self.btBrowseMetadataFile.clicked.connect(lambda: self.browse('metadata'))
         self.btOptions.clicked.connect(lambda: self.on_show_options_dialog())
         self.btRemoveViews.clicked.connect(self.on_remove_views)
@@ -105,6 +131,16 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
         self.btSelectNone.clicked.connect(lambda: self.select('none'))
         self.btSelectInvert.clicked.connect(lambda: self.select('invert'))
         self.score_widget.chkSparse.clicked.connect(self.on_sparse_clicked)
+        for widget in (self.score_widget.chkSparse, self.score_widget.chkOutOfCore, self.score_widget.chkCondensed,
+                       self.score_widget.chkMultiprocessing, self.score_widget.chkUseTopK,
+                       self.score_widget.chkUseCandidates, self.score_widget.gbFiltering,
+                       self.score_widget.chkUseWindowRankFiltering):
+            widget.toggled.connect(self.update_memory_estimate)
+        for widget in (self.score_widget.cbScore, self.score_widget.cbEngine, self.score_widget.cbScoreDtype):
+            widget.currentIndexChanged.connect(self.update_memory_estimate)
+        for widget in (self.score_widget.spinTopK, self.score_widget.spinNCandidates,
+                       self.score_widget.spinMinMatchedPeaksSearch, self.score_widget.spinMatchedPeaksWindow):
+            widget.valueChanged.connect(self.update_memory_estimate)
 
     def on_sparse_clicked(self, checked: bool):
         if not checked:
@@ -125,6 +161,106 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
                 self.score_widget.chkSparse.setChecked(False)
                 return
 
+    def process_files(self):
+        """List of files to process, several files are separated by semicolons"""
+
+        return [f.strip() for f in self.editProcessFile.text().split(PROCESS_FILES_SEPARATOR) if f.strip()]
+
+    def update_spectra_count(self):
+        self.lblSpectraCount.clear()
+        self._num_spectra = 0
+        self.update_memory_estimate()
+        text = self.editProcessFile.text()
+        filenames = self.process_files()
+        if not filenames or not all(os.path.isfile(filename) for filename in filenames):
+            return
+
+        counts = []
+
+        def add_count(worker):
+            counts.append(len(worker.result()) - 1)
+            if self.editProcessFile.text() == text and len(counts) == len(filenames):
+                self.lblSpectraCount.setText(f"{sum(counts)} spectra")
+                self._num_spectra = sum(counts)
+                self.update_memory_estimate()
+
+        for filename in filenames:
+            worker = IndexDataWorker(filename)
+            worker.finished.connect(lambda w=worker: add_count(w))
+            self._index_workers.append(worker)
+        self._index_workers.start()
+
+    def files_size(self):
+        """Total size of files to process, None if some files are compressed."""
+
+        filenames = self.process_files()
+        if any(strip_compression_extension(filename) != filename for filename in filenames):
+            return
+        return sum(os.path.getsize(filename) for filename in filenames if os.path.isfile(filename))
+
+    def embedding_views(self):
+        """For each view computed by an embedding, whether it can use a sparse similarity matrix."""
+
+        views = []
+        for row in range(self.lstViews.count()):
+            widget_class = AVAILABLE_NETWORK_WIDGETS.get(self.lstViews.item(row).data(ProcessDataDialog.NameRole))
+            if widget_class is not None and widget_class.name != ForceDirectedFrame.name:
+                views.append(widget_class.worker_class.handle_sparse)
+        return views
+
+    @staticmethod
+    def memory_budget():
+        fraction = QSettings().value('Memory/budget', int(MEMORY_BUDGET_FRACTION * 100), type=int) / 100
+        return get_memory_budget(fraction)
+
+    def update_memory_estimate(self):
+        self.lblMemoryEstimate.clear()
+        self.lblMemoryEstimate.setToolTip("")
+        if self._num_spectra <= 0:
+            return
+
+        options = self.score_widget.getValues()
+        mean_peaks = estimate_mean_peaks(self._num_spectra, self.files_size(), options)
+        stages = estimate_stages(self._num_spectra, mean_peaks, options, self.embedding_views())
+        peak = get_peak_memory(stages)
+        budget = self.memory_budget()
+
+        text = f"Estimated memory: {format_size(peak)}"
+        if budget is not None:
+            text += f" (budget: {format_size(budget)})"
+        text += f", time: {format_duration(sum(stage.time for stage in stages))}"
+        disk = max(stage.disk for stage in stages)
+        if disk > 0:
+            text += f", disk: {format_size(disk)}"
+        if budget is not None and peak > budget:
+            text = f"<font color='red'>{text}</font>"
+        self.lblMemoryEstimate.setText(text)
+        self.lblMemoryEstimate.setToolTip("\n".join(f"{stage.name}: {format_size(stage.memory)}, "
+                                                    f"{format_duration(stage.time)}" for stage in stages))
+
+    def adjust_options(self):
+        """Change score computation options if estimated memory usage exceeds budget."""
+
+        budget = self.memory_budget()
+        if self._num_spectra <= 0 or budget is None or not QSettings().value('Memory/auto_adjust', True, type=bool):
+            return
+
+        options = self.score_widget.getValues()
+        mean_peaks = estimate_mean_peaks(self._num_spectra, self.files_size(), options)
+        options, stages, changes = plan_options(self._num_spectra, mean_peaks, options, budget,
+                                                self.embedding_views())
+        if changes:
+            self.score_widget.setValues(options)
+            QMessageBox.information(self, None,
+                                    f"Estimated memory usage exceeds budget ({format_size(budget)}), score "
+                                    f"computation options were changed:\n- " + "\n- ".join(changes))
+
+        peak = get_peak_memory(stages)
+        if peak > budget:
+            QMessageBox.warning(self, None,
+                                f"Estimated memory usage ({format_size(peak)}) still exceeds budget "
+                                f"({format_size(budget)}). Consider removing some views or using a sparse matrix.")
+
     def select(self, type_):
         for row in range(self.lstViews.count()):
             item = self.lstViews.item(row)
@@ -160,6 +296,7 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
                     item.setData(ProcessDataDialog.NameRole, widget_class.name)
                     item.setData(ProcessDataDialog.IdRole, id_)
                     self.lstViews.addItem(item)
+                    self.update_memory_estimate()
 
             def error_import_modules(e):
                 if isinstance(e, ImportError):
@@ -192,6 +329,7 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
             if id_ in self._options:
                 del self._options[id_]
             self.lstViews.takeItem(self.lstViews.row(item))
+        self.update_memory_estimate()
 
     def on_edit_view(self, item: QListWidgetItem = None):
         if item is None or isinstance(item, bool):
@@ -224,6 +362,7 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
         if QMessageBox.question(self, None, "Clear the list?") == QMessageBox.Yes:
             self.lstViews.clear()
             self._options = AttrDict()
+            self.update_memory_estimate()
 
     def on_show_options_dialog(self, filename=None):
         if filename is None:
@@ -244,11 +383,13 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
 
     def done(self, r):
         if r == QDialog.DialogCode.Accepted:
-            process_file = self.editProcessFile.text()
+            process_files = self.process_files()
             metadata_file = self.editMetadataFile.text()
 
-            process_ok = len(process_file) > 0 and os.path.exists(process_file)\
-                and os.path.splitext(process_file)[1].lower() in ('.mgf', '.msp')
+            process_ok = len(process_files) > 0 and all(
+                os.path.exists(process_file)
+                and os.path.splitext(strip_compression_extension(process_file))[1].lower() in ('.mgf', '.msp')
+                for process_file in process_files)
             metadata_ok = not self.gbMetadata.isChecked()\
                 or (os.path.exists(metadata_file) and os.path.isfile(metadata_file))
 
@@ -261,6 +402,8 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
             if not process_ok or not metadata_ok:
                 return
 
+            self.adjust_options()
+
         super().done(r)
 
     def browse(self, type_='process'):
@@ -270,10 +413,8 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
         dialog.setFileMode(QFileDialog.FileMode.ExistingFile)
 
         if type_ == 'process':
-            dialog.setNameFilters(["All supported formats (*.mgf *.msp)",
-                                   "Mascot Generic Format (*.mgf)",
-                                   "NIST Text Format of Individual Spectra (*.msp)",
-                                   "All files (*)"])
+            dialog.setFileMode(QFileDialog.FileMode.ExistingFiles)
+            dialog.setNameFilters(SPECTRA_FILES_FILTERS)
         elif type_ == 'metadata':
             dialog.setNameFilters(["Metadata File (*.csv *.tsv *.txt *.xls *.xlsx *.xlsm *.xlsb *.ods)",
                                    "Microsoft Excel spreadsheets (*.xls *.xlsx, *.xlsm *.xlsb)",
@@ -284,8 +425,9 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
             if result == QDialog.DialogCode.Accepted:
                 filename = dialog.selectedFiles()[0]
                 if type_ == 'process':
-                    self.editProcessFile.setText(filename)
+                    self.editProcessFile.setText(f"{PROCESS_FILES_SEPARATOR} ".join(dialog.selectedFiles()))
                     self.editProcessFile.setPalette(self.style().standardPalette())
+                    self.update_spectra_count()
                 else:
                     self.on_show_options_dialog(filename)
 
@@ -298,5 +440,5 @@ class ProcessDataDialog(QDialog, Ui_ProcessFileDialog):
         metadata_file = self.editMetadataFile.text() if os.path.isfile(self.editMetadataFile.text()) else None
         self._options.score = self.score_widget.getValues()
         views = [self.lstViews.item(row).data(ProcessDataDialog.IdRole) for row in range(self.lstViews.count())]
-        return (self.editProcessFile.text(), self.gbMetadata.isChecked(),  metadata_file,
+        return (self.process_files(), self.gbMetadata.isChecked(),  metadata_file,
                 self._metadata_options, self._options, views)
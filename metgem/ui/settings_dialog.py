@@ -8,6 +8,7 @@ from PySide6.QtWidgets import QDialog, QListWidgetItem
 
 from metgem.utils.gui import SignalBlocker
 from metgem.config import STYLES_PATH, APP_PATH, get_python_rendering_flag
+from metgem.utils.memory import MEMORY_BUDGET_FRACTION
 
 if get_python_rendering_flag():
     from PySide6MolecularNetwork._pure import style_from_css, NetworkScene
@@ -99,6 +100,10 @@ class SettingsDialog(QDialog, Ui_SettingsDialog):
         if value is not None:
             self.spinFloatPrecision.setValue(value)
 
+        # Memory tab
+        self.spinMemoryBudget.setValue(settings.value('Memory/budget', int(MEMORY_BUDGET_FRACTION * 100), type=int))
+        self.chkAutoAdjustOptions.setChecked(settings.value('Memory/auto_adjust', True, type=bool))
+
     def showEvent(self, event: QShowEvent):
         self.tabWidget.setCurrentIndex(0)
         self.gvStylePreview.zoomToFit()
@@ -125,6 +130,8 @@ class SettingsDialog(QDialog, Ui_SettingsDialog):
             settings = QSettings()
             settings.setValue('Metadata/neutral_tolerance', self.spinNeutralTolerance.value())
             settings.setValue('Metadata/float_precision', self.spinFloatPrecision.value())
+            settings.setValue('Memory/budget', self.spinMemoryBudget.value())
+            settings.setValue('Memory/auto_adjust', self.chkAutoAdjustOptions.isChecked())
             settings.setValue('NetworkView/style', self.lstStyles.currentItem().data(CssRole))
             settings.setValue('NetworkView/style_font_size',
                               self.spinFontSize.value() if self.chkOverrideFontSize.isChecked() else None)
@@ -4,7 +4,7 @@ import numpy as np
 import igraph as ig
 import pandas as pd
 from PySide6.QtCore import Signal, Qt, QObject
-from PySide6.QtGui import QPen
+from PySide6.QtGui import QPen, QColor
 from PySide6.QtWidgets import QFrame, QWidget, QGraphicsLineItem
 
 from metgem.ui.widgets.annotations import AnnotationsNetworkScene
@@ -12,6 +12,7 @@ from metgem.ui.edit_options_dialog import (EditForceDirectedOptionsDialog, EditT
                                            EditMDSOptionsDialog, EditIsomapOptionsDialog,
                                            EditUMAPOptionsDialog, EditPHATEOptionsDialog)
 from metgem import config
+from metgem.utils.network import get_edge_arrays
 from metgem.workers import core as workers_core
 from metgem.workers import options as workers_opts
 from metgem.ui.widgets.network_ui import Ui_NetworkFrame
@@ -179,6 +180,18 @@ class BaseFrame(QFrame, Ui_NetworkFrame):
 
         # Add nodes
         nodes = scene.nodes()
+        num_nodes = len(self._graph.vs) if self._graph.vs else self._network.scores.shape[0]
+        if nodes and len(nodes) != num_nodes:
+            # Spectra have been appended, create nodes again and keep colors and sizes of existing nodes
+            if not colors:
+                colors = scene.nodesColors()
+            if not len(radii):
+                radii = scene.nodesRadii()
+            colors = list(colors) + [QColor()] * (num_nodes - len(colors))
+            radii = list(radii) + [config.RADIUS] * (num_nodes - len(radii))
+            scene.removeAllNodes()
+            nodes = []
+
         if not nodes:
             indexes = None
             if self._graph.vs:  # Network views
@@ -193,10 +206,11 @@ class BaseFrame(QFrame, Ui_NetworkFrame):
 
         if self.use_edges:
             # Add edges
-            edges_attr = [(e.index, nodes[e.source], nodes[e.target], e['__width'])
-                          for e in self._graph.es if not e.is_loop()]
-            if edges_attr:
-                scene.createEdges(*zip(*edges_attr))
+            indexes, sources, targets, widths = get_edge_arrays(self._graph)
+            if indexes.size > 0:
+                nodes = np.array(nodes, dtype=object)
+                scene.createEdges(indexes.tolist(), nodes[sources].tolist(), nodes[targets].tolist(),
+                                  widths.tolist())
 
         if layout is not None:
             self._layout = layout
@@ -226,6 +240,7 @@ class ForceDirectedFrame(BaseFrame):
     worker_class = workers_core.ForceDirectedWorker
     options_class = workers_opts.ForceDirectedVisualizationOptions
     use_edges = True
+    _vertices_to_layout = None
 
     def process_graph_before_export(self, g):
         g.delete_edges([edge for edge in g.es if edge.is_loop()])
@@ -234,8 +249,17 @@ class ForceDirectedFrame(BaseFrame):
                 del g.es[attr]
         return g
 
+    def set_vertices_to_layout(self, vertices):
+        """Only lay out connected components including one of `vertices` next time layout is computed."""
+
+        self._vertices_to_layout = vertices
+
     def create_worker(self, options=None):
         options = self._network.options[self.id] if options is None else options
+        vertices, self._vertices_to_layout = self._vertices_to_layout, None
+        if vertices is not None and self._layout is not None:
+            return self.worker_class(self._graph, self.scene().nodesRadii(), options,
+                                     layout=self._layout, vertices=vertices)
         return self.worker_class(self._graph, self.scene().nodesRadii(), options)
 
 
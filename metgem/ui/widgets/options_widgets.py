@@ -9,6 +9,8 @@ from metgem.workers.options import (ForceDirectedVisualizationOptions,
                                     ScoreComputationOptions,
                                     QueryDatabasesOptions,
                                     )
+from metgem.utils.candidates import HAS_HNSWLIB
+from metgem.utils.scoring import SCORINGS
 
 from metgem.ui.widgets.force_directed_options_widget_ui import Ui_ForceDirectedOptionsWidget
 from metgem.ui.widgets.tsne_options_widget_ui import Ui_TSNEOptionsWidget
@@ -61,6 +63,11 @@ class ForceDirectedOptionsWidget(VisualizationOptionsWidget, Ui_ForceDirectedOpt
         options.max_connected_nodes = self.spinForceDirectedMaxConnectedComponentSize.value()
         options.scale = self.spinForceDirectedScale.value()
         options.gravity = self.spinForceDirectedGravity.value()
+        options.max_iterations = self.spinForceDirectedMaxIterations.value()
+        if self.chkForceDirectedAdaptiveIterations.isChecked():
+            options.update(options.ADAPTIVE_ITERATIONS)
+        else:
+            options.update({'min_iterations': options.max_iterations, 'convergence_tolerance': 0.})
         return options
 
     def setValues(self, options):
@@ -77,6 +84,8 @@ class ForceDirectedOptionsWidget(VisualizationOptionsWidget, Ui_ForceDirectedOpt
         self.spinForceDirectedMaxConnectedComponentSize.setValue(options.max_connected_nodes)
         self.spinForceDirectedScale.setValue(options.scale)
         self.spinForceDirectedGravity.setValue(options.gravity)
+        self.spinForceDirectedMaxIterations.setValue(options.get('max_iterations', 1000))
+        self.chkForceDirectedAdaptiveIterations.setChecked(options.get('convergence_tolerance', 0) > 0)
 
 
 class TSNEOptionsWidget(VisualizationOptionsWidget, Ui_TSNEOptionsWidget):
@@ -239,17 +248,46 @@ class ScoreOptionsWidget(OptionsGroupBox, Ui_gbScoreOptions):
         self.cbScore.addItem("Cosine", "cosine")
         self.cbScore.addItem("Entropy", "entropy")
         self.cbScore.addItem("Weighted Entropy", "weighted_entropy")
+        self.cbScore.addItem("All (Cosine, Entropy, Weighted Entropy)", list(SCORINGS))
+
+        self.cbEngine.addItem("Compiled (libmetgem)", "libmetgem")
+        self.cbEngine.addItem("Vectorized (NumPy)", "numpy")
+
+        self.cbScoreDtype.addItem("32-bit float", "float32")
+        self.cbScoreDtype.addItem("16-bit float", "float16")
+        self.cbScoreDtype.addItem("8-bit (steps of 1/255)", "uint8")
+
+        self.cbCandidatesMethod.addItem("Locality sensitive hashing", "lsh")
+        if HAS_HNSWLIB:
+            self.cbCandidatesMethod.addItem("HNSW index", "hnsw")
 
         self.chkUseMinMZ.stateChanged.connect(self.spinMinMZ.setEnabled)
         self.chkUseParentFiltering.stateChanged.connect(self.spinParentFilterTolerance.setEnabled)
         self.chkUseMinIntensityFiltering.stateChanged.connect(self.spinMinIntensity.setEnabled)
         self.chkUseWindowRankFiltering.stateChanged.connect(self.spinMinMatchedPeaksSearch.setEnabled)
         self.chkUseWindowRankFiltering.stateChanged.connect(self.spinMatchedPeaksWindow.setEnabled)
+        self.chkUseMzBlocking.stateChanged.connect(self.spinMaxMzDelta.setEnabled)
+        self.chkUseRtBlocking.stateChanged.connect(self.spinMaxRtDelta.setEnabled)
+        self.chkSparse.toggled.connect(self.chkOutOfCore.setDisabled)
+        self.chkSparse.toggled.connect(self.chkCondensed.setDisabled)
+        self.chkSparse.toggled.connect(self.chkUseTopK.setEnabled)
+        self.chkSparse.toggled.connect(lambda checked: self.spinTopK.setEnabled(checked
+                                                                                and self.chkUseTopK.isChecked()))
+        self.chkUseTopK.toggled.connect(self.spinTopK.setEnabled)
+        self.chkUseCandidates.toggled.connect(self.spinNCandidates.setEnabled)
+        self.chkUseCandidates.toggled.connect(self.cbCandidatesMethod.setEnabled)
+        self.chkUseCandidates.toggled.connect(self.updateLshTables)
+        self.cbCandidatesMethod.currentIndexChanged.connect(self.updateLshTables)
+
+    def updateLshTables(self):
+        self.spinLshTables.setEnabled(self.chkUseCandidates.isChecked()
+                                      and self.cbCandidatesMethod.currentData() == 'lsh')
 
     def getValues(self):
         options = super().getValues()
 
         options.scoring = self.cbScore.currentData()
+        options.engine = self.cbEngine.currentData()
         options.mz_tolerance = self.spinMZTolerance.value()
         options.min_matched_peaks = self.spinMinMatchedPeaks.value()
         options.min_mz = self.spinMinMZ.value()
@@ -259,11 +297,25 @@ class ScoreOptionsWidget(OptionsGroupBox, Ui_gbScoreOptions):
         options.matched_peaks_window = self.spinMatchedPeaksWindow.value()
         options.is_ms1_data = self.chkMS1Data.isChecked()
         options.dense_output = not self.chkSparse.isChecked()
+        options.out_of_core = self.chkOutOfCore.isChecked()
+        options.condensed = self.chkCondensed.isChecked()
+        options.score_dtype = self.cbScoreDtype.currentData()
+        options.use_multiprocessing = self.chkMultiprocessing.isChecked()
+        options.use_top_k = self.chkUseTopK.isChecked()
+        options.top_k = self.spinTopK.value()
+        options.use_candidates = self.chkUseCandidates.isChecked()
+        options.candidates_method = self.cbCandidatesMethod.currentData()
+        options.n_candidates = self.spinNCandidates.value()
+        options.lsh_tables = self.spinLshTables.value()
         options.use_filtering = self.gbFiltering.isChecked()
         options.use_min_mz_filter = self.chkUseMinMZ.isChecked()
         options.use_min_intensity_filter = self.chkUseMinIntensityFiltering.isChecked()
         options.use_parent_filter = self.chkUseParentFiltering.isChecked()
         options.use_window_rank_filter = self.chkUseWindowRankFiltering.isChecked()
+        options.use_mz_blocking = self.chkUseMzBlocking.isChecked()
+        options.max_mz_delta = self.spinMaxMzDelta.value()
+        options.use_rt_blocking = self.chkUseRtBlocking.isChecked()
+        options.max_rt_delta = self.spinMaxRtDelta.value()
 
         return options
 
@@ -275,6 +327,21 @@ class ScoreOptionsWidget(OptionsGroupBox, Ui_gbScoreOptions):
                 self.cbScore.setCurrentIndex(i)
                 break
 
+        for i in range(self.cbEngine.count()):
+            if self.cbEngine.itemData(i) == options.engine:
+                self.cbEngine.setCurrentIndex(i)
+                break
+
+        for i in range(self.cbScoreDtype.count()):
+            if self.cbScoreDtype.itemData(i) == options.score_dtype:
+                self.cbScoreDtype.setCurrentIndex(i)
+                break
+
+        for i in range(self.cbCandidatesMethod.count()):
+            if self.cbCandidatesMethod.itemData(i) == options.candidates_method:
+                self.cbCandidatesMethod.setCurrentIndex(i)
+                break
+
         self.spinMZTolerance.setValue(options.mz_tolerance)
         self.spinMinMatchedPeaks.setValue(options.min_matched_peaks)
         self.spinMinMZ.setValue(options.min_mz)
@@ -284,11 +351,30 @@ class ScoreOptionsWidget(OptionsGroupBox, Ui_gbScoreOptions):
         self.spinMatchedPeaksWindow.setValue(options.matched_peaks_window)
         self.chkMS1Data.setChecked(options.is_ms1_data)
         self.chkSparse.setChecked(not options.dense_output)
+        self.chkOutOfCore.setChecked(options.out_of_core)
+        self.chkOutOfCore.setEnabled(options.dense_output)
+        self.chkCondensed.setChecked(options.condensed)
+        self.chkCondensed.setEnabled(options.dense_output)
+        self.chkMultiprocessing.setChecked(options.use_multiprocessing)
+        self.chkUseTopK.setChecked(options.use_top_k)
+        self.chkUseTopK.setEnabled(not options.dense_output)
+        self.spinTopK.setValue(options.top_k)
+        self.spinTopK.setEnabled(not options.dense_output and options.use_top_k)
+        self.chkUseCandidates.setChecked(options.use_candidates)
+        self.spinNCandidates.setValue(options.n_candidates)
+        self.spinNCandidates.setEnabled(options.use_candidates)
+        self.cbCandidatesMethod.setEnabled(options.use_candidates)
+        self.spinLshTables.setValue(options.lsh_tables)
+        self.updateLshTables()
         self.gbFiltering.setChecked(options.use_filtering)
         self.chkUseMinMZ.setChecked(options.use_min_mz_filter)
         self.chkUseMinIntensityFiltering.setChecked(options.use_min_intensity_filter)
         self.chkUseParentFiltering.setChecked(options.use_parent_filter)
         self.chkUseWindowRankFiltering.setChecked(options.use_window_rank_filter)
+        self.chkUseMzBlocking.setChecked(options.use_mz_blocking)
+        self.spinMaxMzDelta.setValue(options.max_mz_delta)
+        self.chkUseRtBlocking.setChecked(options.use_rt_blocking)
+        self.spinMaxRtDelta.setValue(options.max_rt_delta)
 
 
 class QueryDatabasesOptionsWidget(OptionsGroupBox, Ui_gbDatabaseOptions):
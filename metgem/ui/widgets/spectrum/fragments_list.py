@@ -10,6 +10,7 @@ from libmetgem import MZ, square_root_data, normalize_data
 from libmetgem.score import compare_spectra, SpectraMatchState
 
 from metgem.ui.widgets.spectrum.fragments_list_ui import Ui_Form
+from metgem.utils.scoring import get_scorings
 
 
 def findParent(type_, widget):
@@ -74,7 +75,8 @@ class FragmentsListWidget(QWidget, Ui_Form):
 
         if main_window is not None and mz1 is not None and data1 is not None and mz2 is not None and data2 is not None:
             options = main_window.network.options
-            if options.score.scoring == 'cosine':
+            scoring = main_window.network.scoring or get_scorings(options.score.scoring)[0]
+            if scoring == 'cosine':
                 data1 = normalize_data(square_root_data(data1), norm='dot')
                 data2 = normalize_data(square_root_data(data2), norm='dot')
             else:
@@ -82,7 +84,7 @@ class FragmentsListWidget(QWidget, Ui_Form):
                 data2 = normalize_data(data2, norm='sum')
             matches = compare_spectra(mz1, data1, mz2, data2,
                                       options.score.mz_tolerance,
-                                      options.score.scoring)
+                                      scoring)
             if matches.size == 0:
                 return
 
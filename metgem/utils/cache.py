@@ -0,0 +1,147 @@
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from metgem.config import CACHE_PATH, CACHE_MAX_SIZE
+from metgem.utils.spectra import PackedSpectra
+
+# Increment if the way spectra are read or filtered changes, so that outdated entries are not used anymore
+CACHE_VERSION = 2
+
+CACHE_EXTENSION = '.npz'
+
+# Hashes of files already computed in this session, keyed by path, size and modification time
+_hashes = {}
+
+
+def file_hash(filename, block_size=2 ** 20):
+    """Hash of the content of a file."""
+
+    stat = os.stat(filename)
+    key = (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+    try:
+        return _hashes[key]
+    except KeyError:
+        pass
+
+    h = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+
+    _hashes[key] = h.hexdigest()
+    return _hashes[key]
+
+
+class SpectraCache:
+    """On-disk cache of parsed and filtered spectra.
+
+    Entries are keyed by a hash of the content of the data file and of the parameters used for filtering.
+    Once total size of the cache exceeds `max_size`, least recently used entries are removed.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_size=CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def key(self, filename, params: dict):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(file_hash(filename).encode())
+        h.update(json.dumps({'version': CACHE_VERSION, **params}, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + CACHE_EXTENSION)
+
+    def get(self, key):
+        """Returns parent masses, ids, spectra and retention times (None if they were not stored) stored for
+        `key` or None if there is no such entry."""
+
+        path = self.entry_path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                mzs = data['mzs'].tolist()
+                ids = data['ids'].tolist()
+                spectra = PackedSpectra(data['peaks'], data['offsets'])
+                rts = data['rts'] if 'rts' in data.files else None
+        except (OSError, KeyError, ValueError):
+            return
+
+        # Mark entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return mzs, ids, spectra, rts
+
+    def put(self, key, mzs, ids, spectra: PackedSpectra, rts=None):
+        """Store parent masses, ids, spectra and optionally retention times for `key`.
+        Returns True if entry has been stored."""
+
+        ids = np.asarray(ids)
+        if ids.dtype.kind not in 'iuf' or ids.shape[0] != len(spectra):
+            return False  # Only numeric ids can be stored without pickling
+
+        if spectra.nbytes > self.max_size:
+            return False
+
+        path = self.entry_path(key)
+        tmp_path = path + '.tmp'
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                arrays = dict(mzs=np.asarray(mzs, dtype=np.float64), ids=ids,
+                              peaks=spectra.peaks, offsets=spectra.offsets)
+                if rts is not None:
+                    arrays['rts'] = np.asarray(rts, dtype=np.float64)
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+
+        self.evict()
+        return True
+
+    def entries(self):
+        """List of (path, size, last access time) of entries, least recently used first."""
+
+        entries = []
+        for path in glob.glob(os.path.join(self.path, '*' + CACHE_EXTENSION)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    def size(self):
+        return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        """Remove least recently used entries until size of the cache is below limit."""
+
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for path, size, _ in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # Entry may be in use on Windows
+                continue
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,199 @@
+"""Approximate nearest neighbours search of spectra, used to only compute exact scores for pairs of spectra that
+are likely to be similar.
+
+Spectra are embedded as binned vectors of fragments and neutral losses, normalized and reduced by a random
+projection. Candidate neighbours are then searched with random-projection locality sensitive hashing or, if
+`hnswlib` is installed, with a HNSW index.
+"""
+
+import math
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from metgem.utils.scoring import score_rows
+from metgem.utils.spectra import PackedSpectra
+
+try:
+    import hnswlib
+except ImportError:
+    HAS_HNSWLIB = False
+else:
+    HAS_HNSWLIB = True
+
+CANDIDATES_METHODS = ('lsh', 'hnsw') if HAS_HNSWLIB else ('lsh',)
+
+# Width of bins used to embed spectra, in Da
+BIN_WIDTH = 1.
+
+# Size of embedding vectors
+N_COMPONENTS = 256
+
+# Number of rows of embedding compared at once inside a bucket
+BLOCK_SIZE = 1024
+
+# Expected size of buckets of hash tables, relative to the number of candidates
+BUCKET_SIZE_FACTOR = 8
+
+# Parameters of HNSW index
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+
+# Number of spectra scored against all others to estimate recall
+RECALL_SAMPLE_SIZE = 100
+
+# Minimum score of neighbours taken into account to estimate recall, lower scores are not used in networks
+RECALL_MIN_SCORE = 0.5
+
+
+def embed_spectra(mzs, spectra, bin_width=BIN_WIDTH, n_components=N_COMPONENTS, seed=0):
+    """Embed `spectra` as vectors of intensities binned by m/z and by neutral loss, reduced to `n_components`
+    dimensions by a gaussian random projection.
+
+    Returns a (n, `n_components`) array of normalized vectors, empty spectra getting null vectors."""
+
+    spectra = PackedSpectra.from_list(spectra)
+    mzs = np.asarray(mzs, dtype=np.float64)
+    n = len(spectra)
+    owners = np.repeat(np.arange(n), spectra.counts())
+    peak_mzs = spectra.peaks[:, 0].astype(np.float64)
+    intensities = spectra.peaks[:, 1].astype(np.float64)
+    losses = mzs[owners] - peak_mzs
+
+    # Peaks above parent mass don't have a neutral loss
+    mz_bins = np.floor(np.maximum(peak_mzs, 0) / bin_width).astype(np.int64)
+    valid = losses >= 0
+    n_mz_bins = int(mz_bins.max()) + 1 if mz_bins.size > 0 else 1
+    loss_bins = np.floor(losses[valid] / bin_width).astype(np.int64) + n_mz_bins
+    n_bins = int(loss_bins.max()) + 1 if loss_bins.size > 0 else n_mz_bins
+
+    vectors = csr_matrix((np.concatenate((intensities, intensities[valid])),
+                          (np.concatenate((owners, owners[valid])), np.concatenate((mz_bins, loss_bins)))),
+                         shape=(n, n_bins))
+    rng = np.random.default_rng(seed)
+    projection = rng.standard_normal((n_bins, n_components)).astype(np.float32)
+    embedding = np.asarray(vectors @ projection, dtype=np.float32)
+
+    norms = np.linalg.norm(embedding, axis=1, keepdims=True)
+    return embedding / np.where(norms > 0, norms, 1)
+
+
+def top_per_row(rows, cols, values, k, n):
+    """Only keep the `k` pairs with highest `values` for each row, without duplicated pairs."""
+
+    _, index = np.unique(rows * n + cols, return_index=True)
+    rows, cols, values = rows[index], cols[index], values[index]
+    # Sort by rows, then by decreasing values which are similarities in [-1, 1]
+    order = np.argsort(rows * 4. + (1 - values))
+    rows, cols, values = rows[order], cols[order], values[order]
+    _, first, counts = np.unique(rows, return_index=True, return_counts=True)
+    ranks = np.arange(rows.shape[0]) - np.repeat(first, counts)
+    mask = ranks < k
+    return rows[mask], cols[mask], values[mask]
+
+
+def lsh_neighbors(embedding, n_candidates, n_tables=16, seed=0):
+    """Approximate `n_candidates` nearest neighbours of each vector of `embedding` with random-projection locality
+    sensitive hashing.
+
+    In each of `n_tables` hash tables, vectors are hashed by the side of random hyperplanes they lie on, with
+    enough hyperplanes to get buckets of a few times `n_candidates` vectors. Vectors sharing a bucket are compared
+    exactly. More tables give a better recall.
+    Returns rows, columns and approximate similarities of candidate pairs."""
+
+    n, n_components = embedding.shape
+    n_bits = min(62, max(1, math.ceil(math.log2(max(1, n / max(1, BUCKET_SIZE_FACTOR * n_candidates))))))
+    weights = np.left_shift(1, np.arange(n_bits, dtype=np.int64))
+    rng = np.random.default_rng(seed)
+
+    best = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+    for _ in range(n_tables):
+        results = [best]
+        planes = rng.standard_normal((n_components, n_bits)).astype(np.float32)
+        codes = (embedding @ planes > 0).astype(np.int64) @ weights
+        order = np.argsort(codes, kind='stable')
+        bounds = np.flatnonzero(np.diff(codes[order])) + 1
+        for members in np.split(order, bounds):
+            if members.shape[0] < 2:
+                continue
+            k = min(n_candidates, members.shape[0] - 1)
+            for start in range(0, members.shape[0], BLOCK_SIZE):
+                block = members[start:start+BLOCK_SIZE]
+                sims = embedding[block] @ embedding[members].T
+                sims[np.arange(block.shape[0]), np.arange(start, start + block.shape[0])] = -np.inf
+                top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+                results.append((np.repeat(block, k), members[top].ravel(),
+                                np.take_along_axis(sims, top, axis=1).ravel()))
+        best = top_per_row(*(np.concatenate(x) for x in zip(*results)), n_candidates, n)
+
+    return best
+
+
+def hnsw_neighbors(embedding, n_candidates, seed=0):
+    """Approximate `n_candidates` nearest neighbours of each vector of `embedding` with a HNSW index.
+
+    Returns rows, columns and approximate similarities of candidate pairs."""
+
+    if not HAS_HNSWLIB:
+        raise ValueError("hnswlib is not installed, use locality sensitive hashing instead.")
+
+    n, n_components = embedding.shape
+    k = min(n_candidates + 1, n)
+    index = hnswlib.Index(space='ip', dim=n_components)
+    index.init_index(max_elements=n, ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M, random_seed=seed)
+    index.add_items(embedding, np.arange(n))
+    index.set_ef(max(2 * k, HNSW_EF_CONSTRUCTION // 2))
+    labels, distances = index.knn_query(embedding, k=k)
+
+    rows = np.repeat(np.arange(n), k)
+    cols = labels.astype(np.int64).ravel()
+    mask = rows != cols
+    return top_per_row(rows[mask], cols[mask], 1 - distances.ravel()[mask], n_candidates, n)
+
+
+def get_candidates(mzs, spectra, n_candidates, method='lsh', n_tables=16, seed=0):
+    """Pairs of spectra worth scoring: approximate `n_candidates` nearest neighbours of each spectrum.
+
+    `method` can be 'lsh' (see `lsh_neighbors`, `n_tables` being the number of hash tables) or 'hnsw'.
+    Returns rows and columns of candidate pairs, with row < column."""
+
+    embedding = embed_spectra(mzs, spectra, seed=seed)
+
+    # Empty spectra can't be similar to any other spectrum
+    valid = np.flatnonzero(np.any(embedding != 0, axis=1))
+    if valid.shape[0] < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    if method == 'hnsw':
+        rows, cols, _ = hnsw_neighbors(embedding[valid], n_candidates, seed=seed)
+    elif method == 'lsh':
+        rows, cols, _ = lsh_neighbors(embedding[valid], n_candidates, n_tables=n_tables, seed=seed)
+    else:
+        raise ValueError(f"Unknown nearest neighbours search method: {method}.")
+
+    n = len(spectra)
+    rows, cols = valid[rows], valid[cols]
+    keys = np.unique(np.minimum(rows, cols) * n + np.maximum(rows, cols))
+    return keys // n, keys % n
+
+
+def estimate_recall(mzs, spectra, rows, cols, n_candidates, mz_tolerance, min_matched_peaks, scoring='cosine',
+                    sample_size=RECALL_SAMPLE_SIZE, seed=0):
+    """Estimate the fraction of the `n_candidates` best exact neighbours of spectra that are in candidate pairs
+    (`rows`, `cols`), by scoring a random sample of `sample_size` spectra against all spectra. Only neighbours
+    with a score of at least `RECALL_MIN_SCORE` are taken into account.
+
+    Returns None if sampled spectra don't have any neighbour."""
+
+    n = len(spectra)
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(n, min(n, sample_size), replace=False))
+    r, c, v = score_rows(mzs, spectra, sample, mz_tolerance, min_matched_peaks, scoring)
+    mask = v >= RECALL_MIN_SCORE
+    r, c, _ = top_per_row(r[mask], c[mask], v[mask], n_candidates, n)
+    if r.shape[0] == 0:
+        return
+
+    candidates = np.asarray(rows, dtype=np.int64) * n + np.asarray(cols, dtype=np.int64)
+    found = np.isin(np.minimum(r, c) * n + np.maximum(r, c), candidates)
+    return float(np.count_nonzero(found) / found.shape[0])
@@ -0,0 +1,480 @@
+import glob
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix, issparse
+
+from metgem.config import SCRATCH_PATH
+
+# Maximum size in bytes of a block of rows of a similarity matrix loaded in memory at once
+BLOCK_MAX_BYTES = 2 ** 28
+
+# Number of rows of a sparse similarity matrix processed at once
+SPARSE_BLOCK_ROWS = 4096
+
+SCRATCH_EXTENSION = '.dat'
+
+INTERACTIONS_DTYPE = np.dtype([('Source', int), ('Target', int), ('Delta MZ', np.float32), ('Cosine', np.float32)])
+
+# Types that can be used to store scores, scores stored as integers have a resolution of 1/QUANTIZATION_STEPS
+SCORE_DTYPES = ('float32', 'float16', 'uint8')
+QUANTIZATION_STEPS = 255
+
+
+def get_sparse_dtype(dtype):
+    """Type used to store scores of sparse matrices instead of `dtype`, as they can't store half-precision floats."""
+
+    dtype = np.dtype(dtype)
+    return np.dtype(np.float32) if dtype == np.float16 else dtype
+
+
+def quantize(values, dtype):
+    """Convert scores in [0, 1] to `dtype`, `values` being an array or a sparse matrix."""
+
+    dtype = np.dtype(dtype)
+    if issparse(values):
+        values = values.tocsr()
+        return csr_matrix((quantize(values.data, get_sparse_dtype(dtype)), values.indices, values.indptr),
+                          shape=values.shape)
+
+    values = np.asarray(values)
+    if dtype.kind == 'u':
+        return np.rint(np.clip(values, 0, 1) * QUANTIZATION_STEPS).astype(dtype)
+    return values.astype(dtype, copy=False)
+
+
+def dequantize(values):
+    """Convert scores stored by `quantize` to floating point values, `values` being an array or a sparse matrix."""
+
+    if issparse(values):
+        values = values.tocsr()
+        return csr_matrix((dequantize(values.data), values.indices, values.indptr), shape=values.shape)
+
+    values = np.asarray(values)
+    if values.dtype.kind == 'u':
+        return values.astype(np.float32) / QUANTIZATION_STEPS
+    return values.astype(np.result_type(values.dtype, np.float32), copy=False)
+
+
+def create_memmap(shape, dtype=np.float32, path=SCRATCH_PATH):
+    """Create a zero-filled array backed by a temporary file in `path`.
+
+    Where the platform allows it, file is unlinked right away so that disk space is released as soon as the array
+    is garbage collected. Otherwise it is removed by `clean_scratch` on next start.
+    """
+
+    os.makedirs(path, exist_ok=True)
+    fd, filename = tempfile.mkstemp(suffix=SCRATCH_EXTENSION, dir=path)
+    os.close(fd)
+    array = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+    if not sys.platform.startswith('win'):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+    return array
+
+
+def create_scratch_folder(path=SCRATCH_PATH):
+    """Create a temporary folder in `path` for files written by a pool of processes.
+
+    Folder should be removed with `shutil.rmtree` once processes are finished, which also removes files left by
+    processes that were killed. If the application itself is killed, folder is removed by `clean_scratch` on next
+    start.
+    """
+
+    os.makedirs(path, exist_ok=True)
+    return tempfile.mkdtemp(suffix=SCRATCH_EXTENSION, dir=path)
+
+
+def clean_scratch(path=SCRATCH_PATH):
+    """Remove files and folders left in scratch directory by previous sessions."""
+
+    for filename in glob.glob(os.path.join(path, '*' + SCRATCH_EXTENSION)):
+        try:
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            else:
+                os.remove(filename)
+        except OSError:  # File may still be in use by another instance on Windows
+            pass
+
+
+class CondensedMatrix:
+    """Symmetric similarity matrix with ones on diagonal, storing only its upper triangle.
+
+    Values above diagonal are stored row by row in a 1-D array `data` of `n`x(`n`-1)/2 values, which can be
+    memory-mapped. Indexing with a pair of integers gives a score, other indexing gives dense rows, so that the
+    matrix can be read by blocks of rows like a dense one.
+    """
+
+    ndim = 2
+
+    def __init__(self, n, data=None, dtype=np.float32):
+        size = n * (n - 1) // 2
+        if data is None:
+            data = np.zeros(size, dtype=dtype)
+        elif data.shape != (size,):
+            raise ValueError(f"Expected {size} values for a condensed {n}x{n} matrix, got {data.shape[0]}.")
+        self.n = n
+        self.data = data
+
+    @classmethod
+    def from_data(cls, data):
+        """Create matrix from values of its upper triangle, size of matrix being inferred from number of values."""
+
+        n = int(round((1 + math.sqrt(1 + 8 * data.shape[0])) / 2)) if data.shape[0] > 0 else 0
+        return cls(n, data)
+
+    @classmethod
+    def from_dense(cls, matrix, data=None, dtype=None):
+        """Condense a dense symmetric `matrix`, read by blocks of rows."""
+
+        condensed = cls(matrix.shape[0], data=data, dtype=matrix.dtype if dtype is None else dtype)
+        for start, stop, block in iter_row_blocks(matrix):
+            condensed.set_rows(start, block)
+        return condensed
+
+    @property
+    def shape(self):
+        return self.n, self.n
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def size(self):
+        return self.n * self.n
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def offsets(self, rows):
+        """Position in `data` of the value just after the diagonal for each row of `rows`."""
+
+        rows = np.asarray(rows, dtype=np.int64)
+        return rows * (2 * self.n - rows - 1) // 2
+
+    def index(self, rows, cols):
+        """Position in `data` of values at (`rows`, `cols`), with `rows` != `cols`."""
+
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        r, c = np.minimum(rows, cols), np.maximum(rows, cols)
+        return self.offsets(r) + c - r - 1
+
+    def set_rows(self, start, block):
+        """Store upper triangle part of dense rows `block` starting at row `start`."""
+
+        offsets = self.offsets(np.arange(start, start + block.shape[0]))
+        for i, offset in enumerate(offsets):
+            row = start + i
+            self.data[offset:offset + block.shape[1] - row - 1] = quantize(block[i, row + 1:], self.dtype)
+
+    def set_values(self, rows, cols, values):
+        """Set values at (`rows`, `cols`) and (`cols`, `rows`), with `rows` != `cols`."""
+
+        self.data[self.index(rows, cols)] = quantize(values, self.dtype)
+
+    def row(self, i):
+        result = np.empty(self.n, dtype=self.dtype)
+        if i > 0:
+            result[:i] = self.data[self.index(np.arange(i), i)]
+        result[i] = quantize(1, self.dtype)
+        offset = self.offsets(i)
+        result[i + 1:] = self.data[offset:offset + self.n - i - 1]
+        return result
+
+    def take_rows(self, rows):
+        """Dense array made of `rows`."""
+
+        result = np.empty((len(rows), self.n), dtype=self.dtype)
+        for i, row in enumerate(rows):
+            result[i] = self.row(row)
+        return result
+
+    def toarray(self):
+        return self.take_rows(range(self.n))
+
+    def __array__(self, dtype=None, copy=None):
+        result = self.toarray()
+        return result if dtype is None else result.astype(dtype, copy=False)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key
+            if np.isscalar(rows) and np.isscalar(cols):
+                if rows == cols:
+                    return quantize(1, self.dtype)[()]
+                return self.data[self.index(rows, cols)]
+            return self[rows][..., cols]
+
+        if np.isscalar(key):
+            return self.row(int(key))
+        elif isinstance(key, slice):
+            return self.take_rows(range(*key.indices(self.n)))
+        key = np.asarray(key)
+        return self.take_rows(np.flatnonzero(key) if key.dtype == bool else key)
+
+
+def is_out_of_core(matrix):
+    if isinstance(matrix, CondensedMatrix):
+        return isinstance(matrix.data, np.memmap)
+    return isinstance(matrix, np.memmap)
+
+
+def is_read_by_blocks(matrix):
+    """Whether dense `matrix` is stored on disk, condensed or with reduced precision, and has to be read by blocks of
+    rows to be processed."""
+
+    if issparse(matrix):
+        return False
+    return is_out_of_core(matrix) or isinstance(matrix, CondensedMatrix) or matrix.dtype != np.float32
+
+
+def get_block_size(matrix, max_bytes=BLOCK_MAX_BYTES):
+    """Number of rows of `matrix` that fit in `max_bytes`."""
+
+    row_bytes = matrix.shape[1] * np.result_type(matrix.dtype, np.float32).itemsize
+    return max(1, max_bytes // max(1, row_bytes))
+
+
+def iter_row_blocks(matrix, block_size=None):
+    """Yield (start, stop, block) for consecutive blocks of rows of `matrix`, blocks being dense arrays of floating
+    point scores."""
+
+    n = matrix.shape[0]
+    if block_size is None:
+        block_size = get_block_size(matrix)
+
+    for start in range(0, n, block_size):
+        stop = min(n, start + block_size)
+        block = matrix[start:stop]
+        yield start, stop, dequantize(block.toarray() if issparse(block) else block)
+
+
+def iter_sparse_row_blocks(matrix, block_size=SPARSE_BLOCK_ROWS):
+    """Yield (start, stop, block) for consecutive blocks of rows of sparse `matrix`, blocks being sparse matrices
+    of floating point scores."""
+
+    matrix = matrix.tocsr()
+    n = matrix.shape[0]
+    for start in range(0, n, block_size):
+        stop = min(n, start + block_size)
+        yield start, stop, dequantize(matrix[start:stop])
+
+
+def count_above_threshold(matrix, threshold):
+    """Number of values greater or equal to `threshold` in each column of a symmetric `matrix`."""
+
+    counts = np.zeros(matrix.shape[1], dtype=np.int64)
+    for _, _, block in iter_row_blocks(matrix):
+        counts += (block >= threshold).sum(axis=0)
+    return counts
+
+
+def take_dense(matrix, mask):
+    """Dense sub-matrix made of rows and columns in `mask`, `matrix` being read by blocks of rows."""
+
+    m = np.count_nonzero(mask)
+    result = np.empty((m, m), dtype=np.result_type(matrix.dtype, np.float32))
+    pos = 0
+    for start, stop, block in iter_row_blocks(matrix):
+        block = block[mask[start:stop]][:, mask]
+        result[pos:pos+block.shape[0]] = block
+        pos += block.shape[0]
+    return result
+
+
+class TopKScores:
+    """Keep only the `k` best scores of each of `n` spectra while scores are computed.
+
+    Scores are pushed by chunks of pairs and merged with best scores already kept for the spectra involved, so
+    that memory use stays proportional to `n`x`k` whatever the number of pairs scored.
+    Best scores with spectra of higher index are also kept, as they are the only ones looked at by `generate_network`.
+    """
+
+    def __init__(self, n, k):
+        self.n = n
+        self.k = k
+        self.indices = np.full((n, k), -1, dtype=np.int64)
+        self.values = np.zeros((n, k), dtype=np.float32)
+        self.forward_indices = np.full((n, k), -1, dtype=np.int64)
+        self.forward_values = np.zeros((n, k), dtype=np.float32)
+
+    def push(self, rows, cols, values):
+        """Add scores of pairs (`rows`, `cols`), each pair being given only once."""
+
+        mask = (values > 0) & (rows != cols)
+        rows, cols, values = rows[mask], cols[mask], values[mask].astype(np.float32)
+        if rows.size == 0:
+            return
+
+        self._merge(self.indices, self.values, np.concatenate((rows, cols)), np.concatenate((cols, rows)),
+                    np.concatenate((values, values)))
+        self._merge(self.forward_indices, self.forward_values, np.minimum(rows, cols), np.maximum(rows, cols),
+                    values)
+
+    def _merge(self, indices, values, sources, targets, scores):
+        # Merge new scores with those already kept for the same spectra
+        touched = np.unique(sources)
+        kept = indices[touched] >= 0
+        sources = np.concatenate((np.repeat(touched, self.k)[kept.ravel()], sources))
+        targets = np.concatenate((indices[touched][kept], targets))
+        scores = np.concatenate((values[touched][kept], scores))
+
+        # Rank scores of each spectrum, best first, and keep `k` first ones
+        order = np.lexsort((-scores, sources))
+        sources, targets, scores = sources[order], targets[order], scores[order]
+        ranks = np.arange(sources.size) - np.searchsorted(sources, sources, side='left')
+        mask = ranks < self.k
+
+        indices[touched] = -1
+        values[touched] = 0
+        indices[sources[mask], ranks[mask]] = targets[mask]
+        values[sources[mask], ranks[mask]] = scores[mask]
+
+    def tocsr(self, dtype=np.float32):
+        """Symmetric sparse similarity matrix with ones on diagonal, scores being stored as `dtype`.
+
+        A score is kept if it is among the kept scores of at least one of both spectra, so that the `k` best
+        scores of each spectrum are found in its row."""
+
+        rows, cols, data = [np.arange(self.n)], [np.arange(self.n)], [np.ones(self.n, dtype=np.float32)]
+        for indices, values in ((self.indices, self.values), (self.forward_indices, self.forward_values)):
+            mask = indices >= 0
+            r, c, v = np.nonzero(mask)[0], indices[mask], values[mask]
+            rows.extend((r, c))
+            cols.extend((c, r))
+            data.extend((v, v))
+        rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data)
+
+        # Remove pairs kept several times
+        _, index = np.unique(rows * self.n + cols, return_index=True)
+        return coo_matrix((quantize(data[index], get_sparse_dtype(dtype)), (rows[index], cols[index])),
+                          shape=(self.n, self.n)).tocsr()
+
+
+class NeighborLists:
+    """Neighbours of each spectrum among spectra of higher index (upper triangle of a similarity matrix), sorted by
+    decreasing score and limited to the `max_k` best ones, stored as CSR arrays (`indptr`, `indices`, `scores`).
+
+    Edges tables of networks can then be generated for any threshold and any number of neighbours up to `max_k`
+    without reading the similarity matrix again, see `generate_network`.
+    """
+
+    def __init__(self, indptr, indices, scores, max_k):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.scores = np.asarray(scores, dtype=np.float32)
+        self.max_k = int(max_k)
+
+    @property
+    def n(self):
+        return self.indptr.shape[0] - 1
+
+    @classmethod
+    def from_matrix(cls, scores, max_k, callback=None):
+        """Find the `max_k` best neighbours of each spectrum in `scores`, read by blocks of rows. Neighbours with
+        equal scores are sorted by index. Only non-zero values are read from sparse matrices.
+
+        `callback` is called with the number of rows processed after each block, computation stops if it returns
+        False and None is returned."""
+
+        n = scores.shape[0]
+        k = min(max_k, n)
+        counts, indices, values = [np.zeros(1, dtype=np.int64)], [], []
+        blocks = iter_sparse_row_blocks(scores) if issparse(scores) else iter_row_blocks(scores)
+        for start, stop, block in blocks:
+            if issparse(block):
+                block = block.tocoo()
+                rows, cols, v = block.row.astype(np.int64), block.col.astype(np.int64), block.data
+            else:
+                # Only look at upper triangle, without diagonal
+                block = np.triu(block, start + 1)
+                if k > 0:
+                    # Only look at scores greater or equal to the k-th best one of each row, ties included
+                    kth = np.partition(block, n - k, axis=1)[:, n - k]
+                    rows, cols = np.nonzero((block >= kth[:, None]) & (block > 0))
+                else:
+                    rows = cols = np.empty(0, dtype=np.int64)
+                v = block[rows, cols]
+
+            mask = (cols > rows + start) & (v > 0)
+            rows, cols, v = rows[mask], cols[mask], v[mask]
+
+            # Sort neighbours of each spectrum by decreasing score then by index and keep the k first ones
+            order = np.lexsort((cols, -v, rows))
+            rows, cols, v = rows[order], cols[order], v[order]
+            row_counts = np.bincount(rows, minlength=stop - start)
+            ranks = np.arange(rows.shape[0]) - np.repeat(np.cumsum(row_counts) - row_counts, row_counts)
+            mask = ranks < k
+            indices.append(cols[mask])
+            values.append(v[mask].astype(np.float32))
+            counts.append(np.minimum(row_counts, k))
+
+            if callback is not None and not callback(stop - start):
+                return
+
+        return cls(np.cumsum(np.concatenate(counts)),
+                   np.concatenate(indices) if indices else np.empty(0, dtype=np.int64),
+                   np.concatenate(values) if values else np.empty(0, dtype=np.float32),
+                   max_k)
+
+    def generate_network(self, mzs, pairs_min_cosine, top_k):
+        """Create edges table: for each spectrum, at most `top_k` edges to spectra of higher index with a score
+        above `pairs_min_cosine` are kept, then edges are only kept if both spectra are in each other's `top_k`
+        most similar spectra."""
+
+        if top_k > self.max_k:
+            raise ValueError(f"Only the {self.max_k} best neighbours of each spectrum are known.")
+
+        mzs = np.asarray(mzs, dtype=np.float64)
+        counts = np.diff(self.indptr)
+        ranks = np.arange(self.indices.shape[0]) - np.repeat(self.indptr[:-1], counts)
+        # Neighbours are sorted by decreasing score so scores above threshold come first
+        mask = (ranks < top_k) & (self.scores > max(0, pairs_min_cosine))
+
+        interactions = np.empty(np.count_nonzero(mask), dtype=INTERACTIONS_DTYPE)
+        if interactions.size == 0:
+            return interactions
+        interactions['Source'] = np.repeat(np.arange(self.n), counts)[mask]
+        interactions['Target'] = self.indices[mask]
+        interactions['Delta MZ'] = mzs[interactions['Source']] - mzs[interactions['Target']]
+        interactions['Cosine'] = self.scores[mask]
+        # Sort edges by decreasing score, ties by source then target
+        interactions = interactions[np.lexsort((interactions['Target'], interactions['Source'],
+                                                -interactions['Cosine']))]
+
+        # Rank of each edge among edges of its source and among edges of its target, best scores first
+        m = interactions.size
+        nodes = np.concatenate((interactions['Source'], interactions['Target']))
+        positions = np.concatenate((np.arange(m), np.arange(m)))
+        order = np.lexsort((positions, nodes))
+        sorted_nodes = nodes[order]
+        ranks = np.empty(2 * m, dtype=np.int64)
+        ranks[order] = np.arange(2 * m) - np.searchsorted(sorted_nodes, sorted_nodes, side='left')
+
+        return interactions[(ranks[:m] < top_k) & (ranks[m:] < top_k)]
+
+
+def generate_network(scores, mzs, pairs_min_cosine, top_k, callback=None):
+    """Create edges table from a similarity matrix read by blocks of rows.
+
+    Gives the same edges as `libmetgem.network.generate_network`, which needs the whole matrix in memory:
+    for each spectrum, at most `top_k` edges to other spectra with a score above `pairs_min_cosine` are kept,
+    then edges are only kept if both spectra are in each other's `top_k` most similar spectra.
+    """
+
+    neighbors = NeighborLists.from_matrix(scores, max(top_k, 0), callback=callback)
+    if neighbors is None:
+        return np.empty(0, dtype=INTERACTIONS_DTYPE)
+    return neighbors.generate_network(mzs, pairs_min_cosine, top_k)
@@ -0,0 +1,278 @@
+"""Estimation of memory and time needed to process a dataset, used to choose options that fit in memory before
+starting computations.
+
+Estimates are rough: the number of pairs of spectra with a non null score, the number of peaks left after
+filtering and the speed of computations are only known once scores are computed, so typical values are used.
+"""
+
+import copy
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from metgem.utils.scoring import get_scorings
+
+try:
+    import psutil
+except ImportError:
+    HAS_PSUTIL = False
+else:
+    HAS_PSUTIL = True
+
+# Default fraction of physical memory that processing is allowed to use
+MEMORY_BUDGET_FRACTION = 0.5
+
+# Size of a peak in memory (m/z and intensity stored as 32-bit floats), in bytes
+PEAK_SIZE = 8
+
+# Size of spectra files per peak and per spectrum (headers), in bytes, used to estimate the number of peaks
+BYTES_PER_PEAK = 16
+BYTES_PER_SPECTRUM = 200
+
+# Average number of peaks of a spectrum, if it can't be estimated from the size of files
+DEFAULT_MEAN_PEAKS = 100
+
+# Typical m/z range of spectra, in Da, used to estimate the number of peaks kept by the window rank filter
+MZ_RANGE = 1000
+
+# Fraction of pairs of spectra with a non null score, used to estimate the size of sparse matrices keeping all
+# scores
+SPARSE_DENSITY = 0.05
+
+# Memory used by each process to score a tile when similarity matrix is built by tiles, in bytes
+TILE_MEMORY = 64 * 1024 ** 2
+
+# Time needed to score a pair of spectra, per peak, by implementation, in seconds
+SECONDS_PER_PEAK = {'libmetgem': 2e-8, 'numpy': 1e-7}
+
+# Memory used per pair of spectra kept by an embedding computed from a dense matrix (copy of the matrix converted
+# to distances and double precision working copies of the estimator), in bytes
+EMBEDDING_BYTES_PER_PAIR = 20
+
+# Memory used per neighbour of each spectrum by an embedding computed from a sparse matrix, in bytes
+EMBEDDING_BYTES_PER_NEIGHBOR = 48
+
+# Time needed by an embedding per pair of spectra, in seconds
+EMBEDDING_SECONDS_PER_PAIR = 5e-8
+
+# Typical number of neighbours of a spectrum in a sparse matrix used by an embedding
+EMBEDDING_NEIGHBORS = 50
+
+Stage = namedtuple('Stage', 'name memory disk time')
+Stage.__doc__ = """Estimated peak memory and disk usage (in bytes) and time (in seconds) of a processing stage.
+
+Memory includes data kept from previous stages."""
+
+
+def get_physical_memory():
+    """Total physical memory in bytes, or None if it can't be found."""
+
+    if HAS_PSUTIL:
+        return psutil.virtual_memory().total
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return
+
+
+def get_memory_budget(fraction=MEMORY_BUDGET_FRACTION):
+    """Memory that processing is allowed to use, in bytes, or None if physical memory is unknown."""
+
+    total = get_physical_memory()
+    if total is None:
+        return
+    return int(total * fraction)
+
+
+def estimate_mean_peaks(num_spectra, files_size, options=None):
+    """Estimate average number of peaks of spectra from the total size of uncompressed files, `files_size`, and
+    the number of peaks kept by the window rank filter of `options`."""
+
+    if num_spectra <= 0:
+        return 0
+
+    if files_size is None:
+        mean_peaks = DEFAULT_MEAN_PEAKS
+    else:
+        mean_peaks = max(1., (files_size / num_spectra - BYTES_PER_SPECTRUM) / BYTES_PER_PEAK)
+
+    if options is not None and options.get('use_filtering', False) \
+            and options.get('use_window_rank_filter', False) and options.get('matched_peaks_window', 0) > 0:
+        mean_peaks = min(mean_peaks, options.min_matched_peaks_search * MZ_RANGE / options.matched_peaks_window)
+
+    return mean_peaks
+
+
+def format_size(size):
+    """Human readable size in bytes."""
+
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def format_duration(seconds):
+    """Human readable duration."""
+
+    if seconds < 60:
+        return f"{max(1, math.ceil(seconds))} s"
+    elif seconds < 3600:
+        return f"{math.ceil(seconds / 60)} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+def get_num_pairs(n, options):
+    """Number of pairs of spectra scored. Upper bound if pairs are restricted by parent masses or retention
+    times."""
+
+    if options.get('use_candidates', False):
+        return min(n * (n - 1) // 2, n * options.get('n_candidates', 0))
+    return n * (n - 1) // 2
+
+
+def get_top_k(options):
+    if options.get('dense_output', True) or not options.get('use_top_k', False):
+        return 0
+    return options.get('top_k', 0)
+
+
+def is_tiled(options):
+    """Whether similarity matrix is built by tiles, see `ComputeScoresWorker.use_tiling`."""
+
+    return (options.get('dense_output', True) and options.get('out_of_core', False)) \
+        or options.get('use_multiprocessing', False) or get_top_k(options) > 0 \
+        or not isinstance(options.get('scoring', 'cosine'), str)
+
+
+def get_n_jobs(options):
+    if not options.get('use_multiprocessing', False):
+        return 1
+    return options.get('n_jobs', 0) if options.get('n_jobs', 0) > 0 else (os.cpu_count() or 1)
+
+
+def estimate_scores(n, options):
+    """Estimate size of similarity matrices (in memory and on disk) and peak memory used while they are built.
+
+    Returns (stored, disk, working) sizes in bytes."""
+
+    n_matrices = len(get_scorings(options.get('scoring', 'cosine')))
+    dtype = np.dtype(options.get('score_dtype', 'float32'))
+    n_pairs = get_num_pairs(n, options)
+    top_k = get_top_k(options)
+
+    if options.get('dense_output', True):
+        size = n * (n - 1) // 2 if options.get('condensed', False) else n * n
+        size *= dtype.itemsize * n_matrices
+        stored, disk = (0, size) if options.get('out_of_core', False) else (size, 0)
+        if is_tiled(options):
+            working = get_n_jobs(options) * TILE_MEMORY
+        else:
+            # A full matrix of 32-bit floats is computed before being condensed or converted
+            working = n * n * 4 if options.get('condensed', False) or dtype != np.float32 else 0
+        return stored, disk, working
+
+    itemsize = max(dtype.itemsize, 4) if dtype.kind == 'f' else dtype.itemsize
+    if top_k > 0:
+        nnz = min(2 * n_pairs, 2 * n * top_k) + n
+        # Best scores of each spectrum are kept with their columns while scores are computed
+        working = n * top_k * (itemsize + 8) * n_matrices
+    else:
+        nnz = int(2 * n_pairs * SPARSE_DENSITY) + n
+        # Scores are gathered as coordinates before being converted
+        working = nnz * (16 + itemsize) * n_matrices
+    stored = (nnz * (itemsize + 4) + (n + 1) * 8) * n_matrices
+    if is_tiled(options):
+        working += get_n_jobs(options) * TILE_MEMORY
+    return stored, 0, working
+
+
+def estimate_stages(n, mean_peaks, options, views=()):
+    """Estimate memory, disk usage and time of each processing stage of `n` spectra with `mean_peaks` peaks in
+    average, with score computation `options`.
+
+    `views` lists, for each view computed from scores by an embedding (e.g. t-SNE), whether it can use a sparse
+    matrix. Returns a list of `Stage`."""
+
+    spectra = n * mean_peaks * PEAK_SIZE
+    # Unfiltered spectra are kept to filter them again without reading files
+    stages = [Stage('Reading spectra', 2 * spectra, 0, 0)]
+
+    stored, disk, working = estimate_scores(n, options)
+    n_matrices = len(get_scorings(options.get('scoring', 'cosine')))
+    seconds = SECONDS_PER_PEAK.get(options.get('engine', 'libmetgem'), SECONDS_PER_PEAK['libmetgem'])
+    time = get_num_pairs(n, options) * mean_peaks * seconds / get_n_jobs(options)
+    if options.get('engine', 'libmetgem') != 'numpy':
+        time *= n_matrices
+    stages.append(Stage('Computing scores', 2 * spectra + stored + working, disk, time))
+
+    dense = options.get('dense_output', True)
+    for i in range(len(views)):
+        if not dense:
+            memory = n * EMBEDDING_NEIGHBORS * EMBEDDING_BYTES_PER_NEIGHBOR
+            time = n * EMBEDDING_NEIGHBORS * EMBEDDING_SECONDS_PER_PAIR
+        else:
+            memory = n * n * EMBEDDING_BYTES_PER_PAIR
+            time = n * n * EMBEDDING_SECONDS_PER_PAIR
+        stages.append(Stage(f'Computing view {i + 1}', 2 * spectra + stored + memory, disk, time))
+
+    return stages
+
+
+def get_peak_memory(stages):
+    return max((stage.memory for stage in stages), default=0)
+
+
+def get_reductions(options, views=()):
+    """Changes of score computation options reducing memory usage, from the least to the most disruptive one.
+
+    Yields (description, changes) tuples, changes adding up to the previous ones."""
+
+    if options.get('dense_output', True):
+        if options.get('score_dtype', 'float32') == 'float32':
+            # Reduced precision only helps if the full matrix of 32-bit floats is never computed
+            yield ("Scores stored as 16-bit floats and computed by tiles",
+                   {'score_dtype': 'float16', 'use_multiprocessing': True})
+        if all(views):
+            yield (f"Sparse matrix keeping the {options.top_k} best scores of each spectrum",
+                   {'dense_output': False, 'use_top_k': True, 'score_dtype': 'float32'})
+            return
+        if not options.get('condensed', False):
+            yield "Only upper half of similarity matrix stored", {'condensed': True, 'use_multiprocessing': True}
+        if options.get('score_dtype', 'float32') != 'uint8':
+            yield "Scores stored in steps of 1/255", {'score_dtype': 'uint8', 'use_multiprocessing': True}
+        if not options.get('out_of_core', False):
+            yield "Similarity matrix stored in a temporary file", {'out_of_core': True}
+    else:
+        if not options.get('use_top_k', False):
+            yield (f"Only the {options.top_k} best scores of each spectrum kept",
+                   {'use_top_k': True, 'use_multiprocessing': True})
+        if options.get('score_dtype', 'float32') != 'uint8':
+            yield "Scores stored in steps of 1/255", {'score_dtype': 'uint8'}
+
+
+def plan_options(n, mean_peaks, options, budget, views=()):
+    """Adjust score computation `options` so that estimated peak memory of processing stays below `budget`
+    bytes, see `estimate_stages` for `views`.
+
+    Options are changed step by step, see `get_reductions`, until estimated memory fits. Returns adjusted
+    options, their estimated stages and the list of descriptions of changes made."""
+
+    options = copy.copy(options)
+    stages = estimate_stages(n, mean_peaks, options, views)
+    changes = []
+    if budget is None:
+        return options, stages, changes
+
+    for description, values in get_reductions(options, views):
+        if get_peak_memory(stages) <= budget:
+            break
+        options.update(values)
+        stages = estimate_stages(n, mean_peaks, options, views)
+        changes.append(description)
+
+    return options, stages, changes
@@ -1,13 +1,91 @@
 import uuid
 
+import igraph as ig
+import numpy as np
 import pandas as pd
 from metgem.utils.qt import QObject, Signal
+from metgem.config import RADIUS
 
 
 def generate_id(type: str):
     return f"{type}_{uuid.uuid4()}"
 
 
+def get_edge_widths(weights):
+    """Widths of edges, scaled from their `weights` between 1 and `RADIUS`."""
+
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.size == 0:
+        return weights
+    min_ = max(0, weights.min() - 0.1)
+    if min_ == weights.max():
+        return np.full(weights.shape, RADIUS, dtype=np.float64)
+    return (RADIUS - 1) * (weights - min_) / (weights.max() - min_) + 1
+
+
+def build_graph(n, sources, targets, weights, vertex_attrs=None):
+    """Create a graph of `n` vertices in one call from arrays of `sources`, `targets` and `weights` of edges.
+
+    Edges get `__weight` and `__width` attributes, see `get_edge_widths`. Vertices are named by their index
+    unless `vertex_attrs` are given."""
+
+    # igraph converts lists of Python integers faster than NumPy arrays
+    edges = np.column_stack((np.asarray(sources, dtype=np.int64), np.asarray(targets, dtype=np.int64))).tolist()
+    weights = np.asarray(weights, dtype=np.float64)
+    if vertex_attrs is None:
+        vertex_attrs = {'name': list(range(n))}
+    return ig.Graph(n=n, edges=edges, vertex_attrs=vertex_attrs,
+                    edge_attrs={'__weight': weights.tolist(), '__width': get_edge_widths(weights).tolist()})
+
+
+def get_edge_arrays(graph, attribute='__width'):
+    """Indexes, sources, targets and `attribute` values of edges of `graph` that are not loops, as arrays."""
+
+    if graph.ecount() == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, np.empty(0, dtype=np.float64)
+
+    edges = np.array(graph.get_edgelist(), dtype=np.int64)
+    values = np.asarray(graph.es[attribute], dtype=np.float64)
+    index = np.flatnonzero(edges[:, 0] != edges[:, 1])
+    return index, edges[index, 0], edges[index, 1], values[index]
+
+
+def get_edges_to_cut(n, sources, targets, weights, max_size):
+    """Edges of a graph of `n` vertices that have to be removed, weakest first, so that no connected component
+    has more than `max_size` vertices.
+
+    Removing edges one by one by increasing weight (ties by position) until components are small enough removes
+    all edges up to the one that joins a component of more than `max_size` vertices when edges are added back by
+    decreasing weight. Components are tracked with a union-find, so edges only have to be sorted once.
+    Returns positions of edges to remove."""
+
+    order = np.argsort(np.asarray(weights, dtype=np.float64), kind='stable')
+    sources = np.asarray(sources, dtype=np.int64)[order].tolist()
+    targets = np.asarray(targets, dtype=np.int64)[order].tolist()
+    parent = list(range(n))
+    size = [1] * n
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i in range(len(order) - 1, -1, -1):
+        a, b = find(sources[i]), find(targets[i])
+        if a == b:
+            continue
+        if size[a] < size[b]:
+            a, b = b, a
+        parent[b] = a
+        size[a] += size[b]
+        if size[a] > max_size:
+            return order[:i + 1]
+
+    return order[:0]
+
+
 class Network(QObject):
     infosAboutToChange = Signal()
     infosChanged = Signal()
@@ -19,6 +97,43 @@ class Network(QObject):
         self.db_results = {}
         self.columns_mappings = {}
         self.lazyloaded = False
+        self.rts = None  # Retention times of spectra in seconds (NaN if unknown), None if not available
+
+        # Similarity matrices by scoring algorithm if several algorithms were used, `scores` being the one of
+        # `scoring` algorithm, which is used by views
+        self.all_scores = {}
+        self.scoring = None
+
+        # Best neighbours of each spectrum in `scores`, used to generate networks without reading scores again
+        self.neighbors = None
+
+        # Unfiltered spectra and a key identifying the data file they were read from, used to filter spectra again
+        # without reading data file if only filtering options are changed
+        self.raw_spectra = None
+        self.raw_spectra_source = None
+        self.raw_spectra_infos = None  # Metadata built while reading files (e.g. file each spectrum comes from)
+
+    def set_scores(self, scores, scoring):
+        """Set similarity matrix, `scores` being a dict of matrices by algorithm if several `scoring` algorithms
+        were used. Active algorithm is kept if possible."""
+
+        if isinstance(scores, dict):
+            self.all_scores = scores
+            if self.scoring not in scores:
+                self.scoring = next(iter(scores))
+            self.scores = scores[self.scoring]
+        else:
+            self.all_scores = {}
+            self.scoring = scoring if isinstance(scoring, str) else scoring[0]
+            self.scores = scores
+        self.neighbors = None
+
+    def use_scoring(self, scoring):
+        """Make similarity matrix of `scoring` algorithm the active one."""
+
+        self.scoring = scoring
+        self.scores = self.all_scores[scoring]
+        self.neighbors = None
 
     @property
     def infos(self):
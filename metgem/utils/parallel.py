@@ -0,0 +1,104 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# Shared arrays mapped by child processes, see `SharedArrays.attach`
+_attached = {}
+_attached_shms = []
+
+
+def cpu_count():
+    """Number of CPUs usable by the current process"""
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def imap_unordered(func, tasks, should_stop=None, max_workers=None, executor_class=ProcessPoolExecutor,
+                   poll_interval=0.1):
+    """Run `func(*args)` for each `args` of `tasks` in a pool of workers.
+
+    Yields tuples (index of task, result) as soon as each task is completed. If `should_stop` returns True,
+    pending tasks are canceled and the generator returns without waiting for running tasks.
+    """
+
+    executor = executor_class(max_workers=max_workers)
+    futures = {}
+    try:
+        futures = {executor.submit(func, *args): i for i, args in enumerate(tasks)}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield futures[future], future.result()
+
+            if should_stop is not None and should_stop():
+                return
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SharedArrays:
+    """Arrays copied to shared memory, so that processes of a pool can read and write them without pickling.
+
+    `specs` is a picklable description of arrays, to be given to `SharedArrays.attach` in child processes.
+    Shared memory is released by `close`.
+    """
+
+    def __init__(self, **arrays):
+        self._shms = []
+        self._arrays = {}
+        self.specs = {}
+        try:
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                shm = SharedMemory(create=True, size=max(1, array.nbytes))
+                self._shms.append(shm)
+                self._arrays[name] = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+                self._arrays[name][...] = array
+                self.specs[name] = (shm.name, array.shape, array.dtype.str)
+        except Exception:
+            self.close()
+            raise
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    @staticmethod
+    def attach(specs):
+        """Get arrays described by `specs` from a child process.
+
+        Shared memory is only mapped once per process and stays mapped until the process exits."""
+
+        key = tuple(sorted(specs.items()))
+        try:
+            return _attached[key]
+        except KeyError:
+            pass
+
+        arrays = {}
+        for name, (shm_name, shape, dtype) in specs.items():
+            shm = SharedMemory(name=shm_name)
+            _attached_shms.append(shm)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        _attached[key] = arrays
+        return arrays
+
+    def close(self):
+        self._arrays.clear()
+        for shm in self._shms:
+            try:
+                shm.close()
+            except BufferError:  # Some arrays are still referenced, memory will be released when they are deleted
+                pass
+            try:
+                shm.unlink()
+            except OSError:
+                pass
+        self._shms.clear()
@@ -1,15 +1,84 @@
+import bz2
+import gzip
+import hashlib
+import io
 import os
+import re
+import tempfile
+
+import numpy as np
+
+from metgem.config import CACHE_PATH, SCRATCH_PATH
+
+try:
+    import zstandard
+except ImportError:
+    HAS_ZSTANDARD = False
+else:
+    HAS_ZSTANDARD = True
+
+# Lines starting a new spectrum in each supported format
+SPECTRUM_START_PATTERNS = {'mgf': re.compile(rb'^BEGIN IONS', re.MULTILINE),
+                           'msp': re.compile(rb'^NAME:', re.MULTILINE | re.IGNORECASE)}
+
+# Folder and extension of files used to store offsets of spectra in data files
+INDEX_PATH = os.path.join(CACHE_PATH, 'indexes')
+INDEX_EXTENSION = '.idx'
+
+MGF_FLOAT_KEYS = ('pepmass', 'rtinseconds')
+MGF_INT_KEYS = ('charge', 'mslevel', 'feature_id', 'scans')
+MSP_FLOAT_KEYS = ('precursormz', 'exactmass', 'mw', 'retentiontime')
+MSP_INT_KEYS = ('charge', 'num peaks')
+
+# Compressed data files are decompressed on the fly, depending on their extension
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.zst': 'zstd'}
+
+
+def get_compression(filename):
+    """Get the compression of a data file from its extension, None if file is not compressed"""
+
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+
+def strip_compression_extension(filename):
+    """Remove compression extension from a filename, e.g. 'data.mgf.gz' -> 'data.mgf'"""
+
+    if get_compression(filename) is not None:
+        return os.path.splitext(filename)[0]
+    return filename
+
+
+def open_data_file(filename, mode='r', errors=None):
+    """Open a data file, decompressing it on the fly if needed. `mode` should be 'r' (text) or 'rb' (binary)."""
+
+    compression = get_compression(filename)
+    if compression is None:
+        return open(filename, mode, errors=errors) if mode != 'rb' else open(filename, mode)
+
+    if compression == 'gzip':
+        f = gzip.open(filename, 'rb')
+    elif compression == 'bz2':
+        f = bz2.open(filename, 'rb')
+    elif HAS_ZSTANDARD:
+        f = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True)
+    else:
+        raise NotImplementedError("Module 'zstandard' is needed to read zstd compressed files.")
+
+    if mode == 'rb':
+        return f
+    return io.TextIOWrapper(io.BufferedReader(f) if compression == 'zstd' else f,
+                            encoding='utf-8', errors=errors)
 
 
 def guess_file_format(filename):
     """Try to guess mgf or msp file format"""
 
-    ext = os.path.splitext(filename)[1].lower()
+    ext = os.path.splitext(strip_compression_extension(filename))[1].lower()
     if ext in ('.mgf', '.msp'):
         return ext[1:]
 
     try:
-        with open(filename, 'r') as f:
+        with open_data_file(filename, 'r') as f:
             head = next(f)
             if head.startswith('BEGIN IONS'):
                 return 'mgf'
@@ -17,3 +86,265 @@ def guess_file_format(filename):
                 return 'msp'
     except UnicodeDecodeError:
         return
+
+
+def _convert_value(key, value, float_keys, int_keys):
+    if key in float_keys:
+        try:
+            return float(value.split()[0])
+        except (ValueError, IndexError):
+            return 0.
+    elif key in int_keys:
+        try:
+            return int(value.strip().rstrip('+-'))
+        except ValueError:
+            return value
+    return value
+
+
+def _peaks_to_array(peaks):
+    if peaks:
+        return np.array(peaks, dtype=np.float32)
+    return np.empty((0, 2), dtype=np.float32)
+
+
+def parse_mgf(lines, ignore_unknown=False):
+    """Parse MGF formatted lines. Yields a dictionary of parameters and an array of peaks for each spectrum,
+    like `libmetgem.mgf.read` does."""
+
+    in_data = False
+    params = {}
+    peaks = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith('BEGIN IONS'):
+            in_data = True
+            params = {}
+            peaks = []
+        elif line.startswith('END IONS'):
+            if in_data:
+                yield params, _peaks_to_array(peaks)
+            in_data = False
+        elif in_data:
+            if line[0].isdigit():
+                values = line.split()
+                try:
+                    peaks.append((float(values[0]), float(values[1])))
+                except (ValueError, IndexError):
+                    pass
+            elif '=' in line:
+                key, value = line.split('=', 1)
+                key = key.lower()
+                if ignore_unknown and key not in MGF_FLOAT_KEYS and key not in MGF_INT_KEYS:
+                    continue
+                params[key] = _convert_value(key, value, MGF_FLOAT_KEYS, MGF_INT_KEYS)
+
+
+def parse_msp(lines, ignore_unknown=False):
+    """Parse MSP formatted lines. Yields a dictionary of parameters and an array of peaks for each spectrum,
+    like `libmetgem.msp.read` does."""
+
+    params = None
+    peaks = []
+    in_peaks = False
+    for line in lines:
+        line = line.strip()
+        if not line:
+            if params is not None and in_peaks:
+                yield params, _peaks_to_array(peaks)
+                params = None
+            continue
+
+        if line[:5].upper() == 'NAME:':
+            if params is not None:
+                yield params, _peaks_to_array(peaks)
+            params = {'name': line[5:].strip()}
+            peaks = []
+            in_peaks = False
+        elif params is None:
+            continue
+        elif in_peaks or line[0].isdigit():
+            in_peaks = True
+            for peak in line.split(';'):
+                values = peak.split()
+                try:
+                    peaks.append((float(values[0]), float(values[1])))
+                except (ValueError, IndexError):
+                    pass
+        elif ':' in line:
+            key, value = line.split(':', 1)
+            key = key.strip().lower()
+            if key == 'num peaks':
+                in_peaks = True
+            if ignore_unknown and key not in MSP_FLOAT_KEYS and key not in MSP_INT_KEYS:
+                continue
+            params[key] = _convert_value(key, value.strip(), MSP_FLOAT_KEYS, MSP_INT_KEYS)
+
+    if params is not None:
+        yield params, _peaks_to_array(peaks)
+
+
+PARSERS = {'mgf': parse_mgf, 'msp': parse_msp}
+
+
+def read_copy(src, read, size=None, suffix='', scratch_path=SCRATCH_PATH, chunk_size=2 ** 24, **kwargs):
+    """Parse the next `size` bytes (all remaining bytes if None) of binary file object `src` with `read`, a reader
+    which only accepts file names such as `libmetgem.mgf.read`. Additional keyword arguments are passed to `read`.
+
+    Bytes are copied to a temporary file in `scratch_path`, which is removed as soon as it has been parsed.
+    Returns a list of parsed spectra."""
+
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=scratch_path)
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            remaining = size
+            while remaining is None or remaining > 0:
+                chunk = src.read(chunk_size if remaining is None else min(remaining, chunk_size))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+
+        return list(read(path, **kwargs))
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def read_decompressed(filename, read, scratch_path=SCRATCH_PATH, **kwargs):
+    """Parse a compressed data file with `read`, a reader of uncompressed files, see `read_copy`.
+
+    File is decompressed to a temporary file so that compressed and uncompressed files are parsed the same way."""
+
+    with open_data_file(filename, 'rb') as src:
+        return read_copy(src, read, suffix=os.path.splitext(strip_compression_extension(filename))[1],
+                         scratch_path=scratch_path, **kwargs)
+
+
+def scan_file(filename, fmt, chunk_size=2 ** 24, callback=None):
+    """Find byte offsets of all spectra in a data file.
+
+    Returns an array of the offset of each spectrum, followed by the size of the file, so that spectrum `i`
+    is stored between bytes `offsets[i]` and `offsets[i+1]`. Offsets of compressed files are offsets in
+    decompressed data.
+    """
+
+    pattern = SPECTRUM_START_PATTERNS[fmt]
+    offsets = []
+    position = 0
+    tail = b''
+    with open_data_file(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+
+            # Only search in complete lines, keep the end of chunk for next iteration
+            block = tail + chunk
+            start = position - len(tail)
+            position += len(chunk)
+            end = block.rfind(b'\n') + 1
+            offsets.extend(start + m.start() for m in pattern.finditer(block, 0, end))
+            tail = block[end:]
+
+            if callback is not None and not callback(position):
+                return
+
+        if tail:
+            start = position - len(tail)
+            offsets.extend(start + m.start() for m in pattern.finditer(tail))
+
+    offsets.append(position)
+    return np.array(offsets, dtype=np.int64)
+
+
+def get_index_filename(filename, index_path=INDEX_PATH):
+    """Path of the file storing offsets of spectra of data file `filename`, named after its absolute path."""
+
+    key = hashlib.blake2b(os.path.realpath(filename).encode(), digest_size=20).hexdigest()
+    return os.path.join(index_path, key + INDEX_EXTENSION)
+
+
+def index_file(filename, fmt=None, callback=None, index_path=INDEX_PATH):
+    """Get byte offsets of all spectra in a data file, see `scan_file`.
+
+    Offsets are saved in `index_path` folder (None to not save them) and reused as long as size and modification
+    time of the data file are unchanged.
+    """
+
+    if fmt is None:
+        fmt = guess_file_format(filename)
+    if fmt not in SPECTRUM_START_PATTERNS or get_compression(filename) is not None:
+        raise NotImplementedError  # Random access is not possible in compressed files
+
+    stat = os.stat(filename)
+    index_filename = get_index_filename(filename, index_path) if index_path is not None else None
+    if index_filename is not None:
+        try:
+            with np.load(index_filename) as index:
+                if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime_ns:
+                    return index['offsets']
+        except (OSError, KeyError, ValueError):
+            pass
+
+    offsets = scan_file(filename, fmt, callback=callback)
+    if offsets is None:
+        return
+
+    if index_filename is not None:
+        try:
+            os.makedirs(index_path, exist_ok=True)
+            with open(index_filename, 'wb') as f:
+                np.savez(f, offsets=offsets, size=stat.st_size, mtime=stat.st_mtime_ns)
+        except OSError:  # Folder may be read-only, just skip saving index
+            pass
+
+    return offsets
+
+
+class IndexedSpectraFile:
+    """Random access to spectra of a MGF or MSP file, using byte offsets computed by `index_file`."""
+
+    def __init__(self, filename, fmt=None, offsets=None, ignore_unknown=True):
+        self.filename = filename
+        self.format = fmt if fmt is not None else guess_file_format(filename)
+        if self.format not in PARSERS:
+            raise NotImplementedError
+        self.offsets = offsets if offsets is not None else index_file(filename, self.format)
+        self.ignore_unknown = ignore_unknown
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('spectrum index out of range')
+
+        try:
+            return next(self.read_range(index, index + 1))
+        except StopIteration:
+            return {}, _peaks_to_array([])
+
+    def read_bytes(self, start, stop):
+        """Parse all spectra stored between bytes `start` and `stop`."""
+
+        with open(self.filename, 'rb') as f:
+            f.seek(start)
+            text = f.read(stop - start).decode('utf-8', errors='ignore')
+        yield from PARSERS[self.format](text.splitlines(), ignore_unknown=self.ignore_unknown)
+
+    def read_range(self, start, stop):
+        """Parse spectra from index `start` to index `stop` (excluded)."""
+
+        stop = min(stop, len(self))
+        if start >= stop:
+            return
+        yield from self.read_bytes(self.offsets[start], self.offsets[stop])
@@ -0,0 +1,337 @@
+"""Vectorized scoring of spectra with NumPy and SciPy sparse matrices.
+
+This is an alternative to `libmetgem.score.compute_similarity_matrix`, with the same signature. Peaks are binned
+by m/z and by neutral loss (difference between parent mass and m/z) and pairs of peaks that may match are found
+for a whole block of spectra at once with sparse matrix products. Pairs of spectra that do not have enough
+candidate peaks are discarded, exact matching is only done for remaining ones.
+Unlike `libmetgem`, only some pairs of spectra can also be scored, see `score_pairs`.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+
+from metgem.utils.spectra import PackedSpectra
+
+ENGINES = ('libmetgem', 'numpy')
+
+SCORINGS = ('cosine', 'entropy', 'weighted_entropy')
+
+# Number of rows of similarity matrix scored at once
+BLOCK_SIZE = 256
+
+# Peaks of all spectra, as needed to find matches: `owners` is the index of the spectrum of each peak
+# `weighted` are intensities reweighted for weighted entropy similarity, None if not needed
+Peaks = namedtuple('Peaks', ['offsets', 'owners', 'mzs', 'intensities', 'weighted', 'square_root', 'losses',
+                             'mz_bins', 'loss_bins', 'n_bins', 'mz_tolerance'])
+
+
+def get_scorings(scoring):
+    """List of scoring algorithms, `scoring` being the name of an algorithm or a list of names."""
+
+    scorings = [scoring] if isinstance(scoring, str) else list(scoring)
+    for name in scorings:
+        if name not in SCORINGS:
+            raise ValueError(f"Unknown scoring algorithm: {name}.")
+    return scorings
+
+
+def use_square_root(scoring):
+    """Whether spectra scored with `scoring` are normalized as square roots of intensities with a unit norm, which is
+    only the case for cosine score alone. Otherwise, intensities are normalized to a sum of one, from which
+    intensities used for cosine score are square roots."""
+
+    return get_scorings(scoring) == ['cosine']
+
+
+def convert_spectra(spectra, scoring):
+    """Convert `spectra` normalized to a sum of one to spectra normalized for `scoring` alone."""
+
+    spectra = PackedSpectra.from_list(spectra)
+    if not use_square_root(scoring):
+        return spectra
+
+    peaks = spectra.peaks.copy()
+    peaks[:, 1] = np.sqrt(peaks[:, 1])
+    return PackedSpectra(peaks, spectra.offsets)
+
+
+def weight_intensities(intensities, owners, n):
+    """Reweight intensities of spectra normalized to a sum of one, spectra with a low entropy getting more weight
+    for low intensity peaks, as done for weighted entropy similarity."""
+
+    terms = np.zeros_like(intensities)
+    positive = intensities > 0
+    terms[positive] = intensities[positive] * np.log(intensities[positive])
+    entropy = -np.bincount(owners, weights=terms, minlength=n)
+    weights = np.where(entropy < 3, 0.25 + 0.25 * entropy, 1)
+
+    intensities = intensities ** weights[owners]
+    sums = np.bincount(owners, weights=intensities, minlength=n)
+    sums = sums[owners]
+    return intensities / np.where(sums > 0, sums, 1)
+
+
+def get_bins(values, origin, width):
+    return np.floor((values - origin) / width).astype(np.int64)
+
+
+def find_close_peaks(bins1, values1, bins2, values2, tolerance, n_bins):
+    """Pairs of peaks (i, j) with |`values1`[i] - `values2`[j]| <= `tolerance`, bins having a width of `tolerance`.
+
+    Peaks in same or adjacent bins are found with a product of sparse incidence matrices, then filtered."""
+
+    rows = np.arange(bins1.shape[0])
+    incidence1 = csr_matrix((np.ones(bins1.shape[0], dtype=np.int32), (rows, bins1)),
+                            shape=(bins1.shape[0], n_bins))
+    neighbors = np.concatenate((bins2 - 1, bins2, bins2 + 1))
+    cols = np.tile(np.arange(bins2.shape[0]), 3)
+    valid = (neighbors >= 0) & (neighbors < n_bins)
+    incidence2 = csr_matrix((np.ones(np.count_nonzero(valid), dtype=np.int32), (cols[valid], neighbors[valid])),
+                            shape=(bins2.shape[0], n_bins))
+
+    pairs = coo_matrix(incidence1 @ incidence2.T)
+    i, j = pairs.row.astype(np.int64), pairs.col.astype(np.int64)
+    mask = np.abs(values1[i] - values2[j]) <= tolerance
+    return i[mask], j[mask]
+
+
+def match_peaks(keys1, keys2, values):
+    """Greedy one-to-one matching of peaks for pairs of spectra.
+
+    `keys1` and `keys2` identify each peak of a candidate match in its pair of spectra. Candidate matches are
+    considered by decreasing `values`, a match is kept if none of its peaks has already been matched. All matches
+    that are the best remaining ones for both their peaks are accepted at once, which gives the same result as
+    considering them one by one.
+    Returns a mask of accepted matches."""
+
+    accepted = np.zeros(keys1.shape[0], dtype=bool)
+    remaining = np.argsort(-values, kind='stable')
+    while remaining.size > 0:
+        first1 = np.unique(keys1[remaining], return_index=True)[1]
+        first2 = np.unique(keys2[remaining], return_index=True)[1]
+        best = np.zeros(remaining.size, dtype=bool)
+        best[np.intersect1d(first1, first2, assume_unique=True)] = True
+        accepted[remaining[best]] = True
+
+        used = (np.isin(keys1[remaining], keys1[remaining[best]])
+                | np.isin(keys2[remaining], keys2[remaining[best]]))
+        remaining = remaining[~used]
+    return accepted
+
+
+def find_matches(peaks1, peaks2, mzs, losses, mz_bins, loss_bins, n_bins, mz_tolerance):
+    """Candidate matches between peaks `peaks1` and `peaks2` (slices or arrays of indices of peaks), by m/z or by
+    neutral loss.
+
+    Returns global indices of both peaks of each candidate match, without duplicates."""
+
+    ids1, ids2 = np.arange(mzs.shape[0])[peaks1], np.arange(mzs.shape[0])[peaks2]
+    i1, j1 = find_close_peaks(mz_bins[peaks1], mzs[peaks1], mz_bins[peaks2], mzs[peaks2], mz_tolerance, n_bins[0])
+    i2, j2 = find_close_peaks(loss_bins[peaks1], losses[peaks1], loss_bins[peaks2], losses[peaks2], mz_tolerance,
+                              n_bins[1])
+    i = ids1[np.concatenate((i1, i2))]
+    j = ids2[np.concatenate((j1, j2))]
+    _, index = np.unique(i * mzs.shape[0] + j, return_index=True)
+    return i[index], j[index]
+
+
+def get_entropy_terms(a, b):
+    """Contribution of matched peaks of intensities `a` and `b` to entropy similarity, which only depends on matched
+    peaks of spectra normalized to a sum of one."""
+
+    return ((a + b) * np.log2(a + b) - a * np.log2(np.where(a > 0, a, 1))
+            - b * np.log2(np.where(b > 0, b, 1))) / 2
+
+
+def score_matches(i, j, peaks, n, min_matched_peaks, scorings):
+    """Score pairs of spectra with each algorithm of `scorings` from candidate matches (`i`, `j`) between their
+    peaks. Peaks are matched once for all algorithms.
+
+    Returns rows and columns of pairs with at least one non-zero score and a (len(`scorings`), n_pairs) array of
+    scores, rows being owners of peaks `i`."""
+
+    owners = peaks.owners
+
+    # Pre-score: discard pairs of spectra that can't have enough matched peaks
+    keys = owners[i] * n + owners[j]
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    mask = counts[inverse] >= max(1, min_matched_peaks)
+    i, j, keys = i[mask], j[mask], keys[mask]
+    if i.size == 0:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty((len(scorings), 0), dtype=np.float32))
+
+    # Peaks belong to a single spectrum, so a peak and the other spectrum identify a peak in a pair of spectra
+    # Square roots and normalization of intensities don't change order of matches
+    a, b = peaks.intensities[i], peaks.intensities[j]
+    accepted = match_peaks(i * n + owners[j], j * n + owners[i], a * b)
+    i, j, keys, a, b = i[accepted], j[accepted], keys[accepted], a[accepted], b[accepted]
+
+    unique_keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    scores = np.empty((len(scorings), unique_keys.shape[0]), dtype=np.float64)
+    for k, scoring in enumerate(scorings):
+        if scoring == 'cosine':
+            terms = a * b if peaks.square_root else np.sqrt(a * b)
+        elif scoring == 'weighted_entropy':
+            terms = get_entropy_terms(peaks.weighted[i], peaks.weighted[j])
+        else:
+            terms = get_entropy_terms(a, b)
+        scores[k] = np.bincount(inverse, weights=terms, minlength=unique_keys.shape[0])
+
+    mask = (counts >= min_matched_peaks) & np.any(scores > 0, axis=0)
+    unique_keys, scores = unique_keys[mask], np.minimum(scores[:, mask], 1)
+    return unique_keys // n, unique_keys % n, scores.astype(np.float32)
+
+
+def score_block(start, stop, peaks, min_matched_peaks, scorings):
+    """Score spectra of rows [`start`, `stop`) against all spectra after them, see `score_matches`."""
+
+    offsets = peaks.offsets
+    i, j = find_matches(slice(offsets[start], offsets[stop]), slice(offsets[start], offsets[-1]), peaks.mzs,
+                        peaks.losses, peaks.mz_bins, peaks.loss_bins, peaks.n_bins, peaks.mz_tolerance)
+    mask = peaks.owners[i] < peaks.owners[j]
+    return score_matches(i[mask], j[mask], peaks, offsets.shape[0] - 1, min_matched_peaks, scorings)
+
+
+def get_peak_indices(idx, offsets):
+    """Indices of all peaks of spectra `idx`."""
+
+    counts = offsets[idx + 1] - offsets[idx]
+    starts = np.repeat(offsets[idx] - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+    return starts + np.arange(starts.shape[0])
+
+
+def prepare_peaks(mzs, spectra, mz_tolerance, scoring):
+    """Pack peaks of all `spectra` with their neutral losses and the bins used to find matches. `spectra` are
+    normalized for `scoring`, see `use_square_root`."""
+
+    scorings = get_scorings(scoring)
+    spectra = PackedSpectra.from_list(spectra)
+    mzs = np.asarray(mzs, dtype=np.float64)
+    n = len(spectra)
+    owners = np.repeat(np.arange(n), spectra.counts())
+    peak_mzs = spectra.peaks[:, 0].astype(np.float64)
+    intensities = spectra.peaks[:, 1].astype(np.float64)
+    weighted = weight_intensities(intensities, owners, n) if 'weighted_entropy' in scorings else None
+    losses = mzs[owners] - peak_mzs
+
+    width = max(mz_tolerance, np.finfo(np.float32).eps)
+    bins, n_bins = [], []
+    for values in (peak_mzs, losses):
+        origin = values.min() - width if values.size > 0 else 0
+        bins.append(get_bins(values, origin, width))
+        n_bins.append(int(bins[-1].max()) + 2 if values.size > 0 else 1)
+
+    return Peaks(spectra.offsets, owners, peak_mzs, intensities, weighted, use_square_root(scoring), losses,
+                 bins[0], bins[1], n_bins, mz_tolerance)
+
+
+def compute_similarity_matrix(mzs, spectra, mz_tolerance, min_matched_peaks, scoring='cosine', dense_output=True,
+                              callback=None):
+    """Compute similarity matrix of `spectra`, filtered and normalized as for `libmetgem`.
+
+    Two peaks match if their m/z or their neutral losses differ by at most `mz_tolerance`. Scores of pairs with
+    less than `min_matched_peaks` matched peaks are set to 0.
+    If `scoring` is a list of algorithms, peaks are matched once and a list of similarity matrices is returned.
+    `callback` is called with the number of pairs scored since last call and computation stops if it returns
+    False. Returns None in that case.
+    """
+
+    scorings = get_scorings(scoring)
+    peaks = prepare_peaks(mzs, spectra, mz_tolerance, scoring)
+    n = peaks.offsets.shape[0] - 1
+
+    results = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty((len(scorings), 0), dtype=np.float32))]
+    for start in range(0, n, BLOCK_SIZE):
+        stop = min(n, start + BLOCK_SIZE)
+        results.append(score_block(start, stop, peaks, min_matched_peaks, scorings))
+
+        if callback is not None:
+            num_pairs = (stop - start) * (2 * n - start - stop - 1) // 2
+            if not callback(num_pairs):
+                return
+
+    rows, cols, values = (np.concatenate(x, axis=-1) for x in zip(*results))
+    if isinstance(scoring, str):
+        return to_matrix(n, rows, cols, values[0], dense_output=dense_output)
+    return [to_matrix(n, rows[v > 0], cols[v > 0], v[v > 0], dense_output=dense_output) for v in values]
+
+
+def to_matrix(n, rows, cols, data, dense_output=True):
+    """Symmetric similarity matrix with ones on diagonal from scores of upper triangle."""
+
+    rows = np.concatenate((rows, np.arange(n)))
+    cols = np.concatenate((cols, np.arange(n)))
+    data = np.concatenate((data, np.ones(n, dtype=np.float32)))
+    if dense_output:
+        matrix = np.zeros((n, n), dtype=np.float32)
+        matrix[rows, cols] = data
+        matrix[cols, rows] = data
+        return matrix
+    else:
+        mask = rows != cols
+        return coo_matrix((np.concatenate((data, data[mask])),
+                           (np.concatenate((rows, cols[mask])), np.concatenate((cols, rows[mask])))),
+                          shape=(n, n)).tocsr()
+
+
+def score_pairs(mzs, spectra, rows, cols, mz_tolerance, min_matched_peaks, scoring='cosine', callback=None):
+    """Only score pairs of spectra (`rows`[k], `cols`[k]), e.g. pairs of spectra likely to be similar.
+
+    Pairs are grouped by blocks of rows and peaks of spectra of each block are matched at once with peaks of all
+    spectra they are paired with, then only matches between requested pairs are kept.
+    `callback` is called with the number of pairs scored since last call and computation stops if it returns
+    False. Returns rows, columns and values of non-zero scores, with row < column, or None if stopped. If `scoring`
+    is a list, values are a (len(`scoring`), n_pairs) array of scores of each algorithm.
+    """
+
+    scorings = get_scorings(scoring)
+    peaks = prepare_peaks(mzs, spectra, mz_tolerance, scoring)
+    n = peaks.offsets.shape[0] - 1
+
+    # Keys are sorted by rows
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    keys = np.unique(np.minimum(rows, cols) * n + np.maximum(rows, cols))
+    keys = keys[keys // n != keys % n]
+    rows, cols = keys // n, keys % n
+    _, first = np.unique(rows, return_index=True)
+    bounds = np.append(first[::BLOCK_SIZE], rows.shape[0])
+
+    results = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty((len(scorings), 0), dtype=np.float32))]
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        i, j = find_matches(get_peak_indices(np.unique(rows[start:stop]), peaks.offsets),
+                            get_peak_indices(np.unique(cols[start:stop]), peaks.offsets), peaks.mzs,
+                            peaks.losses, peaks.mz_bins, peaks.loss_bins, peaks.n_bins, mz_tolerance)
+        mask = np.isin(peaks.owners[i] * n + peaks.owners[j], keys[start:stop])
+        results.append(score_matches(i[mask], j[mask], peaks, n, min_matched_peaks, scorings))
+
+        if callback is not None and not callback(int(stop - start)):
+            return
+
+    rows, cols, values = (np.concatenate(x, axis=-1) for x in zip(*results))
+    return rows, cols, values[0] if isinstance(scoring, str) else values
+
+
+def score_rows(mzs, spectra, idx, mz_tolerance, min_matched_peaks, scoring='cosine'):
+    """Score spectra `idx` against all other spectra with a single algorithm.
+
+    Returns rows, columns and values of non-zero scores, rows being in `idx`."""
+
+    peaks = prepare_peaks(mzs, spectra, mz_tolerance, scoring)
+    n = peaks.offsets.shape[0] - 1
+    all_peaks = slice(0, peaks.offsets[-1])
+
+    idx = np.asarray(idx, dtype=np.int64)
+    results = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty((1, 0), dtype=np.float32))]
+    for start in range(0, idx.shape[0], BLOCK_SIZE):
+        i, j = find_matches(get_peak_indices(idx[start:start+BLOCK_SIZE], peaks.offsets), all_peaks, peaks.mzs,
+                            peaks.losses, peaks.mz_bins, peaks.loss_bins, peaks.n_bins, mz_tolerance)
+        mask = peaks.owners[i] != peaks.owners[j]
+        results.append(score_matches(i[mask], j[mask], peaks, n, min_matched_peaks, [scoring]))
+
+    rows, cols, values = (np.concatenate(x, axis=-1) for x in zip(*results))
+    return rows, cols, values[0]
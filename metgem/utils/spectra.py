@@ -0,0 +1,128 @@
+from collections.abc import Sequence
+
+import numpy as np
+
+
+class PackedSpectra(Sequence):
+    """A read-only sequence of spectra stored in a single contiguous array.
+
+    All peaks are stored in one (n_peaks, 2) float32 array and spectrum `i` spans rows
+    `offsets[i]:offsets[i+1]`, like the `indptr` array of a CSR matrix. Indexing with an integer returns a
+    view on the packed array (no copy), indexing with a slice or an array of indices returns a new
+    `PackedSpectra` object.
+    """
+
+    dtype = np.float32
+
+    def __init__(self, peaks=None, offsets=None):
+        if peaks is None:
+            peaks = np.empty((0, 2), dtype=self.dtype)
+        if offsets is None:
+            offsets = np.zeros((1,), dtype=np.int64)
+
+        if offsets.ndim != 1 or offsets.size == 0:
+            raise ValueError("offsets should be a non-empty one dimensional array")
+        if offsets[-1] != peaks.shape[0]:
+            raise ValueError("Last offset does not match number of peaks")
+
+        self.peaks = peaks
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, spectra):
+        """Pack a list of (n, 2) arrays."""
+
+        if isinstance(spectra, PackedSpectra):
+            return spectra
+
+        offsets = np.zeros((len(spectra) + 1,), dtype=np.int64)
+        if len(spectra) > 0:
+            np.cumsum([s.shape[0] if s.size > 0 else 0 for s in spectra], out=offsets[1:])
+
+        peaks = np.empty((offsets[-1], 2), dtype=cls.dtype)
+        for i, data in enumerate(spectra):
+            if data.size > 0:
+                peaks[offsets[i]:offsets[i+1]] = data
+        return cls(peaks, offsets)
+
+    @classmethod
+    def concatenate(cls, spectra_list):
+        """Concatenate several `PackedSpectra` objects, keeping their order."""
+
+        spectra_list = [cls.from_list(s) for s in spectra_list]
+        if not spectra_list:
+            return cls()
+
+        peaks = np.concatenate([s.peaks for s in spectra_list])
+        offsets = [np.zeros((1,), dtype=np.int64)]
+        shift = 0
+        for s in spectra_list:
+            offsets.append(s.offsets[1:] + shift)
+            shift += s.offsets[-1]
+        return cls(peaks, np.concatenate(offsets))
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(np.arange(len(self))[index])
+        elif isinstance(index, (list, np.ndarray)):
+            return self.take(index)
+
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('spectrum index out of range')
+        return self.peaks[self.offsets[index]:self.offsets[index+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.peaks[self.offsets[i]:self.offsets[i+1]]
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(n_spectra={len(self)}, n_peaks={self.peaks.shape[0]})"
+
+    def take(self, indices):
+        """Return a new `PackedSpectra` object containing only spectra at the given indices."""
+
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        indices = indices.astype(np.int64, copy=False)
+        indices = np.where(indices < 0, indices + len(self), indices)
+
+        starts = self.offsets[indices]
+        counts = self.offsets[indices + 1] - starts
+        offsets = np.zeros((indices.shape[0] + 1,), dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        # Build rows indices of all selected peaks without a Python loop
+        rows = np.arange(offsets[-1], dtype=np.int64) + np.repeat(starts - offsets[:-1], counts)
+        return PackedSpectra(self.peaks[rows], offsets)
+
+    def tolist(self):
+        """Return a list of views on each spectrum."""
+
+        return list(self)
+
+    def counts(self):
+        """Number of peaks in each spectrum."""
+
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.peaks.nbytes + self.offsets.nbytes
+
+    def close(self):
+        pass
+
+
+def as_list(spectra):
+    """Convert a sequence of spectra to a list of arrays, as expected by libmetgem's functions."""
+
+    if isinstance(spectra, PackedSpectra):
+        return spectra.tolist()
+    return list(spectra)
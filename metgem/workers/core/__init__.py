@@ -1,11 +1,13 @@
 from metgem.workers.core.clusterize import ClusterizeWorker
 from metgem.workers.core.numberize import NumberizeWorker
-from metgem.workers.core.score import ComputeScoresWorker
+from metgem.workers.core.score import ComputeScoresWorker, AppendScoresWorker, NoRetentionTimesError
 from metgem.workers.core.import_modules import ImportModulesWorker
 from metgem.workers.core.max_connected_components import MaxConnectedComponentsWorker
 from metgem.workers.core.force_directed import ForceDirectedWorker
 from metgem.workers.core.force_directed_graph import ForceDirectedGraphWorker
 from metgem.workers.core.read_data import ReadDataWorker, NoSpectraError, FileEmptyError
+from metgem.workers.core.filter_spectra import FilterSpectraWorker
+from metgem.workers.core.index_data import IndexDataWorker
 from metgem.workers.core.read_group_mapping import ReadGroupMappingWorker
 from metgem.workers.core.read_metadata import ReadMetadataWorker
 from metgem.workers.core.generic import GenericWorker
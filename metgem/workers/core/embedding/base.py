@@ -6,6 +6,7 @@ from scipy.sparse import issparse
 
 from metgem.workers.base import BaseWorker, UserRequestedStopError
 from metgem.config import RADIUS
+from metgem.utils.matrix import count_above_threshold, dequantize, is_read_by_blocks, take_dense
 
 
 class BoundingBox:
@@ -25,7 +26,9 @@ class EmbeddingWorker(BaseWorker):
 
     def __init__(self, scores, options):
         super().__init__()
-        self._scores = scores
+        # Sparse matrices with reduced precision are converted back to floating point values, dense ones are
+        # converted by blocks of rows
+        self._scores = dequantize(scores) if issparse(scores) else scores
         self.options = options
         self.use_distance_matrix = True
         self._io_wrapper = None
@@ -43,7 +46,11 @@ class EmbeddingWorker(BaseWorker):
             sys.stdout = self._io_wrapper
 
         # Compute layout
-        mask = (self._scores >= self.options.min_score).sum(axis=0) > self.options.min_scores_above_threshold
+        if is_read_by_blocks(self._scores):
+            counts = count_above_threshold(self._scores, self.options.min_score)
+        else:
+            counts = (self._scores >= self.options.min_score).sum(axis=0)
+        mask = counts > self.options.min_scores_above_threshold
         if issparse(self._scores):
             mask = np.squeeze(np.asarray(mask))
 
@@ -53,8 +60,14 @@ class EmbeddingWorker(BaseWorker):
             layout = np.empty((self._scores.shape[0], 2))
 
             try:
-                matrix = self._scores[mask][:, mask]
-                if issparse(self._scores):
+                if is_read_by_blocks(self._scores):
+                    # Read matrix stored on disk, condensed or with reduced precision by blocks, as a dense matrix
+                    # of floating point scores
+                    matrix = take_dense(self._scores, mask)
+                else:
+                    matrix = self._scores[mask][:, mask]
+
+                if issparse(matrix):
                     n_neighbors = self.get_n_neighbors(matrix.shape[0])
 
                     # Compute graph from matrix (Restrict number of neighbors for each spectrum)
@@ -63,7 +76,9 @@ class EmbeddingWorker(BaseWorker):
                     layout[mask] = self._estimator.fit_transform(graph)
                     del graph
                 else:
-                    matrix = 1 - matrix if self.use_distance_matrix else matrix
+                    if self.use_distance_matrix:
+                        # Matrix is a copy, convert it to distances in place instead of allocating another one
+                        np.subtract(1, matrix, out=matrix)
                     layout[mask] = self._estimator.fit_transform(matrix)
                 del matrix
             except UserRequestedStopError:
@@ -88,7 +103,7 @@ class EmbeddingWorker(BaseWorker):
                         dy += 5 * RADIUS
         else:
             try:
-                matrix = self._scores
+                matrix = np.asarray(self._scores) if is_read_by_blocks(self._scores) else self._scores
                 matrix = 1 - matrix if self.use_distance_matrix else matrix
                 layout = self._estimator.fit_transform(matrix)
                 del matrix
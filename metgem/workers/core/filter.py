@@ -1,10 +1,11 @@
-from typing import List, Tuple
+from typing import List, Tuple, Sequence
 
 import numpy as np
 import pandas as pd
 from libmetgem import MZ
 
 from metgem.workers.base import BaseWorker
+from metgem.utils.spectra import PackedSpectra
 
 FRAGMENTS = 0
 NEUTRAL_LOSSES = 1
@@ -15,47 +16,52 @@ AT_LEAST_ONE_CONDITION = 1
 
 
 class FilterWorker(BaseWorker):
-    def __init__(self, mzs: pd.Series, spectra: List[np.ndarray],
+    def __init__(self, mzs: pd.Series, spectra: Sequence[np.ndarray],
                  values: List[Tuple[int, float, float]], condition_criterium: int = ALL_CONDITIONS):
         super().__init__()
         self.mzs = mzs
         self.spectra = spectra
         self.values = values
         self.condition_criterium = condition_criterium
-        self.max = len(self.spectra)
+        self.max = len(self.values)
         self.desc = 'Filtering nodes...'
 
     def run(self):
-        nodes = set()
-        num_criteria = len(self.values)
-        for i in range(len(self.spectra)):
-            mz_parent = self.mzs.iloc[i]
-            try:
-                spec = self.spectra[i]
-            except OSError as e:
-                self.error.emit(e)
+        try:
+            spectra = PackedSpectra.from_list(self.spectra)
+        except OSError as e:
+            self.error.emit(e)
+            return
+
+        # Criteria are evaluated on all the peaks at once, then reduced to one value per spectrum
+        num_spectra = len(spectra)
+        spectrum_index = np.repeat(np.arange(num_spectra), spectra.counts())
+        mzs_parent = np.asarray(self.mzs, dtype=np.float64)
+        fragments = spectra.peaks[:, MZ].astype(np.float64)
+
+        matched = np.zeros((num_spectra,), dtype=np.int64)
+        for i, (type_, value, tol, unit) in enumerate(self.values):
+            if self.isStopped():
+                self.canceled.emit()
                 return
-            criteria_matched = 0
-            for type_, value, tol, unit in self.values:
-                if type_ == MZ_PARENT:
-                    arr = mz_parent
-                elif type_ == NEUTRAL_LOSSES:
-                    arr = mz_parent-spec[:, MZ]
-                else:
-                    arr = spec[:, MZ]
-                kwargs = dict(atol=tol*1e-3, rtol=0.) if unit == "mDa" else dict(rtol=tol*1e-6, atol=0.)
-                if np.any(np.isclose(arr, value, **kwargs)):
-                    if self.condition_criterium == AT_LEAST_ONE_CONDITION:
-                        nodes.add(i)
-                        break
-                    else:
-                        criteria_matched += 1
-            if self.condition_criterium == ALL_CONDITIONS and criteria_matched == num_criteria:
-                nodes.add(i)
-
-            self.updated.emit(i)
+
+            kwargs = dict(atol=tol*1e-3, rtol=0.) if unit == "mDa" else dict(rtol=tol*1e-6, atol=0.)
+            if type_ == MZ_PARENT:
+                found = np.isclose(mzs_parent, value, **kwargs)
+            else:
+                arr = mzs_parent[spectrum_index] - fragments if type_ == NEUTRAL_LOSSES else fragments
+                found = np.bincount(spectrum_index[np.isclose(arr, value, **kwargs)],
+                                    minlength=num_spectra) > 0
+            matched += found
+
+            self.updated.emit(1)
+
+        if self.condition_criterium == AT_LEAST_ONE_CONDITION:
+            nodes = np.flatnonzero(matched > 0)
+        else:
+            nodes = np.flatnonzero(matched == len(self.values))
 
         if not self.isStopped():
-            return list(nodes)
+            return nodes.tolist()
         else:
             self.canceled.emit()
@@ -0,0 +1,42 @@
+from libmetgem.filter import filter_data_multi
+
+from metgem.workers.base import BaseWorker
+from metgem.workers.options import ScoreComputationOptions
+from metgem.workers.core.read_data import get_filter_params, NoSpectraError
+from metgem.utils.spectra import PackedSpectra, as_list
+
+
+class FilterSpectraWorker(BaseWorker):
+    """Filter spectra already read from a data file, without reading the file again.
+    """
+
+    def __init__(self, mzs, raw_spectra, options: ScoreComputationOptions):
+        super().__init__()
+        self._mzs = mzs
+        self._raw_spectra = raw_spectra
+        self.options = options
+        self.max = 0
+        self.iterative_update = True
+        self.desc = 'Filtering spectra...'
+
+    def run(self):
+        if self.isStopped():
+            self.canceled.emit()
+            return
+
+        params = get_filter_params(self.options)
+        spectra = filter_data_multi(self._mzs.values.tolist(), as_list(self._raw_spectra), params['min_intensity'],
+                                    params['parent_filter_tolerance'], params['matched_peaks_window'],
+                                    params['min_matched_peaks_search'], mz_min=params['mz_min'],
+                                    square_root=params['square_root'], norm=params['norm'])
+        spectra = PackedSpectra.from_list(spectra)
+
+        if not spectra:
+            self.error.emit(NoSpectraError())
+            return
+
+        if self.isStopped():
+            self.canceled.emit()
+            return
+
+        return self._mzs, spectra
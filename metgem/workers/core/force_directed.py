@@ -1,23 +1,119 @@
 import igraph as ig
 import numpy as np
+from scipy.sparse import csr_matrix
 try:
-    from fa2_modified import ForceAtlas2
+    from fa2_modified import ForceAtlas2, fa2util
 except ImportError:
-    from fa2 import ForceAtlas2
+    from fa2 import ForceAtlas2, fa2util
 
 from metgem.workers.base import BaseWorker
 from metgem.config import RADIUS
+from metgem.utils.parallel import cpu_count, imap_unordered, SharedArrays
+
+# Minimum number of vertices in components laid out by ForceAtlas2 to use a pool of processes, smaller graphs
+# are laid out faster than processes are started
+PARALLEL_MIN_VERTICES = 1000
+
+
+def get_iterations(vcount, options):
+    """Number of ForceAtlas2 iterations of a component of `vcount` vertices."""
+
+    iterations = int(options.get('iterations_per_node', 2.) * vcount)
+    max_iterations = options.get('max_iterations', 1000)
+    return min(max_iterations, max(options.get('min_iterations', max_iterations), iterations))
+
+
+def run_forceatlas2(forceatlas2, adjacency, iterations, chunk_size=50, tolerance=0., should_stop=None):
+    """Run at most `iterations` of `forceatlas2` on a graph given by its symmetric `adjacency` matrix.
+
+    Iterations are run by chunks of `chunk_size`. After each chunk, layout stops if nodes moved in average less
+    than `tolerance` times the spread of nodes per iteration, or if `should_stop` returns True, in which case None
+    is returned. Returns an array of coordinates."""
+
+    # Same loop as `ForceAtlas2.forceatlas2`, which can't be interrupted
+    nodes, edges = forceatlas2.init(adjacency)
+    speed, speed_efficiency = 1.0, 1.0
+    outbound_att_compensation = 1.0
+    if forceatlas2.outboundAttractionDistribution:
+        outbound_att_compensation = np.mean([n.mass for n in nodes])
+
+    pos = np.array([(n.x, n.y) for n in nodes], dtype=np.float64)
+    chunk_size = max(1, chunk_size)
+    for i in range(iterations):
+        for n in nodes:
+            n.old_dx = n.dx
+            n.old_dy = n.dy
+            n.dx = 0
+            n.dy = 0
+
+        if forceatlas2.barnesHutOptimize:
+            root_region = fa2util.Region(nodes)
+            root_region.buildSubRegions()
+            root_region.applyForceOnNodes(nodes, forceatlas2.barnesHutTheta, forceatlas2.scalingRatio)
+        else:
+            fa2util.apply_repulsion(nodes, forceatlas2.scalingRatio)
+        fa2util.apply_gravity(nodes, forceatlas2.gravity, scalingRatio=forceatlas2.scalingRatio,
+                              useStrongGravity=forceatlas2.strongGravityMode)
+        fa2util.apply_attraction(nodes, edges, forceatlas2.outboundAttractionDistribution,
+                                 outbound_att_compensation, forceatlas2.edgeWeightInfluence)
+        values = fa2util.adjustSpeedAndApplyForces(nodes, speed, speed_efficiency, forceatlas2.jitterTolerance)
+        speed = values['speed']
+        speed_efficiency = values['speedEfficiency']
+
+        if (i + 1) % chunk_size == 0 and i + 1 < iterations:
+            if should_stop is not None and should_stop():
+                return
+
+            if tolerance > 0:
+                new_pos = np.array([(n.x, n.y) for n in nodes], dtype=np.float64)
+                displacement = np.linalg.norm(new_pos - pos, axis=1).mean() / chunk_size
+                spread = np.sqrt(np.square(new_pos - new_pos.mean(axis=0)).sum(axis=1).mean())
+                if displacement <= tolerance * spread:
+                    return new_pos
+                pos = new_pos
+
+    return np.array([(n.x, n.y) for n in nodes], dtype=np.float64)
+
+
+def compute_component_layout(vcount, edges, weights, options, should_stop=None):
+    """Lay out a connected component of `vcount` vertices with ForceAtlas2, see `run_forceatlas2`. Returns an
+    array of coordinates, or None if `should_stop` returned True."""
+
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    weights = np.asarray(weights, dtype=np.float64)
+    rows, cols = np.concatenate((edges[:, 0], edges[:, 1])), np.concatenate((edges[:, 1], edges[:, 0]))
+    adjacency = csr_matrix((np.concatenate((weights, weights)), (rows, cols)), shape=(vcount, vcount))
+    forceatlas2 = ForceAtlas2(adjustSizes=False,
+                              scalingRatio=options.scale,
+                              gravity=options.gravity,
+                              verbose=False)
+    return run_forceatlas2(forceatlas2, adjacency, get_iterations(vcount, options),
+                           chunk_size=options.get('iterations_chunk', 50),
+                           tolerance=options.get('convergence_tolerance', 0.),
+                           should_stop=should_stop)
+
+
+def compute_shared_component_layout(specs, vcount, edges, weights, options):
+    """Run `compute_component_layout` in a child process, layout stops as soon as shared `stop` flag is set."""
+
+    stop = SharedArrays.attach(specs)['stop']
+    return compute_component_layout(vcount, edges, weights, options, should_stop=lambda: stop[0])
 
 
 class ForceDirectedWorker(BaseWorker):
 
     handle_sparse = True
     
-    def __init__(self, graph, radii, options: 'ForceDirectedVisualizationOptions'):
+    def __init__(self, graph, radii, options: 'ForceDirectedVisualizationOptions', layout=None, vertices=None):
+        """If both `layout` and `vertices` are given, only connected components including one of `vertices` are
+        laid out, other components keep their position from `layout`."""
+
         super().__init__()
         self.graph = graph
         self.radii = radii
         self.options = options
+        self.layout = layout
+        self.vertices = vertices
         self.max = self.graph.vcount()
         self.desc = 'Computing layout: {value:d} vertices of {max:d}.'
         self.iterative_update = False
@@ -25,23 +121,43 @@ class ForceDirectedWorker(BaseWorker):
     def run(self):
         layout = np.empty((self.max, 2))
 
-        forceatlas2 = ForceAtlas2(adjustSizes=False,
-                                  scalingRatio=self.options.scale,
-                                  gravity=self.options.gravity,
-                                  verbose=False)
-
         clusters = sorted(self.graph.clusters(), key=len, reverse=True)
-        dx, dy = 0, 0
+        x0, dx, dy = 0, 0, 0
         max_height = 0
         max_width = 0
         total_count = 0
-        for i, ids in enumerate(clusters):
+
+        if self.layout is not None and self.vertices is not None:
+            # Keep position of unchanged components and put other components below them
+            vertices = set(self.vertices)
+            kept = [ids for ids in clusters if vertices.isdisjoint(ids)]
+            clusters = [ids for ids in clusters if not vertices.isdisjoint(ids)]
+            if kept:
+                kept = np.concatenate(kept)
+                layout[kept] = self.layout[kept]
+                x0 = dx = layout[kept, 0].min()
+                dy = layout[kept, 1].max() + 5 * RADIUS
+                max_width = layout[kept, 0].max() - x0
+                total_count = kept.size
+                self.updated.emit(total_count)
+
+        # Lay out components of three vertices or more, largest first, then pack them once all are available
+        lyts = {}
+        for i, lyt in self.iter_layouts(clusters):
             if self.isStopped():
                 self.canceled.emit()
                 return False
-                
-            graph = self.graph.subgraph(ids)
-            vcount = graph.vcount()
+
+            lyts[i] = lyt
+            total_count += len(clusters[i])
+            self.updated.emit(total_count)
+
+        if self.isStopped():
+            self.canceled.emit()
+            return False
+
+        for i, ids in enumerate(clusters):
+            vcount = len(ids)
             radii = [self.radii[x] if self.radii[x] > 0 else RADIUS for x in ids]
 
             if vcount == 1:
@@ -51,8 +167,7 @@ class ForceDirectedWorker(BaseWorker):
                 lyt = ig.Layout([(0, -2*radii[0]), (0, 2*radii[1])])
                 border = 2 * max(radii)
             else:
-                lyt = forceatlas2.forceatlas2_igraph_layout(graph, pos=None, #sizes=radii,
-                                                            iterations=1000, weight_attr='__weight')
+                lyt = ig.Layout(lyts[i].tolist())
                 border = 5 * max(radii)
             
             bb = lyt.bounding_box(border=border)
@@ -66,12 +181,51 @@ class ForceDirectedWorker(BaseWorker):
         
             dx += bb.width
             max_height = max(max_height, bb.height)
-            if dx >= max_width:
-                dx = 0
+            if dx - x0 >= max_width:
+                dx = x0
                 dy += max_height
                 max_height = 0
 
-            total_count += vcount
-            self.updated.emit(total_count)
+            if vcount < 3:
+                total_count += vcount
+                self.updated.emit(total_count)
 
         return layout, np.where(np.asarray(self.graph.degree()) < 1)[0]
+
+    def iter_layouts(self, clusters):
+        """Lay out `clusters` of three vertices or more with ForceAtlas2, in a pool of processes if they are large
+        enough. Yields tuples (index of cluster, coordinates) as soon as each layout is computed."""
+
+        tasks = []
+        indices = []
+        for i, ids in enumerate(clusters):
+            if len(ids) < 3:
+                continue
+            graph = self.graph.subgraph(ids)
+            tasks.append((graph.vcount(), graph.get_edgelist(), graph.es['__weight'], self.options))
+            indices.append(i)
+
+        if len(tasks) > 1 and sum(task[0] for task in tasks) >= PARALLEL_MIN_VERTICES:
+            shared = SharedArrays(stop=np.zeros(1, dtype=bool))
+
+            def should_stop():
+                if self.isStopped():
+                    shared['stop'][0] = True
+                    return True
+                return False
+
+            try:
+                tasks = [(shared.specs, *task) for task in tasks]
+                for j, lyt in imap_unordered(compute_shared_component_layout, tasks, should_stop=should_stop,
+                                             max_workers=min(len(tasks), cpu_count())):
+                    if lyt is None:
+                        return
+                    yield indices[j], lyt
+            finally:
+                shared.close()
+        else:
+            for i, task in zip(indices, tasks):
+                lyt = compute_component_layout(*task, should_stop=self.isStopped)
+                if lyt is None:
+                    return
+                yield i, lyt
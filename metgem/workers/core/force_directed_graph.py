@@ -1,22 +1,32 @@
-import numpy as np
 import pandas as pd
-from libmetgem.network import generate_network
+from scipy.sparse import issparse
 
 from metgem.workers.base import BaseWorker
 from metgem.workers.options import ForceDirectedVisualizationOptions
-from metgem.config import RADIUS
+from metgem.utils.matrix import NeighborLists, dequantize
+from metgem.utils.network import build_graph
+
+# Minimum number of best neighbours of each spectrum kept when similarity matrix is read, so that networks can be
+# generated again with another threshold or number of neighbours without reading it again
+NEIGHBORS_MIN_K = 50
 
 
 class ForceDirectedGraphWorker(BaseWorker):
+    """Generate a network from a similarity matrix.
+
+    If given, `neighbors` are the `NeighborLists` of the similarity matrix, which is then only read if more
+    neighbours are needed. Neighbour lists used are available as `neighbors` attribute after run.
+    """
 
     def __init__(self, scores, mzs, graph, options: ForceDirectedVisualizationOptions,
-                 keep_vertices=False):
+                 keep_vertices=False, neighbors=None):
         super().__init__()
         self._scores = scores
         self._mzs = mzs
         self._graph = graph
         self.options = options
         self._keep_vertices = keep_vertices
+        self.neighbors = neighbors
         self.max = len(mzs)
         self.iterative_update = True
         self.desc = 'Generating Network...'
@@ -29,36 +39,27 @@ class ForceDirectedGraphWorker(BaseWorker):
                 self.updated.emit(min(value, self.max))
             return not self.isStopped()
 
-        # Create edges table (filter score below a threshold and apply TopK algorithm
-        interactions = generate_network(self._scores, self._mzs,
-                                        self.options.pairs_min_cosine,
-                                        self.options.top_k,
-                                        callback=callback)
-
-        # Recreate graph deleting all previously created edges and eventually nodes
-        graph = self._graph
-        graph.delete_edges(self._graph.es)
-        if not self._keep_vertices:
-            graph.delete_vertices(graph.vs)
-            nodes_idx = np.arange(self._scores.shape[0])
-            graph.add_vertices(nodes_idx.tolist())
+        # Find best neighbours of each spectrum if they are not known yet
+        # Matrices stored on disk or condensed are read by blocks instead of being loaded in memory
+        # Sparse matrices with reduced precision are converted back to floating point values
+        n = self._scores.shape[0]
+        top_k = self.options.top_k
+        if self.neighbors is None or self.neighbors.n != n or self.neighbors.max_k < top_k:
+            scores = dequantize(self._scores) if issparse(self._scores) else self._scores
+            self.neighbors = NeighborLists.from_matrix(scores, max(top_k, NEIGHBORS_MIN_K), callback=callback)
+            if self.neighbors is None:
+                self.canceled.emit()
+                return
 
-        # Add edges from edges table
-        graph.add_edges(zip(interactions['Source'], interactions['Target']))
-        graph.es['__weight'] = interactions['Cosine'].tolist()
+        # Create edges table (filter score below a threshold and apply TopK algorithm)
+        interactions = self.neighbors.generate_network(self._mzs, self.options.pairs_min_cosine, top_k)
 
-        # Set width for all edges based on their weight
-        widths = np.array(interactions['Cosine'])
-        if widths.size > 0:
-            # noinspection PyUnboundLocalVariable
-            min_ = max(0, widths.min() - 0.1)
-            if min_ != widths.max():
-                widths = (RADIUS - 1) * (widths - min_) / (widths.max() - min_) + 1
-            else:
-                widths = RADIUS
-        else:
-            widths = RADIUS
-        graph.es['__width'] = widths
+        # Create graph from edges table in one call, keeping attributes of vertices if requested
+        vertex_attrs = None
+        if self._keep_vertices and self._graph.vcount() == n:
+            vertex_attrs = {attr: self._graph.vs[attr] for attr in self._graph.vs.attributes()}
+        graph = build_graph(n, interactions['Source'], interactions['Target'], interactions['Cosine'],
+                            vertex_attrs=vertex_attrs)
 
         if not self.isStopped():
             return pd.DataFrame(interactions), graph
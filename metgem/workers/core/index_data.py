@@ -0,0 +1,43 @@
+import os
+
+from metgem.workers.base import BaseWorker
+from metgem.utils.read_data import index_file, get_compression, guess_file_format, scan_file
+
+
+class IndexDataWorker(BaseWorker):
+    """Find the position of each spectrum in a MGF or MSP file.
+    Result is cached in user folder so that it is only computed once.
+
+    Compressed files can't be indexed, positions of spectra in decompressed data are given instead. They can only
+    be used to count spectra and are not cached."""
+
+    def __init__(self, filename):
+        super().__init__(track_progress=False)
+        self.filename = filename
+        self.max = 0
+        self.iterative_update = False
+        self.desc = 'Indexing data file...'
+
+    def run(self):
+        def callback(value):
+            self.updated.emit(value)
+            return not self.isStopped()
+
+        try:
+            if get_compression(self.filename) is not None:
+                fmt = guess_file_format(self.filename)
+                if fmt is None:
+                    raise NotImplementedError
+                offsets = scan_file(self.filename, fmt, callback=callback)
+            else:
+                self.max = os.path.getsize(self.filename)
+                offsets = index_file(self.filename, callback=callback)
+        except (OSError, EOFError, NotImplementedError) as e:
+            self.error.emit(e)
+            return
+
+        if offsets is None or self.isStopped():
+            self.canceled.emit()
+            return
+
+        return offsets
@@ -1,6 +1,14 @@
+import numpy as np
+
+from metgem.utils.network import get_edges_to_cut
+from metgem.utils.parallel import cpu_count, imap_unordered
 from metgem.workers.base import BaseWorker
 from metgem.workers.options import ForceDirectedVisualizationOptions
 
+# Minimum number of edges in oversized clusters to split them in a pool of processes, smaller graphs are split
+# faster than processes are started
+PARALLEL_MIN_EDGES = 200000
+
 
 class MaxConnectedComponentsWorker(BaseWorker):
 
@@ -19,34 +27,48 @@ class MaxConnectedComponentsWorker(BaseWorker):
 
         # Max Connected Components option: split large clusters by removing edges with smaller weights until
         # cluster size is lower than the desired value
-        graph.es['__index'] = graph.es.indices
         max_connected_nodes = self.options.max_connected_nodes
-        if max_connected_nodes > 0:  # 0 means no limit
-            clusters = [c for c in graph.clusters() if len(c) > max_connected_nodes]
+        if max_connected_nodes > 0 and graph.ecount() > 0:  # 0 means no limit
+            membership = np.asarray(graph.clusters().membership, dtype=np.int64)
+            sizes = np.bincount(membership)
+            clusters = np.flatnonzero(sizes > max_connected_nodes)
             self.max = len(clusters)
 
-            edges_indices_to_remove = set()  # store indices in the full graph that we will need to remove
-            for ids in clusters:
+            edges = np.array(graph.get_edgelist(), dtype=np.int64)
+            weights = np.asarray(graph.es['__weight'], dtype=np.float64)
+            edges_membership = membership[edges[:, 0]]
+
+            # Number vertices of each cluster from 0
+            order = np.argsort(membership, kind='stable')
+            local = np.empty_like(membership)
+            local[order] = np.arange(membership.shape[0]) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+            tasks = []
+            indices = []
+            for c in clusters:
+                index = np.flatnonzero(edges_membership == c)
+                indices.append(index)
+                tasks.append((int(sizes[c]), local[edges[index, 0]], local[edges[index, 1]], weights[index],
+                              max_connected_nodes))
+
+            edges_indices_to_remove = []
+            if len(tasks) > 1 and sum(index.shape[0] for index in indices) >= PARALLEL_MIN_EDGES:
+                results = imap_unordered(get_edges_to_cut, tasks, should_stop=self.isStopped,
+                                         max_workers=min(len(tasks), cpu_count()))
+            else:
+                results = ((i, get_edges_to_cut(*args)) for i, args in enumerate(tasks))
+
+            for i, positions in results:
                 if self.isStopped():
                     self.canceled.emit()
                     return
+                edges_indices_to_remove.extend(indices[i][positions].tolist())
                 self.updated.emit(1)
 
-                vcount = len(ids)
-                # Clusters
-                if vcount <= max_connected_nodes:
-                    break
-
-                subgraph = graph.subgraph(ids)
-                while vcount > max_connected_nodes:
-                    e = min(subgraph.es, key=lambda x: x['__weight'])
-                    edges_indices_to_remove.add(e['__index'])
-                    subgraph.delete_edges(e.index)
-                    c = subgraph.clusters()
-                    if len(c) > 1:
-                        vcount = max(len(l) for l in c)
+            if self.isStopped():
+                self.canceled.emit()
+                return
             graph.delete_edges(edges_indices_to_remove)
-        del graph.es['__index']
 
         if not self.isStopped():
             return graph
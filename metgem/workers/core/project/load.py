@@ -3,6 +3,8 @@ import zipfile
 import pandas as pd
 from scipy.sparse import csr_matrix
 
+from metgem.utils.matrix import CondensedMatrix, NeighborLists
+
 from metgem.utils.qt import QColor, Qt
 from metgem.mappings import SizeMappingFunc, MODE_LINEAR
 from metgem.utils.network import Network, generate_id
@@ -13,11 +15,25 @@ from metgem.workers.options import (AttrDict, AVAILABLE_NETWORK_OPTIONS, AVAILAB
                                     ForceDirectedVisualizationOptions, TSNEVisualizationOptions)
 
 from metgem.workers.core.project.mnz import MnzFile
-from metgem.workers.core.project.spectra_list import SpectraList
+from metgem.workers.core.project.spectra_list import open_spectra
 from metgem.workers.core.project.graphml import GraphMLParser
 from metgem.workers.core.project.version import CURRENT_FORMAT_VERSION, UnsupportedVersionError
 
 
+def load_scores(fid, key):
+    """Load a similarity matrix stored as a dense array, as the upper triangle of a dense array or as a CSR sparse
+    matrix."""
+
+    try:
+        return fid[key]
+    except KeyError:
+        try:
+            return CondensedMatrix.from_data(fid[f'{key}_condensed'])
+        except KeyError:
+            return csr_matrix((fid[f'{key}_data'], fid[f'{key}_indices'], fid[f'{key}_indptr']),
+                              shape=fid[f'{key}_shape'])
+
+
 class LoadProjectWorker(BaseWorker):
     """Load project from a previously saved file"""
 
@@ -43,7 +59,7 @@ class LoadProjectWorker(BaseWorker):
                                                   + "This file format is not supported anymore.\n"
                                                   + "Please generate networks from raw data again")
 
-                elif version in (2, 3, 4, 5, 6, 7, CURRENT_FORMAT_VERSION):
+                elif version in (2, 3, 4, 5, 6, 7, 8, 9, CURRENT_FORMAT_VERSION):
                     # Create network object
                     network = Network()
                     network.lazyloaded = True
@@ -51,13 +67,27 @@ class LoadProjectWorker(BaseWorker):
                     # Load scores matrix
                     # Prior to version, scores must be a dense numpy array
                     # Starting from version 6, scores can be a CSR sparse matrix or a dense numpy array
+                    # Starting from version 10, scores can also be the upper triangle of a dense matrix
+                    network.scores = load_scores(fid, '0/scores')
+
+                    # Starting from version 10, similarity matrices of several scoring algorithms can be stored
                     try:
-                        network.scores = fid['0/scores']
+                        scorings = fid['0/scorings.json']
                     except KeyError:
-                        network.scores = csr_matrix((fid['0/scores_data'],
-                                                    fid['0/scores_indices'],
-                                                    fid['0/scores_indptr']),
-                                                    shape=fid['0/scores_shape'])
+                        pass
+                    else:
+                        network.scoring = scorings['active']
+                        network.all_scores = {name: network.scores if name == network.scoring
+                                              else load_scores(fid, f'0/scores/{name}')
+                                              for name in scorings['algorithms']}
+
+                    # Best neighbours of each spectrum may have been stored to generate networks faster
+                    try:
+                        network.neighbors = NeighborLists(fid['0/neighbors/indptr'], fid['0/neighbors/indices'],
+                                                          fid['0/neighbors/scores'],
+                                                          int(fid['0/neighbors/max_k']))
+                    except KeyError:
+                        pass
 
                     self.updated.emit(10)
                     if self.isStopped():
@@ -165,7 +195,9 @@ class LoadProjectWorker(BaseWorker):
                         return
 
                     # Load table of spectra
-                    network.spectra = SpectraList(self.filename)
+                    # Starting from version 9, spectra are stored in a single array which is memory-mapped
+                    # Prior to version 9, each spectrum is stored in its own compressed array and read on demand
+                    network.spectra = open_spectra(self.filename)
                     mzs = []
                     ids = []
                     for s in fid['0/spectra/index.json']:
@@ -177,6 +209,12 @@ class LoadProjectWorker(BaseWorker):
                         ids = pd.RangeIndex(start=1, stop=len(mzs)+1, step=1)
                     network.mzs = pd.Series(mzs, index=ids)
 
+                    # Retention times are only stored if they were available in data file
+                    try:
+                        network.rts = fid['0/spectra/rts']
+                    except KeyError:
+                        network.rts = None
+
                     # Make sure that `infos` dataframe's index match `mzs` series' index
                     # meaning each id from `mzs` has a corresponding row in `infos` dataframe
                     # and that `infos` dataframe has no additional rows
@@ -1,5 +1,7 @@
 import io
 import json
+import struct
+import time
 import zipfile
 
 import numpy as np
@@ -11,6 +13,14 @@ from numpy.lib import format
 from numpy.lib.npyio import NpzFile
 from scipy.sparse import csr_matrix
 
+from metgem.utils.matrix import CondensedMatrix
+from metgem.utils.spectra import PackedSpectra
+
+# Alignment of arrays stored uncompressed in archive
+ARRAY_ALIGN = 64
+# Header id used for extra fields used to pad local headers, same as Android's zipalign
+PADDING_HEADER_ID = 0xD935
+
 # Copy of numpy's _savez function to allow different file extension
 # https://github.com/numpy/numpy/blob/master/numpy/lib/npyio.py#L669
 # Copyright (c) 2005, NumPy Developers
@@ -40,6 +50,33 @@ class MnzFile(NpzFile):
         super().__init__(fid, own_fid, *args, **kwargs)
         self.parquet_files = [x[:-8] for x in self._files if x.endswith('.parquet')]
 
+    def memmap(self, key):
+        """Map an array stored uncompressed in archive without reading it."""
+
+        info = self.zip.getinfo(key + '.npy')
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError(f"'{key}' is compressed and can't be memory-mapped.")
+
+        # Skip the local file header which can be different from the one in central directory
+        self.fid.seek(info.header_offset)
+        header = self.fid.read(zipfile.sizeFileHeader)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        self.fid.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+
+        version = format.read_magic(self.fid)
+        if version == (1, 0):
+            shape, fortran_order, dtype = format.read_array_header_1_0(self.fid)
+        else:
+            shape, fortran_order, dtype = format.read_array_header_2_0(self.fid)
+
+        if 0 in shape:
+            return np.empty(shape, dtype=dtype)
+
+        # Use copy-on-write mode because some compiled functions does not accept read-only buffers.
+        # Modifications are never written back to the file.
+        return np.memmap(self.fid, dtype=dtype, mode='c', offset=self.fid.tell(), shape=shape,
+                         order='F' if fortran_order else 'C')
+
     def __getitem__(self, key):
         if key in self.parquet_files:
             with self.zip.open(key + '.parquet') as f:
@@ -107,6 +144,11 @@ def savez(file, version, *args, compress=True, **kwargs):
                     elif isinstance(val, csr_matrix):
                         for prop in ('indices', 'indptr', 'data', 'shape'):
                             save_array(zipf, f'{key}_{prop}', getattr(val, prop))
+                    elif isinstance(val, CondensedMatrix):
+                        save_array(zipf, f'{key}_condensed', val.data)
+                    elif isinstance(val, PackedSpectra):
+                        for prop in ('peaks', 'offsets'):
+                            save_aligned_array(zipf, f'{key}/{prop}', getattr(val, prop))
                     else:
                         save_array(zipf, key, val)
                 else:
@@ -118,4 +160,27 @@ def save_array(zipf, key, val):
     val = np.asanyarray(val)
     force_zip64 = val.nbytes >= 2 ** 30
     with zipf.open(fname, 'w', force_zip64=force_zip64) as fid:
-        format.write_array(fid, val, allow_pickle=False)
\ No newline at end of file
+        format.write_array(fid, val, allow_pickle=False)
+
+
+def save_aligned_array(zipf, key, val):
+    """Save an array uncompressed with its data aligned in archive so that it can be memory-mapped."""
+
+    fname = key + '.npy'
+    val = np.asanyarray(val)
+    force_zip64 = val.nbytes >= 2 ** 30
+
+    zinfo = zipfile.ZipInfo(fname, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_STORED
+
+    # Pad local header with an extra field to align beginning of data.
+    # npy header is itself padded to a multiple of 64 bytes so array's data will be aligned too.
+    header_size = zipfile.sizeFileHeader + len(fname.encode('utf-8')) + (20 if force_zip64 else 0)
+    padding = -(zipf.start_dir + header_size) % ARRAY_ALIGN
+    if 0 < padding < 4:
+        padding += ARRAY_ALIGN
+    if padding > 0:
+        zinfo.extra = struct.pack('<HH', PADDING_HEADER_ID, padding - 4) + b'\x00' * (padding - 4)
+
+    with zipf.open(zinfo, 'w', force_zip64=force_zip64) as fid:
+        format.write_array(fid, val, allow_pickle=False)
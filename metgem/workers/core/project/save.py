@@ -1,11 +1,11 @@
 import os
-import zipfile
 
 import numpy as np
 import pandas as pd
 import igraph as ig
 
 from metgem.utils.network import Network
+from metgem.utils.spectra import PackedSpectra
 from metgem.utils.qt import QColor, Qt
 
 from metgem.workers.base import BaseWorker
@@ -13,7 +13,7 @@ from metgem.workers.base import BaseWorker
 from metgem.workers.core.project.graphml import GraphMLWriter
 from metgem.workers.core.project.mnz import savez
 from metgem.workers.core.project.version import CURRENT_FORMAT_VERSION
-from metgem.workers.core.project.spectra_list import SpectraList
+from metgem.workers.core.project.spectra_list import open_spectra
 
 
 class SaveProjectWorker(BaseWorker):
@@ -44,6 +44,22 @@ class SaveProjectWorker(BaseWorker):
              '0/options.json': self.options,
              '0/layouts.json': list(self.layouts.keys())}
 
+        # If several scoring algorithms were used, other similarity matrices are stored aside of the active one
+        all_scores = getattr(self.network, 'all_scores', {})
+        if all_scores:
+            d['0/scorings.json'] = {'active': self.network.scoring, 'algorithms': list(all_scores.keys())}
+            for name, scores in all_scores.items():
+                if name != self.network.scoring:
+                    d[f'0/scores/{name}'] = scores
+
+        # Best neighbours of each spectrum, used to generate networks without reading scores again
+        neighbors = self.network.neighbors
+        if neighbors is not None:
+            d['0/neighbors/indptr'] = neighbors.indptr
+            d['0/neighbors/indices'] = neighbors.indices
+            d['0/neighbors/scores'] = neighbors.scores
+            d['0/neighbors/max_k'] = np.array(neighbors.max_k)
+
         for name, layout in self.layouts.items():
             key = f'0/layouts/{name}'
             for k, v in layout.items():
@@ -124,22 +140,22 @@ class SaveProjectWorker(BaseWorker):
 
             d['0/columns_mappings.json'] = columns_mappings
 
-        if self.network.lazyloaded and os.path.exists(self.original_fname):
-            self.network.spectra.close()
+        # Spectra are saved as a single uncompressed array so that they can be memory-mapped when loading project.
+        # If spectra were loaded from the original file, they are read from it while writing the new one.
+        mzs = getattr(self.network, 'mzs', pd.Series(dtype='float64'))
+        spectra = getattr(self.network, 'spectra', PackedSpectra())
+        d['0/spectra/index.json'] = [{'id': i, 'mz_parent': mz_parent} for i, mz_parent in mzs.items()]
+        rts = getattr(self.network, 'rts', None)
+        if rts is not None:
+            d['0/spectra/rts'] = rts
+        try:
+            d['0/spectra'] = PackedSpectra.from_list(spectra)
+        except OSError as e:
+            self.error.emit(e)
+            return
 
-            # create a temp copy of the archive without filename
-            with zipfile.ZipFile(self.original_fname, 'r') as zin:
-                with zipfile.ZipFile(self.tmp_filename, 'w') as zout:
-                    zout.comment = zin.comment  # preserve the comment
-                    for item in zin.infolist():
-                        if item.filename.startswith('0/spectra/'):
-                            zout.writestr(item, zin.read(item.filename))
-        else:
-            # Convert lists of parent mass and spectrum data to something that be can be saved
-            mzs = getattr(self.network, 'mzs', pd.Series(dtype='float64'))
-            spectra = getattr(self.network, 'spectra', pd.DataFrame())
-            d['0/spectra/index.json'] = [{'id': i, 'mz_parent': mz_parent} for i, mz_parent in mzs.items()]
-            d.update({'0/spectra/{}'.format(mzs.index[i]): data for i, data in enumerate(spectra)})
+        if os.path.exists(self.tmp_filename):
+            os.remove(self.tmp_filename)
 
         try:
             savez(self.tmp_filename, version=CURRENT_FORMAT_VERSION, **d)
@@ -150,14 +166,25 @@ class SaveProjectWorker(BaseWorker):
                 pass
             self.error.emit(e)
         else:
+            # Release original file before replacing it
+            if self.network.lazyloaded:
+                self.network.spectra.close()
+
+            try:
+                os.replace(self.tmp_filename, self.filename)
+            except OSError as e:
+                # Original file is left untouched, map spectra from it again
+                if self.network.lazyloaded:
+                    source = self.original_fname if self.original_fname is not None else self.filename
+                    try:
+                        self.network.spectra.load(source)
+                    except OSError:
+                        self.network.spectra.load(self.tmp_filename)
+                self.error.emit(e)
+                return
+
             try:
-                if os.path.exists(self.filename):
-                    os.remove(self.filename)
-                os.rename(self.tmp_filename, self.filename)
-                if isinstance(getattr(self.network, 'spectra', []), list):
-                    self.network.spectra = SpectraList(self.filename)
-                else:
-                    self.network.spectra.load(self.filename)
+                self.network.spectra = open_spectra(self.filename)
                 self.network.lazyloaded = True
             except OSError as e:
                 self.error.emit(e)
@@ -1,26 +1,42 @@
+import numpy as np
+
 from metgem.workers.core.project.mnz import MnzFile
+from metgem.utils.spectra import PackedSpectra
 
 
 class SpectraList(list):
+    """Spectra lazily read from a project file saved with format version 8 or lower,
+    where each spectrum is stored as an individual compressed array."""
 
     def __init__(self, filename):
         super().__init__()
         self.load(filename)
 
     def __getitem__(self, index):
+        if isinstance(index, (slice, list, np.ndarray)):
+            indices = np.arange(len(self))[index]
+            return PackedSpectra.from_list([self[i] for i in indices])
+
         data = super().__getitem__(index)
-        if isinstance(data, int):
+        if not isinstance(data, np.ndarray):
             data = self._file[f'0/spectra/{data}']
             super().__setitem__(index, data)
 
         return data
 
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
     def __del__(self):
         self.close()
 
     def close(self):
         self._file.close()
 
+    def tolist(self):
+        return list(self)
+
     # noinspection PyAttributeOutsideInit
     def load(self, filename):
         self._file = MnzFile(filename, 'r')
@@ -29,3 +45,28 @@ class SpectraList(list):
         for s in self._file['0/spectra/index.json']:
             self.append(s['id'])
 
+
+class MappedSpectra(PackedSpectra):
+    """Spectra memory-mapped from a project file saved with format version 9 or higher.
+    Peaks are read from disk by the operating system only when they are accessed."""
+
+    # noinspection PyMissingConstructor
+    def __init__(self, filename):
+        self.load(filename)
+
+    def close(self):
+        # Release the memory map, views on it that may still exist will keep it alive until they are deleted
+        super().__init__()
+
+    def load(self, filename):
+        with MnzFile(filename, 'r') as fid:
+            super().__init__(fid.memmap('0/spectra/peaks'), np.asarray(fid['0/spectra/offsets']))
+
+
+def open_spectra(filename):
+    """Open spectra from a project file, using a memory map if file format allows it."""
+
+    with MnzFile(filename, 'r') as fid:
+        mappable = '0/spectra/peaks' in fid.files
+
+    return MappedSpectra(filename) if mappable else SpectraList(filename)
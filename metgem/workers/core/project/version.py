@@ -1,4 +1,4 @@
-CURRENT_FORMAT_VERSION = 8
+CURRENT_FORMAT_VERSION = 10
 
 
 class UnsupportedVersionError(OSError):
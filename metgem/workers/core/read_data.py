@@ -1,11 +1,37 @@
+import os
+import shutil
+
+import numpy as np
 import pandas as pd
 from libmetgem.filter import filter_data_multi
 from libmetgem.mgf import read as read_mgf
 from libmetgem.msp import read as read_msp
 
+from metgem.config import SCRATCH_PATH
 from metgem.workers.base import BaseWorker
 from metgem.workers.options import ScoreComputationOptions
-from metgem.utils.read_data import guess_file_format
+from metgem.utils.cache import SpectraCache
+from metgem.utils.matrix import create_scratch_folder
+from metgem.utils.parallel import cpu_count, imap_unordered
+from metgem.utils.read_data import (guess_file_format, get_compression, index_file, read_copy, read_decompressed,
+                                    strip_compression_extension, IndexedSpectraFile)
+from metgem.utils.scoring import use_square_root
+from metgem.utils.spectra import PackedSpectra
+
+# Files bigger than this size (in bytes) are parsed and filtered in several processes
+PARALLEL_READ_MIN_SIZE = 2 ** 26
+
+# Number of byte ranges each process will have to handle, more ranges means smoother progress
+PARALLEL_READ_CHUNKS_PER_PROCESS = 4
+
+MZ_KEYS = {'mgf': ['pepmass'],
+           'msp': ['precursormz', 'exactmass', 'mw']}
+ID_KEYS = {'mgf': 'feature_id',
+           'msp': None}
+RT_KEYS = {'mgf': 'rtinseconds',
+           'msp': None}
+READERS = {'mgf': read_mgf,
+           'msp': read_msp}
 
 
 class NoSpectraError(Exception):
@@ -16,54 +42,263 @@ class FileEmptyError(Exception):
     pass
 
 
+def get_filter_params(options: ScoreComputationOptions):
+    """Build keyword arguments for `filter_data_multi` from options"""
+
+    use_filtering = options.use_filtering
+    use_min_mz_filter = options.use_min_mz_filter if use_filtering else False
+    use_min_intensity_filter = options.use_min_intensity_filter if use_filtering else False
+    use_parent_filter = options.use_parent_filter if use_filtering else False
+    use_window_rank_filter = options.use_window_rank_filter if use_filtering else False
+    square_root = use_square_root(options.scoring)
+
+    return dict(min_intensity=options.min_intensity if use_min_intensity_filter else 0,
+                parent_filter_tolerance=options.parent_filter_tolerance if use_parent_filter else 0,
+                matched_peaks_window=options.matched_peaks_window if use_window_rank_filter else 0,
+                min_matched_peaks_search=options.min_matched_peaks_search if use_window_rank_filter else 0,
+                mz_min=options.min_mz if use_min_mz_filter else 0,
+                square_root=square_root,
+                norm='dot' if square_root else 'sum')
+
+
+def filter_entries(entries, fmt, first_index, is_ms1_data, filter_params, keep_raw=False):
+    """Filter parsed spectra. `first_index` is the position in file of the first spectrum, used to build default ids.
+
+    Returns parent masses, ids, filtered spectra, unfiltered spectra if `keep_raw` is True (None otherwise) and
+    retention times (NaN if not available)."""
+
+    mz_keys = MZ_KEYS[fmt]
+    id_key = ID_KEYS[fmt]
+    rt_key = RT_KEYS[fmt]
+
+    mzs = []
+    spectra = []
+    ids = []
+    rts = []
+    for i, (params, data) in enumerate(entries, first_index):
+        ids.append(params.get(id_key, i+1) if id_key is not None else i+1)
+        rts.append(params.get(rt_key, np.nan) if rt_key is not None else np.nan)
+        mz_parent = 0
+        if not is_ms1_data:
+            for key in mz_keys:
+                mz_parent = params.get(key, mz_parent)
+        mzs.append(mz_parent)
+        spectra.append(data)
+
+    raw_spectra = PackedSpectra.from_list(spectra) if keep_raw else None
+    if spectra:
+        spectra = filter_data_multi(mzs, spectra, filter_params['min_intensity'],
+                                    filter_params['parent_filter_tolerance'],
+                                    filter_params['matched_peaks_window'],
+                                    filter_params['min_matched_peaks_search'],
+                                    mz_min=filter_params['mz_min'], square_root=filter_params['square_root'],
+                                    norm=filter_params['norm'])
+
+    return mzs, ids, PackedSpectra.from_list(spectra), raw_spectra, np.asarray(rts, dtype=np.float64)
+
+
+def read_range(filename, fmt, start, stop, scratch_path=SCRATCH_PATH):
+    """Parse spectra stored between bytes `start` and `stop` of a file.
+
+    libmetgem readers can only read whole files, so this range of bytes is copied to a temporary file in
+    `scratch_path` and parsed by the same reader as whole files, see `read_copy`."""
+
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        return read_copy(f, READERS[fmt], size=stop - start, suffix='.' + fmt, scratch_path=scratch_path,
+                         ignore_unknown=True)
+
+
+def read_and_filter_range(filename, fmt, start, stop, first_index, is_ms1_data, filter_params, keep_raw=False,
+                          scratch_path=SCRATCH_PATH):
+    """Parse and filter spectra stored between bytes `start` and `stop` of a file, see `filter_entries`."""
+
+    return filter_entries(read_range(filename, fmt, start, stop, scratch_path), fmt, first_index, is_ms1_data,
+                          filter_params, keep_raw)
+
+
+def read_file(filename, fmt, scratch_path=SCRATCH_PATH):
+    """Parse all spectra of a file. Compressed files are decompressed to a temporary file in `scratch_path` so that
+    they are parsed by the same reader as uncompressed files, see `read_decompressed`."""
+
+    if get_compression(filename) is not None:
+        return read_decompressed(filename, READERS[fmt], scratch_path=scratch_path, ignore_unknown=True)
+    return READERS[fmt](filename, ignore_unknown=True)
+
+
+def read_and_filter_file(filename, fmt, is_ms1_data, filter_params, keep_raw=False, scratch_path=SCRATCH_PATH):
+    """Parse and filter all spectra of a file, see `filter_entries`."""
+
+    return filter_entries(read_file(filename, fmt, scratch_path), fmt, 0, is_ms1_data, filter_params, keep_raw)
+
+
+def get_file_label(filename):
+    """Name of a data file without directory and extensions, e.g. '/data/batch1.mgf.gz' -> 'batch1'"""
+
+    return os.path.splitext(os.path.basename(strip_compression_extension(filename)))[0]
+
+
+def make_unique(values):
+    """Append a suffix to repeated values so that all values are unique, e.g. [a, b, a] -> [a, b, a-2]"""
+
+    values = pd.Series([str(v) for v in values])
+    count = values.groupby(values).cumcount()
+    duplicated = count > 0
+    while duplicated.any():
+        values[duplicated] = values[duplicated] + '-' + (count[duplicated] + 1).astype(str)
+        count = values.groupby(values).cumcount()
+        duplicated = count > 0
+    return values.tolist()
+
+
+def match_metadata(metadata, infos):
+    """Find rows of a `metadata` table matching spectra, `infos` being the metadata of spectra indexed by their ids.
+
+    Spectra merged from several files by `ReadDataWorker` have ids prefixed by the name of their file, so rows are
+    matched by the id of each spectrum in its data file (`ReadDataWorker.ID_COLUMN` column of `infos`, or id of
+    spectrum if missing), and also by the name of this file if `metadata` has a `ReadDataWorker.SOURCE_COLUMN`
+    column. Ids are compared as strings and only the first row of repeated ids is used.
+
+    Returns matching rows indexed by ids of spectra."""
+
+    id_column, source_column = ReadDataWorker.ID_COLUMN, ReadDataWorker.SOURCE_COLUMN
+    index = infos.index.to_series()
+    keys = pd.DataFrame(index=infos.index)
+    if id_column in infos.columns:
+        keys[id_column] = infos[id_column].where(infos[id_column].notna(), index).astype(str)
+    else:
+        keys[id_column] = index.astype(str)
+    rows = metadata.copy()
+    rows[id_column] = metadata.index.astype(str)
+
+    on = [id_column]
+    if source_column in metadata.columns and source_column in infos.columns:
+        keys[source_column] = infos[source_column].astype(str)
+        rows[source_column] = rows[source_column].astype(str)
+        on.append(source_column)
+
+    rows = rows.drop_duplicates(on).set_index(on)
+    return keys.join(rows, on=on, how='inner').drop(columns=on)
+
+
 class ReadDataWorker(BaseWorker):
+    """Read and filter spectra from one or several data files.
+
+    If several files are given, they are read concurrently and merged. Ids of spectra are then prefixed with the name
+    of the file they come from. The name of this file and the id of spectra in it are available in `infos`
+    attribute, see `match_metadata`."""
 
-    def __init__(self, filename, options: ScoreComputationOptions):
+    # Name of the column storing file each spectrum has been read from
+    SOURCE_COLUMN = 'source file'
+    # Name of the column storing id of each spectrum in the file it has been read from
+    ID_COLUMN = 'original id'
+
+    def __init__(self, filename, options: ScoreComputationOptions, indices=None, cache: SpectraCache = None,
+                 keep_raw=False):
         super().__init__()
-        self.filename = filename
+        self.filenames = list(filename) if isinstance(filename, (list, tuple)) else [filename]
+        self.filename = self.filenames[0]
         self.options = options
-        self.max = 0
+        self.indices = indices  # If not None, read only spectra at these positions in file
+        self.cache = cache if indices is None else None
+        self.keep_raw = keep_raw  # If True, unfiltered spectra will be available in `raw_spectra` attribute
+        self.raw_spectra = None
+        self.rts = None  # Retention times in seconds (NaN if not available), None if no spectrum has one
+        self.infos = None
+        self.max = len(indices) if indices is not None else 0
         self.iterative_update = True
         self.desc = 'Reading data file...'
 
+    def use_parallel_read(self, fmt):
+        if (self.indices is not None or fmt not in MZ_KEYS or get_compression(self.filename) is not None
+                or cpu_count() < 2):
+            return False
+
+        try:
+            return os.path.getsize(self.filename) >= PARALLEL_READ_MIN_SIZE
+        except OSError:
+            return False
+
+    def get_cache_key(self, filename, fmt, filter_params):
+        if self.cache is None:
+            return
+
+        try:
+            return self.cache.key(filename, {'format': fmt, 'is_ms1_data': self.options.is_ms1_data,
+                                             **filter_params})
+        except OSError:
+            return
+
+    def set_rts(self, rts):
+        """Store retention times, if at least one spectrum has one"""
+
+        rts = np.asarray(rts, dtype=np.float64)
+        self.rts = rts if np.any(~np.isnan(rts)) else None
+
     def run(self):
+        filter_params = get_filter_params(self.options)
+        if len(self.filenames) > 1:
+            return self.read_multiple(filter_params)
+
+        fmt = guess_file_format(self.filename)
+        cache_key = self.get_cache_key(self.filename, fmt, filter_params)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                mzs, ids, spectra, rts = cached
+                if rts is not None:
+                    self.set_rts(rts)
+                return pd.Series(mzs, index=ids), spectra
+
+        if self.use_parallel_read(fmt):
+            result = self.read_parallel(fmt, filter_params)
+        else:
+            result = self.read(fmt, filter_params)
+
+        if result is not None and cache_key is not None:
+            mzs, spectra = result
+            self.cache.put(cache_key, mzs.values, mzs.index.values, spectra, rts=self.rts)
+
+        return result
+
+    def read(self, fmt, filter_params):
         mzs = []
         spectra = []
         ids = []
+        rts = []
 
-        use_filtering = self.options.use_filtering
-        use_min_mz_filter = self.options.use_min_mz_filter if use_filtering else False
-        use_min_intensity_filter = self.options.use_min_intensity_filter if use_filtering else False
-        use_parent_filter = self.options.use_parent_filter if use_filtering else False
-        use_window_rank_filter = self.options.use_window_rank_filter if use_filtering else False
-        min_mz = self.options.min_mz if use_min_mz_filter else 0
-        min_intensity = self.options.min_intensity if use_min_intensity_filter else 0
-        parent_filter_tolerance = self.options.parent_filter_tolerance if use_parent_filter else 0
-        matched_peaks_window = self.options.matched_peaks_window if use_window_rank_filter else 0
-        min_matched_peaks_search = self.options.min_matched_peaks_search if use_window_rank_filter else 0
         is_ms1_data = self.options.is_ms1_data
-        scoring = self.options.scoring
-        square_root = scoring == 'cosine'
-        norm = 'dot' if scoring == 'cosine' else 'sum'
 
-        fmt = guess_file_format(self.filename)
-        if fmt == 'mgf':
-            read = read_mgf
-            mz_keys = ['pepmass']
-            id_key = 'feature_id'
-        elif fmt == 'msp':
-            read = read_msp
-            mz_keys = ['precursormz', 'exactmass', 'mw']
-            id_key = None
-        else:
+        if fmt not in READERS:
             self.error.emit(NotImplementedError())
             return
+        mz_keys = MZ_KEYS[fmt]
+        id_key = ID_KEYS[fmt]
+        rt_key = RT_KEYS[fmt]
 
-        for i, (params, data) in enumerate(read(self.filename, ignore_unknown=True)):
+        if self.indices is not None:
+            # Seek directly to requested spectra using an index of the file
+            try:
+                reader = IndexedSpectraFile(self.filename, fmt)
+                entries = ((i, reader[i]) for i in self.indices)
+            except (OSError, NotImplementedError) as e:
+                self.error.emit(e)
+                return
+        else:
+            try:
+                entries = enumerate(read_file(self.filename, fmt, SCRATCH_PATH))
+            except (OSError, NotImplementedError) as e:
+                self.error.emit(e)
+                return
+
+        for i, (params, data) in entries:
             if self.isStopped():
                 self.canceled.emit()
                 return
 
+            if self.indices is not None:
+                self.updated.emit(1)
+
             id_ = params.get(id_key, i+1) if id_key is not None else i+1
             if not is_ms1_data:
                 mz_parent = 0
@@ -85,21 +320,171 @@ class ReadDataWorker(BaseWorker):
 
             spectra.append(data)
             ids.append(id_)
+            rts.append(params.get(rt_key, np.nan) if rt_key is not None else np.nan)
 
         if not spectra:
             self.error.emit(FileEmptyError())
             return
 
+        if self.keep_raw:
+            self.raw_spectra = PackedSpectra.from_list(spectra)
+
         # Even if use_filtering is False, filtering should be done with neutral parameters
         # because last step of filtering is to normalize spectra
-        spectra = filter_data_multi(mzs, spectra, min_intensity, parent_filter_tolerance,
-                                    matched_peaks_window, min_matched_peaks_search,
-                                    mz_min=min_mz, square_root=square_root, norm=norm)
+        spectra = filter_data_multi(mzs, spectra, filter_params['min_intensity'],
+                                    filter_params['parent_filter_tolerance'],
+                                    filter_params['matched_peaks_window'],
+                                    filter_params['min_matched_peaks_search'],
+                                    mz_min=filter_params['mz_min'], square_root=filter_params['square_root'],
+                                    norm=filter_params['norm'])
+        spectra = PackedSpectra.from_list(spectra)
 
         if not spectra:
             self.error.emit(NoSpectraError())
             return
 
+        self.set_rts(rts)
         mzs = pd.Series(mzs, index=ids)
 
         return mzs, spectra
+
+    def read_parallel(self, fmt, filter_params):
+        """Split file in byte ranges on spectrum boundaries, then parse and filter each range
+        in a pool of processes. Results are merged in their original order."""
+
+        try:
+            offsets = index_file(self.filename, fmt, callback=lambda _: not self.isStopped())
+        except OSError as e:
+            self.error.emit(e)
+            return
+
+        if offsets is None:
+            self.canceled.emit()
+            return
+
+        num_spectra = offsets.shape[0] - 1
+        if num_spectra == 0:
+            self.error.emit(FileEmptyError())
+            return
+        self.max = num_spectra
+
+        # Balance ranges by size in bytes rather than by number of spectra
+        num_chunks = min(num_spectra, cpu_count() * PARALLEL_READ_CHUNKS_PER_PROCESS)
+        bounds = np.searchsorted(offsets, np.linspace(offsets[0], offsets[-1], num_chunks + 1))
+        bounds[-1] = num_spectra
+        bounds = np.unique(bounds)
+
+        # Ranges are copied to scratch files to be parsed, remove them all even if a process was killed
+        try:
+            scratch_path = create_scratch_folder(SCRATCH_PATH)
+        except OSError as e:
+            self.error.emit(e)
+            return
+
+        tasks = [(self.filename, fmt, offsets[start], offsets[stop], start,
+                  self.options.is_ms1_data, filter_params, self.keep_raw, scratch_path)
+                 for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        results = [None] * len(tasks)
+        try:
+            for i, result in imap_unordered(read_and_filter_range, tasks, should_stop=self.isStopped):
+                results[i] = result
+                self.updated.emit(bounds[i+1] - bounds[i])
+        except Exception as e:
+            self.error.emit(e)
+            return
+        finally:
+            shutil.rmtree(scratch_path, ignore_errors=True)
+
+        if self.isStopped():
+            self.canceled.emit()
+            return
+
+        mzs = [mz for r in results for mz in r[0]]
+        ids = [id_ for r in results for id_ in r[1]]
+        spectra = PackedSpectra.concatenate([r[2] for r in results])
+        if self.keep_raw:
+            self.raw_spectra = PackedSpectra.concatenate([r[3] for r in results])
+
+        if not spectra:
+            self.error.emit(NoSpectraError())
+            return
+
+        self.set_rts(np.concatenate([r[4] for r in results]))
+        mzs = pd.Series(mzs, index=ids)
+
+        return mzs, spectra
+
+    def read_multiple(self, filter_params):
+        """Read each file in its own process and merge results in the order of files."""
+
+        formats = [guess_file_format(filename) for filename in self.filenames]
+        if any(fmt not in MZ_KEYS for fmt in formats):
+            self.error.emit(NotImplementedError())
+            return
+
+        self.max = len(self.filenames)
+        self.desc = 'Reading data files...'
+
+        results = [None] * len(self.filenames)
+        cache_keys = [self.get_cache_key(filename, fmt, filter_params)
+                      for filename, fmt in zip(self.filenames, formats)]
+        tasks_files = []
+        for i, (filename, fmt, cache_key) in enumerate(zip(self.filenames, formats, cache_keys)):
+            cached = self.cache.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                mzs, ids, spectra, rts = cached
+                results[i] = (mzs, ids, spectra, None, rts if rts is not None else np.full(len(spectra), np.nan))
+                self.updated.emit(1)
+            else:
+                tasks_files.append(i)
+
+        # Compressed files are decompressed to scratch files to be parsed, remove them all even if a process was
+        # killed
+        try:
+            scratch_path = create_scratch_folder(SCRATCH_PATH)
+        except OSError as e:
+            self.error.emit(e)
+            return
+
+        tasks = [(self.filenames[i], formats[i], self.options.is_ms1_data, filter_params, self.keep_raw,
+                  scratch_path) for i in tasks_files]
+        try:
+            for j, result in imap_unordered(read_and_filter_file, tasks, should_stop=self.isStopped):
+                i = tasks_files[j]
+                results[i] = result
+                if cache_keys[i] is not None and len(result[2]) > 0:
+                    self.cache.put(cache_keys[i], *result[:3], rts=result[4])
+                self.updated.emit(1)
+        except Exception as e:
+            self.error.emit(e)
+            return
+        finally:
+            shutil.rmtree(scratch_path, ignore_errors=True)
+
+        if self.isStopped():
+            self.canceled.emit()
+            return
+
+        if not any(len(r[1]) for r in results):
+            self.error.emit(FileEmptyError())
+            return
+
+        # Prefix ids with the name of the file they come from, then make sure they are unique
+        labels = make_unique([get_file_label(filename) for filename in self.filenames])
+        ids = make_unique([f'{label}:{id_}' for label, r in zip(labels, results) for id_ in r[1]])
+        mzs = [mz for r in results for mz in r[0]]
+        spectra = PackedSpectra.concatenate([r[2] for r in results])
+        if self.keep_raw and all(r[3] is not None for r in results):
+            self.raw_spectra = PackedSpectra.concatenate([r[3] for r in results])
+
+        if not spectra:
+            self.error.emit(NoSpectraError())
+            return
+
+        self.set_rts(np.concatenate([r[4] for r in results]))
+        sources = [os.path.basename(filename) for filename, r in zip(self.filenames, results) for _ in r[1]]
+        original_ids = [str(id_) for r in results for id_ in r[1]]
+        self.infos = pd.DataFrame({self.SOURCE_COLUMN: sources, self.ID_COLUMN: original_ids}, index=ids)
+
+        return pd.Series(mzs, index=ids), spectra
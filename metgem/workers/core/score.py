@@ -1,23 +1,373 @@
+import heapq
+import math
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
 from libmetgem.score import compute_similarity_matrix
+from scipy.sparse import coo_matrix, issparse
 
+from metgem.logger import logger
 from metgem.workers.base import BaseWorker
 from metgem.workers.options import ScoreComputationOptions
+from metgem.utils.matrix import (create_memmap, iter_row_blocks, is_out_of_core, quantize, dequantize,
+                                 get_sparse_dtype, CondensedMatrix, TopKScores)
+from metgem.utils.parallel import cpu_count, imap_unordered, SharedArrays
+from metgem.utils import scoring as numpy_scoring
+from metgem.utils.scoring import get_scorings, convert_spectra
+from metgem.utils.candidates import get_candidates, estimate_recall
+from metgem.utils.spectra import PackedSpectra, as_list
+
+# Minimum number of spectra scored at once when only pairs of spectra with close parent masses or retention times
+# are scored
+MIN_BLOCK_SIZE = 256
+
+# Maximum number of spectra in a tile when similarity matrix is computed by tiles
+TILE_SIZE = 2048
+
+# Minimum number of tiles scored by each process when scores are computed by several processes
+TILES_PER_PROCESS = 4
+
+
+class NoRetentionTimesError(Exception):
+    pass
+
+
+def get_blocking_windows(keys, delta, min_block_size=MIN_BLOCK_SIZE):
+    """Split sorted `keys` in blocks of consecutive rows.
+
+    Yields (start, stop, end) tuples: all rows that are at most `delta` away from a row of block [start, stop)
+    and after it are in [start, end). Blocks are about as large as windows so that the cost of scoring a full
+    window instead of only pairs involving rows of the block stays low.
+    """
+
+    n = keys.shape[0]
+    start = 0
+    while start < n:
+        width = np.searchsorted(keys, keys[start] + delta, side='right') - start
+        stop = min(n, start + max(min_block_size, width))
+        end = max(stop, np.searchsorted(keys, keys[stop-1] + delta, side='right'))
+        yield start, stop, end
+        start = stop
+
+
+def get_tiles(n, tile_size):
+    """Split upper triangle of a `n`x`n` matrix in tiles of at most `tile_size` rows and columns.
+
+    Returns a list of (rows, cols) slices."""
+
+    return [(slice(i, min(n, i + tile_size)), slice(j, min(n, j + tile_size)))
+            for i in range(0, n, tile_size) for j in range(i, n, tile_size)]
+
+
+def get_tile_size(n, n_parts):
+    """Size of tiles giving a few tiles to each of `n_parts` processes or jobs."""
+
+    num_blocks = math.ceil(math.sqrt(2 * TILES_PER_PROCESS * n_parts))
+    return max(1, min(TILE_SIZE, math.ceil(n / num_blocks)))
+
+
+def split_tiles(tiles, n_parts):
+    """Distribute `tiles` in `n_parts` lists with about the same number of pairs to score."""
+
+    parts = [[] for _ in range(n_parts)]
+    heap = [(0, i) for i in range(n_parts)]
+    for tile in sorted(tiles, key=lambda t: get_tile_cost(*t), reverse=True):
+        cost, i = heapq.heappop(heap)
+        parts[i].append(tile)
+        heapq.heappush(heap, (cost + get_tile_cost(*tile), i))
+    return parts
+
+
+def get_append_tiles(n_scored, n, tile_size, block_size=None):
+    """Tiles of upper triangle of a `n`x`n` matrix that involve spectra appended after the first `n_scored`
+    ones, whose scores are already known.
+
+    First spectra are split in blocks of `block_size` rows: scoring a block together with appended spectra is
+    cheapest when both have about the same size."""
+
+    if block_size is None:
+        block_size = tile_size
+    new = range(n_scored, n, tile_size)
+    tiles = [(slice(i, min(n_scored, i + block_size)), slice(j, min(n, j + tile_size)))
+             for i in range(0, n_scored, block_size) for j in new]
+    tiles.extend((slice(i, min(n, i + tile_size)), slice(j, min(n, j + tile_size))) for i in new for j in new
+                 if j >= i)
+    return tiles
+
+
+def get_tile_cost(rows, cols):
+    """Number of pairs scored to compute a tile."""
+
+    size = rows.stop - rows.start + (cols.stop - cols.start if cols != rows else 0)
+    return size * (size - 1) // 2
+
+
+def get_scoring_function(engine):
+    """Function used to compute similarity matrices, from `libmetgem` or implemented with NumPy."""
+
+    if engine == 'numpy':
+        return numpy_scoring.compute_similarity_matrix
+    return compute_similarity_matrix
+
+
+def compute_scores(mzs, spectra, mz_tolerance, min_matched_peaks, scoring, dense_output=True, callback=None,
+                   engine='libmetgem'):
+    """Compute similarity matrix of `spectra`, or a list of similarity matrices if `scoring` is a list of
+    algorithms, see `metgem.utils.scoring.use_square_root` for normalization of spectra.
+
+    NumPy implementation matches peaks once for all algorithms. libmetgem computes each matrix in turn, progress
+    reported to `callback` being scaled accordingly.
+    """
+
+    compute = get_scoring_function(engine)
+    if engine == 'numpy' or isinstance(scoring, str):
+        return compute(mzs, spectra, mz_tolerance, min_matched_peaks, scoring, dense_output=dense_output,
+                       callback=callback)
+
+    scorings = get_scorings(scoring)
+    progress = 0.
+    reported = 0
+
+    def scaled_callback(value):
+        nonlocal progress, reported
+        progress += value / len(scorings)
+        value, reported = int(progress) - reported, int(progress)
+        return callback(value)
+
+    matrices = []
+    for name in scorings:
+        matrix = compute(mzs, as_list(convert_spectra(spectra, name)), mz_tolerance, min_matched_peaks, name,
+                         dense_output=dense_output, callback=scaled_callback if callback is not None else None)
+        if matrix is None:
+            return
+        matrices.append(matrix)
+    return matrices
+
+
+def get_scores(matrix):
+    """Rows, columns and values of non-zero scores of a sparse similarity matrix. If `matrix` is a list of
+    matrices, values are a (len(`matrix`), n_pairs) array of scores of pairs with a non-zero score in any of them."""
+
+    if not isinstance(matrix, list):
+        matrix = coo_matrix(matrix)
+        return matrix.row, matrix.col, matrix.data
+
+    matrices = [coo_matrix(m) for m in matrix]
+    n = matrices[0].shape[1]
+    keys = np.unique(np.concatenate([m.row.astype(np.int64) * n + m.col for m in matrices]))
+    values = np.zeros((len(matrices), keys.shape[0]), dtype=np.float32)
+    for k, m in enumerate(matrices):
+        values[k, np.searchsorted(keys, m.row.astype(np.int64) * n + m.col)] = m.data
+    return keys // n, keys % n, values
+
+
+def score_tile(mzs, spectra, rows, cols, mz_tolerance, min_matched_peaks, scoring, callback=None,
+               engine='libmetgem'):
+    """Score pairs of spectra of a tile of the upper triangle of similarity matrix.
+
+    As libmetgem can only score all pairs of a list of spectra, a tile away from the diagonal is computed by
+    scoring both blocks of spectra it involves together.
+    Returns rows, columns and values of non-zero scores of the tile, with row < column, or None if `callback`
+    requested to stop. Values are an array of scores of each algorithm if `scoring` is a list, see `get_scores`.
+    """
+
+    stopped = False
+
+    def tile_callback(value):
+        nonlocal stopped
+        stopped = callback is not None and not callback(value)
+        return not stopped
+
+    idx = np.arange(rows.start, rows.stop)
+    if cols != rows:
+        idx = np.concatenate((idx, np.arange(cols.start, cols.stop)))
+    matrix = compute_scores(mzs[idx], [spectra[i] for i in idx], mz_tolerance, min_matched_peaks, scoring,
+                            dense_output=False, callback=tile_callback, engine=engine)
+    if stopped or matrix is None:
+        return
+
+    r, c, v = get_scores(matrix)
+    if cols == rows:
+        mask = c > r
+    else:
+        size = rows.stop - rows.start
+        mask = (r < size) & (c >= size)
+    return idx[r[mask]], idx[c[mask]], v[..., mask]
+
+
+def score_shared_tile(specs, task, rows, cols, mz_tolerance, min_matched_peaks, scoring, engine='libmetgem'):
+    """Run `score_tile` in a child process, with spectra stored in shared memory.
+
+    Progress is reported in shared `progress` array, computation stops as soon as shared `stop` flag is set."""
+
+    arrays = SharedArrays.attach(specs)
+    progress = arrays['progress']
+    stop = arrays['stop']
+    spectra = PackedSpectra(arrays['peaks'], arrays['offsets'])
+
+    def callback(value):
+        progress[task] += value
+        return not stop[0]
+
+    return score_tile(arrays['mzs'], spectra, rows, cols, mz_tolerance, min_matched_peaks, scoring, callback,
+                      engine=engine)
+
+
+def build_matrix(n, results, dense_output=True, out_of_core=False, scores=None, top_k=0, condensed=False,
+                 dtype=np.float32):
+    """Build a symmetric `n`x`n` similarity matrix with ones on diagonal from an iterable of rows, columns and
+    values of scores in upper triangle.
+
+    Dense matrix is filled as `results` are consumed and stored in a memory-mapped file if `out_of_core` is set.
+    If `condensed` is set, only upper triangle of dense matrix is stored.
+    If `top_k` is set, sparse matrix only keeps the `top_k` best scores of each spectrum.
+    Scores are stored as `dtype`, see `quantize`.
+    If given, `scores` is the similarity matrix of the first spectra and is copied in top-left corner.
+    """
+
+    results = ((r, c, v[np.newaxis]) for r, c, v in results)
+    return build_matrices(n, results, 1, dense_output=dense_output, out_of_core=out_of_core,
+                          scores=None if scores is None else [scores], top_k=top_k, condensed=condensed,
+                          dtype=dtype)[0]
+
+
+def build_matrices(n, results, n_matrices, dense_output=True, out_of_core=False, scores=None, top_k=0,
+                   condensed=False, dtype=np.float32):
+    """Build `n_matrices` similarity matrices at once, as `build_matrix`, values of `results` being
+    (`n_matrices`, n_pairs) arrays. If given, `scores` is a list of similarity matrices of the first spectra."""
+
+    if not dense_output and top_k > 0:
+        best = [TopKScores(n, top_k) for _ in range(n_matrices)]
+        for b, matrix in zip(best, scores if scores is not None else []):
+            matrix = coo_matrix(dequantize(matrix))
+            mask = matrix.row < matrix.col
+            b.push(matrix.row[mask], matrix.col[mask], matrix.data[mask])
+        for r, c, v in results:
+            for b, values in zip(best, v):
+                mask = values > 0
+                b.push(r[mask], c[mask], values[mask])
+        return [b.tocsr(dtype) for b in best]
+    elif dense_output and condensed:
+        matrices = []
+        for k in range(n_matrices):
+            matrix = CondensedMatrix(n, data=create_memmap((n * (n - 1) // 2,), dtype) if out_of_core else None,
+                                     dtype=dtype)
+            if scores is not None:
+                for start, stop, block in iter_row_blocks(scores[k]):
+                    matrix.set_rows(start, block)
+            matrices.append(matrix)
+        for r, c, v in results:
+            for matrix, values in zip(matrices, v):
+                matrix.set_values(r, c, values)
+        for matrix in matrices:
+            if isinstance(matrix.data, np.memmap):
+                matrix.data.flush()
+        return matrices
+    elif dense_output:
+        matrices = []
+        for k in range(n_matrices):
+            matrix = create_memmap((n, n), dtype) if out_of_core else np.zeros((n, n), dtype=dtype)
+            np.fill_diagonal(matrix, quantize(1, dtype))
+            if scores is not None:
+                for start, stop, block in iter_row_blocks(scores[k]):
+                    matrix[start:stop, :block.shape[1]] = quantize(block, dtype)
+            matrices.append(matrix)
+        for r, c, v in results:
+            for matrix, values in zip(matrices, v):
+                values = quantize(values, dtype)
+                matrix[r, c] = values
+                matrix[c, r] = values
+        for matrix in matrices:
+            if isinstance(matrix, np.memmap):
+                matrix.flush()
+        return matrices
+    else:
+        dtype = get_sparse_dtype(dtype)
+        start = 0 if scores is None else scores[0].shape[0]
+        parts = []
+        for k in range(n_matrices):
+            rows, cols = [np.arange(start, n)], [np.arange(start, n)]
+            data = [quantize(np.ones(n - start, dtype=np.float32), dtype)]
+            if scores is not None:
+                matrix = coo_matrix(scores[k])
+                rows.append(matrix.row)
+                cols.append(matrix.col)
+                data.append(quantize(dequantize(matrix.data), dtype))
+            parts.append((rows, cols, data))
+        for r, c, v in results:
+            for (rows, cols, data), values in zip(parts, v):
+                mask = values > 0
+                values = quantize(values[mask], dtype)
+                rows.extend((r[mask], c[mask]))
+                cols.extend((c[mask], r[mask]))
+                data.extend((values, values))
+        return [coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                           shape=(n, n)).tocsr() for rows, cols, data in parts]
 
 
 class ComputeScoresWorker(BaseWorker):
     """Generate a network from a MGF file.
+
+    If `scoring` option is a list of algorithms, result is a dict of similarity matrices by algorithm.
     """
 
-    def __init__(self, mzs, spectra, options: ScoreComputationOptions):
+    def __init__(self, mzs, spectra, options: ScoreComputationOptions, rts=None):
         super().__init__()
         self._mzs = mzs
         self._spectra = spectra
+        self._rts = rts
         self.options = options
         self._num_spectra = len(self._spectra)
         self.max = self._num_spectra * (self._num_spectra - 1) // 2
         self.iterative_update = True
         self.desc = 'Computing scores...'
 
+    @property
+    def use_blocking(self):
+        return self.options.get('use_mz_blocking', False) or self.options.get('use_rt_blocking', False)
+
+    @property
+    def n_jobs(self):
+        """Number of processes used to compute scores."""
+
+        if not self.options.get('use_multiprocessing', False):
+            return 1
+        n_jobs = self.options.get('n_jobs', 0)
+        return n_jobs if n_jobs > 0 else cpu_count()
+
+    @property
+    def top_k(self):
+        """Number of scores kept for each spectrum, 0 if all scores are kept."""
+
+        if self.options.dense_output or not self.options.get('use_top_k', False):
+            return 0
+        return self.options.get('top_k', 0)
+
+    @property
+    def engine(self):
+        return self.options.get('engine', 'libmetgem')
+
+    @property
+    def score_dtype(self):
+        return np.dtype(self.options.get('score_dtype', 'float32'))
+
+    @property
+    def condensed(self):
+        return self.options.dense_output and self.options.get('condensed', False)
+
+    @property
+    def scorings(self):
+        return get_scorings(self.options.scoring)
+
+    @property
+    def use_candidates(self):
+        return self.options.get('use_candidates', False)
+
+    @property
+    def use_tiling(self):
+        return ((self.options.dense_output and self.options.get('out_of_core', False)) or self.n_jobs > 1
+                or self.top_k > 0 or not isinstance(self.options.scoring, str))
+
     def run(self):
         def callback(value):
             self.updated.emit(value)
@@ -28,12 +378,22 @@ class ComputeScoresWorker(BaseWorker):
             return False
 
         try:
-            scores_matrix = compute_similarity_matrix(self._mzs, self._spectra,
-                                                      self.options.mz_tolerance, self.options.min_matched_peaks,
-                                                      self.options.scoring,
-                                                      dense_output=self.options.dense_output,
-                                                      callback=callback)
-        except MemoryError as e:
+            if self.use_candidates:
+                scores_matrix = self.compute_candidates(callback)
+            elif self.use_blocking:
+                scores_matrix = self.compute_blocked(callback)
+            elif self.use_tiling:
+                scores_matrix = self.compute_tiled(callback)
+            else:
+                compute = get_scoring_function(self.engine)
+                scores_matrix = compute(self._mzs, as_list(self._spectra), self.options.mz_tolerance,
+                                        self.options.min_matched_peaks, self.options.scoring,
+                                        dense_output=self.options.dense_output, callback=callback)
+                if self.condensed and not self.isStopped():
+                    scores_matrix = CondensedMatrix.from_dense(scores_matrix, dtype=self.score_dtype)
+                elif not self.isStopped() and scores_matrix.dtype != self.score_dtype:
+                    scores_matrix = quantize(scores_matrix, self.score_dtype)
+        except (MemoryError, OSError, BrokenProcessPool, NoRetentionTimesError) as e:
             self.error.emit(e)
             return
 
@@ -41,3 +401,269 @@ class ComputeScoresWorker(BaseWorker):
             return scores_matrix
         else:
             self.canceled.emit()
+
+    def build_matrix(self, results, scores=None, **kwargs):
+        """Build similarity matrix from `results`, see `build_matrix`, or a dict of similarity matrices by algorithm
+        if `scoring` option is a list."""
+
+        kwargs = {'dense_output': self.options.dense_output, 'out_of_core': self.options.get('out_of_core', False),
+                  'top_k': self.top_k, 'condensed': self.condensed, 'dtype': self.score_dtype, **kwargs}
+        if isinstance(self.options.scoring, str):
+            return build_matrix(self._num_spectra, results, scores=scores, **kwargs)
+
+        scorings = self.scorings
+        if scores is not None:
+            scores = [scores[name] for name in scorings]
+        matrices = build_matrices(self._num_spectra, results, len(scorings), scores=scores, **kwargs)
+        return dict(zip(scorings, matrices))
+
+    def get_blocking_keys(self):
+        """List of (values, maximum difference) used to select pairs of spectra to score."""
+
+        keys = []
+        if self.options.use_mz_blocking:
+            keys.append((np.asarray(self._mzs, dtype=np.float64), self.options.max_mz_delta))
+        if self.options.use_rt_blocking:
+            if self._rts is None:
+                raise NoRetentionTimesError("Retention times are not available, spectra can't be paired by "
+                                            "retention time.")
+            keys.append((np.asarray(self._rts, dtype=np.float64), self.options.max_rt_delta))
+        return keys
+
+    def compute_blocked(self, callback):
+        """Only score pairs of spectra with close parent masses and/or retention times.
+
+        Spectra are sorted by parent mass (or retention time if only retention times are used), then scored
+        by sliding windows. Pairs that are not scored get a score of 0.
+        """
+
+        keys = self.get_blocking_keys()
+
+        # Sort spectra using first key, other keys are only used to discard pairs
+        # Spectra without a value for the key (e.g. no retention time) are not paired
+        primary, delta = keys[0]
+        valid = np.flatnonzero(~np.isnan(primary))
+        order = valid[np.argsort(primary[valid], kind='stable')]
+        windows = list(get_blocking_windows(primary[order], delta))
+        self.max = sum((end - start) * (end - start - 1) // 2 for start, _, end in windows)
+
+        matrix = self.build_matrix(self.iter_windows(order, windows, keys, callback))
+        if not self.isStopped():
+            return matrix
+
+    def iter_windows(self, order, windows, keys, callback):
+        """Score spectra of each window and yield rows, columns and values of non-zero scores of pairs of spectra
+        close enough for all `keys`."""
+
+        mzs = np.asarray(self._mzs, dtype=np.float64)
+        spectra = as_list(self._spectra)
+        for start, stop, end in windows:
+            idx = order[start:end]
+            matrix = compute_scores(mzs[idx], [spectra[i] for i in idx], self.options.mz_tolerance,
+                                    self.options.min_matched_peaks, self.options.scoring, dense_output=False,
+                                    callback=callback, engine=self.engine)
+            if self.isStopped() or matrix is None:
+                return
+
+            # Keep each pair only once: first spectrum in block, second one after it in window
+            r, c, v = get_scores(matrix)
+            mask = (r < stop - start) & (c > r)
+            r, c, v = idx[r[mask]], idx[c[mask]], v[..., mask]
+            for values, d in keys:
+                mask = np.abs(values[r] - values[c]) <= d
+                r, c, v = r[mask], c[mask], v[..., mask]
+            yield r, c, v
+
+    def compute_candidates(self, callback):
+        """Only score pairs of spectra found by an approximate nearest neighbours search, see `get_candidates`.
+
+        Candidate pairs are scored with the NumPy implementation, as libmetgem can only score all pairs of a list of
+        spectra. Pairs that are not scored get a score of 0. Estimated recall of the search is logged.
+        """
+
+        n = self._num_spectra
+        mzs = np.asarray(self._mzs, dtype=np.float64)
+        n_candidates = self.options.get('n_candidates', 100)
+        candidates = get_candidates(mzs, self._spectra, n_candidates,
+                                    method=self.options.get('candidates_method', 'lsh'),
+                                    n_tables=self.options.get('lsh_tables', 16))
+        rows, cols = candidates
+        if self.use_blocking:
+            for values, delta in self.get_blocking_keys():
+                mask = np.abs(values[rows] - values[cols]) <= delta
+                rows, cols = rows[mask], cols[mask]
+        self.max = rows.shape[0]
+
+        results = numpy_scoring.score_pairs(mzs, self._spectra, rows, cols, self.options.mz_tolerance,
+                                            self.options.min_matched_peaks, self.options.scoring, callback=callback)
+        if results is None:
+            return
+
+        # Recall of nearest neighbours search with first algorithm, regardless of pairs discarded by blocking
+        scoring = self.scorings[0]
+        spectra = self._spectra if isinstance(self.options.scoring, str) else convert_spectra(self._spectra, scoring)
+        recall = estimate_recall(mzs, spectra, *candidates, n_candidates, self.options.mz_tolerance,
+                                 self.options.min_matched_peaks, scoring)
+        recall = 'n/a' if recall is None else f'{recall:.1%}'
+        logger.info(f"{rows.shape[0]} candidate pairs scored out of {n * (n - 1) // 2}, estimated recall of "
+                    f"{n_candidates} nearest neighbours: {recall}")
+
+        return self.build_matrix([results])
+
+    def compute_tiled(self, callback):
+        """Compute similarity matrix tile by tile, in one or several processes.
+
+        Dense matrix is stored in a memory-mapped file if `out_of_core` option is set, only one tile of scores is
+        then kept in memory at once. If `use_top_k` option is set, only best scores of each spectrum are kept as
+        tiles are computed.
+        """
+
+        n = self._num_spectra
+        tiles = get_tiles(n, get_tile_size(n, self.n_jobs) if self.n_jobs > 1 else TILE_SIZE)
+        self.max = sum(get_tile_cost(*t) for t in tiles)
+
+        matrix = self.build_matrix(self.iter_tiles(tiles, callback))
+        if not self.isStopped():
+            return matrix
+
+    def compute_tiles(self, tiles):
+        """Only score some `tiles` of upper triangle of similarity matrix, as given by `get_tiles`.
+
+        Returns rows, columns and values of non-zero scores, with row < column, or None if worker was stopped.
+        Values are an array of scores of each algorithm if `scoring` option is a list.
+        """
+
+        def callback(value):
+            self.updated.emit(value)
+            return not self.isStopped()
+
+        self.max = sum(get_tile_cost(*t) for t in tiles)
+        shape = (0,) if isinstance(self.options.scoring, str) else (len(self.scorings), 0)
+        parts = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(shape, dtype=np.float32))]
+        parts.extend(self.iter_tiles(tiles, callback))
+
+        if self.isStopped():
+            self.canceled.emit()
+            return
+
+        return tuple(np.concatenate(x, axis=-1) for x in zip(*parts))
+
+    def iter_tiles(self, tiles, callback):
+        """Score `tiles` and yield rows, columns and values of non-zero scores of each tile."""
+
+        if self.n_jobs > 1:
+            yield from self.iter_sharded(tiles)
+            return
+
+        mzs = np.asarray(self._mzs, dtype=np.float64)
+        spectra = as_list(self._spectra)
+        for rows, cols in tiles:
+            result = score_tile(mzs, spectra, rows, cols, self.options.mz_tolerance,
+                                self.options.min_matched_peaks, self.options.scoring, callback=callback,
+                                engine=self.engine)
+            if result is None:
+                return
+            yield result
+
+    def iter_sharded(self, tiles):
+        """Score `tiles` in a pool of processes, spectra being shared with processes through shared memory.
+        Progress of all processes is reported through `updated` signal."""
+
+        spectra = PackedSpectra.from_list(self._spectra)
+        shared = SharedArrays(mzs=np.asarray(self._mzs, dtype=np.float64), peaks=spectra.peaks,
+                              offsets=spectra.offsets, progress=np.zeros(len(tiles), dtype=np.int64),
+                              stop=np.zeros(1, dtype=bool))
+        done = 0
+
+        def should_stop():
+            nonlocal done
+            total = int(shared['progress'].sum())
+            if total > done:
+                self.updated.emit(total - done)
+                done = total
+
+            if self.isStopped():
+                shared['stop'][0] = True
+                return True
+            return False
+
+        try:
+            tasks = [(shared.specs, i, rows, cols, self.options.mz_tolerance, self.options.min_matched_peaks,
+                      self.options.scoring, self.engine) for i, (rows, cols) in enumerate(tiles)]
+            for _, result in imap_unordered(score_shared_tile, tasks, should_stop=should_stop,
+                                            max_workers=self.n_jobs):
+                if result is not None:
+                    yield result
+            should_stop()
+        finally:
+            shared.close()
+
+
+class AppendScoresWorker(ComputeScoresWorker):
+    """Extend similarity matrix `scores` of the first spectra of `spectra` to spectra appended after them.
+
+    Only pairs involving appended spectra are scored. Result is dense or sparse like `scores`. If `scoring` option
+    is a list, `scores` is a dict of similarity matrices by algorithm.
+    """
+
+    def __init__(self, scores, mzs, spectra, options: ScoreComputationOptions, rts=None):
+        super().__init__(mzs, spectra, options, rts=rts)
+        self._scores = scores
+        self._num_scored = self.first_scores.shape[0]
+        num_new = self._num_spectra - self._num_scored
+        self.max = num_new * self._num_scored + num_new * (num_new - 1) // 2
+        self.desc = 'Computing scores of appended spectra...'
+
+    def run(self):
+        def callback(value):
+            self.updated.emit(value)
+            return not self.isStopped()
+
+        if self.isStopped():
+            self.canceled.emit()
+            return
+
+        n = self._num_spectra
+        num_new = n - self._num_scored
+        tile_size = get_tile_size(n, self.n_jobs) if self.n_jobs > 1 else TILE_SIZE
+        block_size = max(MIN_BLOCK_SIZE, min(tile_size, num_new))
+        tiles = get_append_tiles(self._num_scored, n, tile_size, block_size)
+        self.max = sum(get_tile_cost(*t) for t in tiles)
+
+        try:
+            results = self.iter_tiles(tiles, callback)
+            if self.use_blocking:
+                results = self.filter_pairs(results, self.get_blocking_keys())
+
+            first = self.first_scores
+            dense_output = not issparse(first)
+            scores_matrix = self.build_matrix(results, scores=self._scores, dense_output=dense_output,
+                                              out_of_core=self.options.get('out_of_core', False)
+                                              or is_out_of_core(first),
+                                              top_k=0 if dense_output else self.top_k,
+                                              condensed=self.condensed or isinstance(first, CondensedMatrix),
+                                              dtype=first.dtype)
+        except (MemoryError, OSError, BrokenProcessPool, NoRetentionTimesError) as e:
+            self.error.emit(e)
+            return
+
+        if not self.isStopped():
+            return scores_matrix
+        else:
+            self.canceled.emit()
+
+    @property
+    def first_scores(self):
+        """Similarity matrix of the first spectra, or one of them if there are several algorithms."""
+
+        return next(iter(self._scores.values())) if isinstance(self._scores, dict) else self._scores
+
+    @staticmethod
+    def filter_pairs(results, keys):
+        """Only keep pairs whose values of `keys` differ by at most the maximum difference of each key."""
+
+        for r, c, v in results:
+            for values, delta in keys:
+                mask = np.abs(values[r] - values[c]) <= delta
+                r, c, v = r[mask], c[mask], v[..., mask]
+            yield r, c, v
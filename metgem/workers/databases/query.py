@@ -6,6 +6,7 @@ from metgem.workers.base import BaseWorker
 from metgem.workers.options import QueryDatabasesOptions
 from metgem.config import SQL_PATH, get_debug_flag
 from metgem.database import SpectraLibrary, Bank
+from metgem.utils.spectra import as_list
 from metgem.workers.struct import StandardsResult
 
 
@@ -48,7 +49,7 @@ class QueryDatabasesWorker(BaseWorker):
 
         # Query database
         analog_mz_tolerance = self.options.analog_mz_tolerance if self.options.analog_search else 0
-        qr = query(SQL_PATH, self._indices, self._mzs, self._spectra, self.options.databases,
+        qr = query(SQL_PATH, self._indices, self._mzs, as_list(self._spectra), self.options.databases,
                    self.options.mz_tolerance, self.options.min_matched_peaks, min_intensity,
                    parent_filter_tolerance, matched_peaks_window,
                    min_matched_peaks_search, self.options.min_cosine, analog_mz_tolerance,
@@ -67,7 +67,9 @@ class ScoreComputationOptions(Options):
 
     Attributes:
         mz_tolerance (float): in Da.
-        scoring (str): Type of score calculated. Can be 'cosine', 'entropy' or 'weighted_entropy'. Default 'cosine'.
+        scoring (str or list): Type of score calculated. Can be 'cosine', 'entropy' or 'weighted_entropy', or a list
+            of these to compute several scores in one pass. Default 'cosine'.
+        engine (str): Implementation used to compute scores. Can be 'libmetgem' or 'numpy'. Default 'libmetgem'.
         min_matched_peaks (int): Minimum number of common peaks between two spectra.
         min_mz (int): Minimum m/z to keep in spectra
         parent_filter_tolerance (int): in Da.
@@ -76,6 +78,26 @@ class ScoreComputationOptions(Options):
             it is kept only if it is in top `min_matched_peaks_search` in the +/-`matched_peaks_window` window.
         matched_peaks_window (int): in Da.
         dense_output (bool): Whether compute a dense or sparse similarity matrix. Default=true
+        out_of_core (bool): Compute dense similarity matrix by tiles and store it in a memory-mapped file instead
+            of memory. Default=false
+        use_multiprocessing (bool): Split similarity matrix in tiles scored by a pool of processes.
+        n_jobs (int): Number of processes used if `use_multiprocessing` is set, 0 to use all available CPUs.
+        score_dtype (str): Type used to store scores. Can be 'float32', 'float16' or 'uint8' (scores are then stored
+            in steps of 1/255). Sparse matrices use 'float32' instead of 'float16'. Default 'float32'.
+        condensed (bool): Only store upper triangle of dense similarity matrix, which is symmetric. Default=false
+        use_top_k (bool): Only store the `top_k` best scores of each spectrum, if `dense_output` is not set.
+            Scores are then kept as long as they are among best scores of at least one of both spectra.
+        top_k (int): Number of scores kept for each spectrum if `use_top_k` is set.
+        use_candidates (bool): Only score pairs of spectra found by an approximate nearest neighbours search of
+            `n_candidates` neighbours for each spectrum, with the NumPy implementation. Default=false
+        candidates_method (str): Nearest neighbours search method. Can be 'lsh' (random-projection locality
+            sensitive hashing) or 'hnsw' (needs hnswlib). Default 'lsh'.
+        n_candidates (int): Number of candidate neighbours of each spectrum if `use_candidates` is set.
+        lsh_tables (int): Number of hash tables used by 'lsh' method. More tables give a better recall.
+        use_mz_blocking (bool): Only score pairs of spectra whose parent masses differ by at most `max_mz_delta`.
+        max_mz_delta (float): in Da.
+        use_rt_blocking (bool): Only score pairs of spectra whose retention times differ by at most `max_rt_delta`.
+        max_rt_delta (float): in seconds.
 
     """
 
@@ -83,6 +105,7 @@ class ScoreComputationOptions(Options):
 
     def __init__(self, **kwargs):
         super().__init__(scoring='cosine',
+                         engine='libmetgem',
                          mz_tolerance=0.02,
                          min_intensity=0,
                          parent_filter_tolerance=17,
@@ -97,6 +120,21 @@ class ScoreComputationOptions(Options):
                          use_min_mz_filter=True,
                          min_mz=50,
                          dense_output=True,
+                         out_of_core=False,
+                         condensed=False,
+                         score_dtype='float32',
+                         use_multiprocessing=False,
+                         n_jobs=0,
+                         use_top_k=False,
+                         top_k=50,
+                         use_candidates=False,
+                         candidates_method='lsh',
+                         n_candidates=100,
+                         lsh_tables=16,
+                         use_mz_blocking=False,
+                         max_mz_delta=200.,
+                         use_rt_blocking=False,
+                         max_rt_delta=30.,
                          **kwargs)
 
 
@@ -152,15 +190,33 @@ class ForceDirectedVisualizationOptions(VisualizationOptions):
         max_connected_nodes (int): Maximum size of a Force Directed cluster. Default value = 1000
         scale (float): Control repulsion between nodes. More makes a more sparse graph. Default value = 30.0
         gravity (float):  ==Attracts nodes to the center. Prevents islands from drifting away. Default value = 1.0
+        min_iterations (int): Number of ForceAtlas2 iterations for the smallest clusters. Default value = 1000
+        max_iterations (int): Maximum number of ForceAtlas2 iterations for a cluster. Default value = 1000
+        iterations_per_node (float): Number of iterations of a cluster per node, between `min_iterations` and
+            `max_iterations`. Default value = 2.0
+        convergence_tolerance (float): Layout of a cluster stops once nodes move in average less than this fraction
+            of the cluster's spread per iteration, 0 to always run all iterations. Default value = 0.0
+        iterations_chunk (int): Number of iterations between convergence and cancellation checks.
+            Default value = 50
+
+    By default, each cluster is laid out with a fixed number of iterations. `ADAPTIVE_ITERATIONS` are the values
+    used to adapt the number of iterations to the size of clusters and stop once layout converges.
     """
     name = 'fd'
 
+    ADAPTIVE_ITERATIONS = {'min_iterations': 200, 'convergence_tolerance': 0.0005}
+
     def __init__(self):
         super().__init__(top_k=10,
                          pairs_min_cosine=0.7,
                          max_connected_nodes=1000,
                          scale=30.0,
-                         gravity=1.0)
+                         gravity=1.0,
+                         min_iterations=1000,
+                         max_iterations=1000,
+                         iterations_per_node=2.0,
+                         convergence_tolerance=0.,
+                         iterations_chunk=50)
 
 
 class IsomapVisualizationOptions(VisualizationOptions):
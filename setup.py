@@ -95,7 +95,8 @@ setup(
     packages=find_packages(exclude=("tests",)),
     entry_points={
         'console_scripts': [
-            'metgem-cli=metgem.cli:cli'
+            'metgem-cli=metgem.cli:cli',
+            'metgem-jobs=metgem.cli:block_jobs'
         ],
         'gui_scripts': [
             'MetGem=metgem.gui:run',
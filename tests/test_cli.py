@@ -0,0 +1,47 @@
+import json
+
+import numpy as np
+import pytest
+from click.testing import CliRunner
+from scipy.sparse import issparse
+
+from metgem.cli import block_jobs, JOBS_MANIFEST
+from metgem.workers.core import ReadDataWorker, ComputeScoresWorker, LoadProjectWorker
+from metgem.workers.options import ScoreComputationOptions
+
+
+@pytest.mark.parametrize('dense', [True, False])
+def test_block_jobs(examples, tmp_path, dense):
+    fn = str(examples / 'Stillingia SFE.mgf')
+    directory = tmp_path / 'jobs'
+    output = str(tmp_path / 'output.mnz')
+    runner = CliRunner()
+
+    result = runner.invoke(block_jobs, ['prepare', '-i', fn, '-d', str(directory), '-n', '3'])
+    assert result.exit_code == 0, result.output
+    with open(directory / JOBS_MANIFEST, encoding='UTF-8') as f:
+        manifest = json.load(f)
+    assert len(manifest['jobs']) == 3
+
+    # Merging is refused as long as some jobs are not completed
+    for job_file in manifest['jobs']:
+        result = runner.invoke(block_jobs, ['merge', '-d', str(directory), '-o', output])
+        assert result.exit_code != 0
+        result = runner.invoke(block_jobs, ['run', str(directory / job_file)])
+        assert result.exit_code == 0, result.output
+
+    result = runner.invoke(block_jobs, ['merge', '-d', str(directory), '-o', output,
+                                        '--dense' if dense else '--sparse'])
+    assert result.exit_code == 0, result.output
+
+    # Merged scores are the same as scores computed in one go
+    options = ScoreComputationOptions()
+    options.update(manifest['options'])
+    mzs, spectra = ReadDataWorker(fn, options).run()
+    expected = np.asarray(ComputeScoresWorker(mzs, spectra, options).run())
+
+    network, *_ = LoadProjectWorker(output).run()
+    assert issparse(network.scores) != dense
+    scores = network.scores.toarray() if issparse(network.scores) else np.asarray(network.scores)
+    np.testing.assert_allclose(scores, expected, atol=1e-6)
+    np.testing.assert_array_equal(network.mzs.values, mzs.values)
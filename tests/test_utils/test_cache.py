@@ -0,0 +1,61 @@
+import os
+import shutil
+
+import numpy as np
+
+from metgem.utils.cache import SpectraCache
+from metgem.utils.spectra import PackedSpectra
+
+
+def make_spectra(n, num_peaks=10, seed=0):
+    rng = np.random.default_rng(seed)
+    return PackedSpectra.from_list([rng.uniform(0, 1, (num_peaks, 2)).astype(np.float32) for _ in range(n)])
+
+
+def test_spectra_cache(examples, tmp_path):
+    fn = str(tmp_path / 'data.mgf')
+    shutil.copy(examples / 'Stillingia SFE.mgf', fn)
+    cache = SpectraCache(path=str(tmp_path / 'cache'), max_size=2 ** 20)
+
+    key = cache.key(fn, {'format': 'mgf', 'min_intensity': 0})
+    assert cache.get(key) is None
+    assert key != cache.key(fn, {'format': 'mgf', 'min_intensity': 5})
+
+    spectra = make_spectra(20)
+    rts = np.linspace(0, 100, 20)
+    assert cache.put(key, np.arange(20) * 10., np.arange(1, 21), spectra, rts=rts)
+    mzs, ids, cached, cached_rts = cache.get(key)
+    assert mzs == (np.arange(20) * 10.).tolist() and ids == list(range(1, 21))
+    np.testing.assert_array_equal(cached.peaks, spectra.peaks)
+    np.testing.assert_array_equal(cached.offsets, spectra.offsets)
+    np.testing.assert_array_equal(cached_rts, rts)
+
+    # Only numeric ids can be stored
+    assert not cache.put(key, np.zeros(20), [f'id{i}' for i in range(20)], spectra)
+
+    # Key changes with content of data file
+    with open(fn, 'a') as f:
+        f.write('BEGIN IONS\nPEPMASS=100\n50 10\nEND IONS\n')
+    assert cache.get(cache.key(fn, {'format': 'mgf', 'min_intensity': 0})) is None
+
+
+def test_spectra_cache_eviction(examples, tmp_path):
+    fn = str(examples / 'Stillingia SFE.mgf')
+    spectra = make_spectra(1000)
+    cache = SpectraCache(path=str(tmp_path), max_size=int(2.5 * spectra.nbytes))
+
+    keys = [cache.key(fn, {'entry': i}) for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        assert cache.put(key, np.zeros(1000), np.arange(1000), spectra)
+        os.utime(cache.entry_path(key), (i, i))
+
+    # Reading an entry marks it as recently used, so that the least recently used one is evicted
+    assert cache.get(keys[0]) is not None
+    assert cache.put(keys[2], np.zeros(1000), np.arange(1000), spectra)
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+    assert cache.size() <= cache.max_size
+
+    # Entries bigger than cache are not stored
+    assert not SpectraCache(path=str(tmp_path), max_size=10).put(keys[0], np.zeros(1000), np.arange(1000),
+                                                                 spectra)
@@ -0,0 +1,35 @@
+import numpy as np
+
+from metgem.utils.candidates import get_candidates, estimate_recall, top_per_row
+
+
+def test_top_per_row():
+    rows = np.array([0, 0, 0, 0, 1, 1])
+    cols = np.array([1, 2, 3, 1, 0, 2])
+    values = np.array([0.5, 0.9, 0.1, 0.5, 0.3, 0.4])
+
+    r, c, v = top_per_row(rows, cols, values, 2, 4)
+    assert list(zip(r, c)) == [(0, 2), (0, 1), (1, 2), (1, 0)]
+    np.testing.assert_allclose(v, [0.9, 0.5, 0.4, 0.3])
+
+
+def test_get_candidates():
+    # Families of spectra sharing most of their fragments
+    rng = np.random.default_rng(0)
+    families = rng.uniform(50, 500, (20, 15))
+    mzs = rng.uniform(300, 600, 400)
+    spectra = []
+    for k in range(400):
+        peaks = np.sort(np.concatenate((rng.choice(families[k % 20], 12, replace=False),
+                                        rng.uniform(50, 500, 3))))
+        intensities = rng.uniform(0.1, 1, peaks.size)
+        spectra.append(np.stack((peaks, intensities / np.linalg.norm(intensities)), axis=1).astype(np.float32))
+    spectra.append(np.empty((0, 2), dtype=np.float32))
+    mzs = np.append(mzs, 400)
+
+    rows, cols = get_candidates(mzs, spectra, 20)
+    assert np.all(rows < cols)
+    assert not np.any(cols == 400)
+    assert np.count_nonzero(rows % 20 == cols % 20) > 0.9 * 20 * (20 * 19 // 2)
+
+    assert estimate_recall(mzs, spectra, rows, cols, 20, 0.02, 4, 'cosine') > 0.9
@@ -0,0 +1,150 @@
+import os
+
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+from metgem.utils.matrix import CondensedMatrix, NeighborLists, TopKScores, clean_scratch, create_scratch_folder
+
+
+def reference_network(scores, pairs_min_cosine, top_k):
+    n = scores.shape[0]
+    edges = [(scores[i, j], i, j) for i in range(n) for j in range(i + 1, n) if scores[i, j] > pairs_min_cosine]
+    edges.sort(key=lambda e: -e[0])
+
+    # Each spectrum keeps its `top_k` best neighbours of higher index
+    kept = []
+    counts = np.zeros(n, dtype=int)
+    for score, i, j in edges:
+        if counts[i] < top_k:
+            counts[i] += 1
+            kept.append((score, i, j))
+
+    # Then edges are only kept if both spectra are in each other's `top_k` most similar spectra
+    counts = np.zeros(n, dtype=int)
+    result = set()
+    for score, i, j in sorted(kept, key=lambda e: -e[0]):
+        if counts[i] < top_k and counts[j] < top_k:
+            result.add((i, j))
+        counts[i] += 1
+        counts[j] += 1
+    return result
+
+
+@pytest.fixture
+def scores():
+    rng = np.random.default_rng(0)
+    scores = rng.uniform(-0.2, 1, (40, 40)).astype(np.float32)
+    scores = np.triu(scores, 1)
+    scores = scores + scores.T
+    np.fill_diagonal(scores, 1)
+    return scores
+
+
+def test_neighbor_lists(scores):
+    mzs = np.arange(scores.shape[0], dtype=np.float32) * 10
+    neighbors = NeighborLists.from_matrix(scores, 8)
+    assert neighbors.n == scores.shape[0]
+    assert np.all(np.diff(neighbors.indptr) <= 8)
+
+    for pairs_min_cosine in (0., 0.5, 0.9):
+        for top_k in (1, 3, 8):
+            interactions = neighbors.generate_network(mzs, pairs_min_cosine, top_k)
+            assert set(zip(interactions['Source'], interactions['Target'])) \
+                == reference_network(scores, pairs_min_cosine, top_k)
+            np.testing.assert_allclose(interactions['Cosine'],
+                                       scores[interactions['Source'], interactions['Target']])
+            np.testing.assert_allclose(interactions['Delta MZ'],
+                                       mzs[interactions['Source']] - mzs[interactions['Target']])
+
+    with pytest.raises(ValueError):
+        neighbors.generate_network(mzs, 0.5, 10)
+
+
+def test_neighbor_lists_condensed(scores):
+    expected = NeighborLists.from_matrix(scores, 5)
+    neighbors = NeighborLists.from_matrix(CondensedMatrix.from_dense(scores), 5)
+    np.testing.assert_array_equal(neighbors.indptr, expected.indptr)
+    np.testing.assert_array_equal(neighbors.indices, expected.indices)
+    np.testing.assert_allclose(neighbors.scores, expected.scores)
+
+    values = []
+    assert NeighborLists.from_matrix(scores, 5, callback=lambda v: values.append(v) or True) is not None
+    assert sum(values) == scores.shape[0]
+    assert NeighborLists.from_matrix(scores, 5, callback=lambda v: False) is None
+
+
+@pytest.mark.parametrize('kind', ['dense', 'sparse', 'condensed'])
+def test_neighbor_lists_ties(kind):
+    scores = np.array([[1., 0.9, 0.8, 0.8],
+                       [0.9, 1., 0.8, 0.5],
+                       [0.8, 0.8, 1., 0.9],
+                       [0.8, 0.5, 0.9, 1.]], dtype=np.float32)
+    matrix = {'dense': scores, 'sparse': csr_matrix(scores),
+              'condensed': CondensedMatrix.from_dense(scores)}[kind]
+    mzs = np.array([100., 150., 200., 250.])
+
+    # Neighbours with equal scores are sorted by index
+    neighbors = NeighborLists.from_matrix(matrix, 2)
+    np.testing.assert_array_equal(neighbors.indptr, [0, 2, 4, 5, 5])
+    np.testing.assert_array_equal(neighbors.indices, [1, 2, 2, 3, 3])
+    np.testing.assert_allclose(neighbors.scores, [0.9, 0.8, 0.8, 0.5, 0.9])
+
+    interactions = neighbors.generate_network(mzs, 0.6, 1)
+    assert interactions.tolist() == [(0, 1, -50., pytest.approx(0.9)), (2, 3, -50., pytest.approx(0.9))]
+
+    # Spectrum 2 is only in the two best neighbours of spectrum 0 because of its index, edge between 1 and 2 is
+    # removed as 2 already has two better edges
+    interactions = neighbors.generate_network(mzs, 0.6, 2)
+    assert list(zip(interactions['Source'], interactions['Target'])) == [(0, 1), (2, 3), (0, 2)]
+    np.testing.assert_allclose(interactions['Cosine'], [0.9, 0.9, 0.8])
+
+
+def test_neighbor_lists_sparse(scores):
+    sparse = csr_matrix(np.where(scores > 0.5, scores, 0))
+    expected = NeighborLists.from_matrix(sparse.toarray(), 6)
+    neighbors = NeighborLists.from_matrix(sparse, 6)
+    np.testing.assert_array_equal(neighbors.indptr, expected.indptr)
+    np.testing.assert_array_equal(neighbors.indices, expected.indices)
+    np.testing.assert_allclose(neighbors.scores, expected.scores)
+
+
+def test_top_k_scores(scores):
+    n, k = scores.shape[0], 4
+    top_k = TopKScores(n, k)
+
+    # Push pairs of upper triangle by chunks, in random order
+    rows, cols = np.triu_indices(n, 1)
+    order = np.random.default_rng(1).permutation(rows.shape[0])
+    for chunk in np.array_split(order, 7):
+        top_k.push(rows[chunk], cols[chunk], scores[rows[chunk], cols[chunk]])
+
+    matrix = top_k.tocsr().toarray()
+    np.testing.assert_array_equal(matrix, matrix.T)
+    np.testing.assert_array_equal(np.diag(matrix), 1)
+
+    # Kept scores are exact and negative scores are never kept
+    mask = matrix > 0
+    np.testing.assert_allclose(matrix[mask], scores[mask])
+    assert np.all(matrix >= 0)
+
+    # Best scores of each spectrum, and best scores with spectra of higher index, are all kept
+    expected = np.where(scores > 0, scores, 0)
+    np.fill_diagonal(expected, 0)
+    for i in range(n):
+        for values in (expected[i], np.triu(expected, 1)[i]):
+            best = np.sort(values[values > 0])[::-1][:k]
+            if best.size > 0:
+                assert np.all(matrix[i][values >= best[-1]] > 0)
+
+
+def test_clean_scratch(tmp_path):
+    folder = create_scratch_folder(str(tmp_path))
+    with open(os.path.join(folder, 'test.mgf'), 'w') as f:
+        f.write('BEGIN IONS\n')
+    other = tmp_path / 'other.txt'
+    other.write_text('')
+
+    # Scratch folders and their content are removed, other files are kept
+    clean_scratch(str(tmp_path))
+    assert os.listdir(tmp_path) == ['other.txt']
@@ -0,0 +1,38 @@
+from metgem.utils.memory import estimate_scores, estimate_stages, get_peak_memory, plan_options
+from metgem.workers.options import ScoreComputationOptions
+
+
+def test_estimate_scores():
+    options = ScoreComputationOptions()
+    assert estimate_scores(1000, options) == (1000 * 1000 * 4, 0, 0)
+
+    options.update({'condensed': True, 'score_dtype': 'uint8', 'out_of_core': True})
+    stored, disk, _ = estimate_scores(1000, options)
+    assert stored == 0 and disk == 1000 * 999 // 2
+
+    # A full matrix of 32-bit floats is computed before being converted if it is not built by tiles
+    options.update({'out_of_core': False, 'condensed': False, 'score_dtype': 'float16'})
+    assert estimate_scores(1000, options) == (1000 * 1000 * 2, 0, 1000 * 1000 * 4)
+
+    options.update({'scoring': ['cosine', 'entropy'], 'score_dtype': 'float32'})
+    assert estimate_scores(1000, options)[0] == 2 * 1000 * 1000 * 4
+
+
+def test_plan_options():
+    n, mean_peaks = 20000, 50
+    options = ScoreComputationOptions()
+    peak = get_peak_memory(estimate_stages(n, mean_peaks, options))
+
+    planned, stages, changes = plan_options(n, mean_peaks, options, 2 * peak)
+    assert planned == options and not changes
+
+    planned, stages, changes = plan_options(n, mean_peaks, options, peak // 10)
+    assert not planned.dense_output and planned.use_top_k
+    assert len(changes) == 2
+    assert get_peak_memory(stages) <= peak // 10
+    assert options.dense_output  # Original options are not changed
+
+    # Views that can't use a sparse matrix need a dense matrix
+    planned, stages, changes = plan_options(n, mean_peaks, options, peak // 10, views=[False])
+    assert planned.dense_output and planned.out_of_core
+    assert get_peak_memory(stages) > peak // 10
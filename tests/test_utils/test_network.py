@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from metgem.config import RADIUS
+from metgem.utils.network import build_graph, get_edge_arrays, get_edge_widths, get_edges_to_cut
+
+
+def test_build_graph():
+    sources = np.array([0, 1, 2, 3], dtype=np.int32)
+    targets = np.array([1, 2, 2, 4], dtype=np.int32)
+    weights = np.array([0.9, 0.8, 1., 0.7], dtype=np.float32)
+
+    graph = build_graph(6, sources, targets, weights)
+    assert graph.vcount() == 6
+    assert graph.vs['name'] == list(range(6))
+    assert graph.get_edgelist() == [(0, 1), (1, 2), (2, 2), (3, 4)]
+    np.testing.assert_allclose(graph.es['__weight'], weights)
+    np.testing.assert_allclose(graph.es['__width'], get_edge_widths(weights))
+
+    # Loops are not returned
+    indexes, s, t, widths = get_edge_arrays(graph)
+    np.testing.assert_array_equal(indexes, [0, 1, 3])
+    np.testing.assert_array_equal(s, [0, 1, 3])
+    np.testing.assert_array_equal(t, [1, 2, 4])
+    np.testing.assert_allclose(widths, get_edge_widths(weights)[[0, 1, 3]])
+
+    graph = build_graph(3, [], [], [], vertex_attrs={'name': ['a', 'b', 'c']})
+    assert graph.ecount() == 0 and graph.vs['name'] == ['a', 'b', 'c']
+    assert all(a.size == 0 for a in get_edge_arrays(graph))
+
+
+def test_get_edge_widths():
+    widths = get_edge_widths([0.6, 0.8, 1.])
+    assert 1 < widths[0] < widths[1] < widths[2] == RADIUS
+    np.testing.assert_allclose(get_edge_widths([0., 0.]), [RADIUS, RADIUS])
+
+
+def reference_cut(graph, max_size):
+    """Remove weakest edges of each component one by one until it is split in components of at most `max_size`
+    vertices."""
+
+    graph = graph.copy()
+    graph.es['index'] = graph.es.indices
+    removed = set()
+    for ids in graph.connected_components():
+        subgraph = graph.subgraph(ids)
+        while max(len(c) for c in subgraph.connected_components()) > max_size:
+            e = min(subgraph.es, key=lambda x: x['__weight'])
+            removed.add(e['index'])
+            subgraph.delete_edges(e.index)
+    return removed
+
+
+@pytest.mark.parametrize('max_size', [1, 3, 10, 25])
+def test_get_edges_to_cut(max_size):
+    rng = np.random.default_rng(0)
+    n = 40
+    # Connected graph: a random tree and random edges
+    sources = np.concatenate((np.arange(1, n), rng.integers(0, n, 110)))
+    targets = np.concatenate(([rng.integers(0, i) for i in range(1, n)], rng.integers(0, n, 110)))
+    weights = np.round(rng.uniform(0.5, 1, sources.shape[0]), 2)  # Some ties
+    graph = build_graph(n, sources, targets, weights)
+
+    positions = get_edges_to_cut(n, sources, targets, weights, max_size)
+    assert set(positions.tolist()) == reference_cut(graph, max_size)
+
+    graph.delete_edges(positions.tolist())
+    assert max(len(c) for c in graph.connected_components()) <= max_size
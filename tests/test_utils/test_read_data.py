@@ -0,0 +1,48 @@
+import os
+import shutil
+
+import numpy as np
+
+from metgem.utils.read_data import (get_index_filename, index_file, scan_file, parse_mgf, IndexedSpectraFile,
+                                    INDEX_EXTENSION)
+
+
+def test_scan_file_chunks(examples):
+    fn = examples / 'Stillingia SFE.mgf'
+
+    offsets = scan_file(fn, 'mgf')
+    assert offsets.shape == (452,)
+    assert offsets[-1] == fn.stat().st_size
+    np.testing.assert_array_equal(offsets, scan_file(fn, 'mgf', chunk_size=1000))
+
+
+def test_index_file_cached(examples, tmp_path):
+    fn = str(tmp_path / 'data.mgf')
+    shutil.copy(examples / 'Stillingia SFE.mgf', fn)
+    index_path = str(tmp_path / 'indexes')
+
+    offsets = index_file(fn, index_path=index_path)
+    assert os.path.exists(get_index_filename(fn, index_path))
+    assert not any(f.endswith(INDEX_EXTENSION) for f in os.listdir(tmp_path))  # Nothing written next to data
+    np.testing.assert_array_equal(index_file(fn, index_path=index_path), offsets)
+
+    # Index should be invalidated if data file is modified
+    with open(fn, 'a') as f:
+        f.write('BEGIN IONS\nPEPMASS=100\n50 10\nEND IONS\n')
+    assert index_file(fn, index_path=index_path).shape[0] == offsets.shape[0] + 1
+
+
+def test_random_access(examples, tmp_path):
+    fn = str(tmp_path / 'data.mgf')
+    shutil.copy(examples / 'Stillingia SFE.mgf', fn)
+
+    with open(fn) as f:
+        spectra = list(parse_mgf(f, ignore_unknown=True))
+    reader = IndexedSpectraFile(fn, offsets=index_file(fn, index_path=None))
+
+    assert len(reader) == len(spectra) == 451
+    for i in (0, 100, -1):
+        params, data = reader[i]
+        assert params == spectra[i][0]
+        np.testing.assert_array_equal(data, spectra[i][1])
+    assert reader[0][0]['feature_id'] == 1
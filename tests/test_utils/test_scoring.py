@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+from metgem.utils.scoring import compute_similarity_matrix, score_pairs, score_rows
+
+
+def reference_score(mz1, spectrum1, mz2, spectrum2, mz_tolerance, min_matched_peaks, scoring):
+    matches = []
+    for i, (a_mz, a) in enumerate(spectrum1):
+        for j, (b_mz, b) in enumerate(spectrum2):
+            if abs(a_mz - b_mz) <= mz_tolerance or abs((mz1 - a_mz) - (mz2 - b_mz)) <= mz_tolerance:
+                matches.append((a * b, i, j))
+
+    used1, used2 = set(), set()
+    score, count = 0., 0
+    for _, i, j in sorted(matches, key=lambda m: -m[0]):
+        if i in used1 or j in used2:
+            continue
+        used1.add(i)
+        used2.add(j)
+        count += 1
+        a, b = float(spectrum1[i, 1]), float(spectrum2[j, 1])
+        if scoring == 'cosine':
+            score += a * b
+        else:
+            score += ((a + b) * np.log2(a + b) - a * np.log2(a) - b * np.log2(b)) / 2
+    return min(score, 1) if count >= min_matched_peaks else 0
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    mzs = rng.uniform(300, 500, 30)
+    fragments = np.round(rng.uniform(50, 300, 30), 2)
+    spectra = []
+    for k in range(30):
+        peaks = rng.choice(fragments, rng.integers(3, 12), replace=False)
+        if k % 3 == 0:  # Add some neutral losses shared with other spectra
+            peaks = np.concatenate((peaks, mzs[k] - rng.choice(fragments, 3, replace=False)))
+        spectra.append(np.stack((np.sort(peaks), rng.uniform(0.1, 1, peaks.size)), axis=1).astype(np.float32))
+    return mzs, spectra
+
+
+@pytest.mark.parametrize('scoring', ['cosine', 'entropy'])
+@pytest.mark.parametrize('min_matched_peaks', [1, 3])
+def test_compute_similarity_matrix(data, scoring, min_matched_peaks):
+    mzs, spectra = data
+    norm = np.linalg.norm if scoring == 'cosine' else np.sum
+    spectra = [np.stack((s[:, 0], s[:, 1] / norm(s[:, 1])), axis=1) for s in spectra]
+
+    matrix = compute_similarity_matrix(mzs, spectra, 0.02, min_matched_peaks, scoring)
+
+    expected = np.eye(len(spectra), dtype=np.float32)
+    for i in range(len(spectra)):
+        for j in range(i + 1, len(spectra)):
+            expected[i, j] = expected[j, i] = reference_score(mzs[i], spectra[i], mzs[j], spectra[j], 0.02,
+                                                              min_matched_peaks, scoring)
+    np.testing.assert_allclose(matrix, expected, atol=1e-6)
+
+    sparse = compute_similarity_matrix(mzs, spectra, 0.02, min_matched_peaks, scoring, dense_output=False)
+    np.testing.assert_allclose(sparse.toarray(), matrix)
+
+
+def test_compute_similarity_matrix_callback(data):
+    mzs, spectra = data
+    n = len(spectra)
+
+    values = []
+    compute_similarity_matrix(mzs, spectra, 0.02, 3, 'cosine', callback=lambda v: values.append(v) or True)
+    assert sum(values) == n * (n - 1) // 2
+
+    assert compute_similarity_matrix(mzs, spectra, 0.02, 3, 'cosine', callback=lambda v: False) is None
+
+
+@pytest.mark.parametrize('scoring', ['cosine', 'weighted_entropy'])
+def test_score_pairs(data, scoring):
+    mzs, spectra = data
+    n = len(spectra)
+    matrix = compute_similarity_matrix(mzs, spectra, 0.02, 2, scoring)
+
+    rng = np.random.default_rng(1)
+    rows, cols = rng.integers(0, n, 200), rng.integers(0, n, 200)
+    r, c, v = score_pairs(mzs, spectra, rows, cols, 0.02, 2, scoring)
+    assert np.all(r < c)
+    np.testing.assert_allclose(v, matrix[r, c], atol=1e-6)
+
+    pairs = set(zip(np.minimum(rows, cols), np.maximum(rows, cols)))
+    expected = {(i, j) for i, j in pairs if i != j and matrix[i, j] > 0}
+    assert set(zip(r, c)) == expected
+
+    r, c, v = score_rows(mzs, spectra, [3, 7], 0.02, 2, scoring)
+    np.testing.assert_allclose(v, matrix[r, c], atol=1e-6)
+    assert len(v) == np.count_nonzero(matrix[[3, 7]]) - 2
+
+
+def test_compute_several_scorings(data):
+    mzs, spectra = data
+    spectra = [np.stack((s[:, 0], s[:, 1] / s[:, 1].sum()), axis=1) for s in spectra]
+    cosine_spectra = [np.stack((s[:, 0], np.sqrt(s[:, 1])), axis=1) for s in spectra]
+    scorings = ['cosine', 'entropy', 'weighted_entropy']
+
+    matrices = compute_similarity_matrix(mzs, spectra, 0.02, 2, scorings, dense_output=False)
+    assert len(matrices) == len(scorings)
+    for scoring, matrix in zip(scorings, matrices):
+        expected = compute_similarity_matrix(mzs, cosine_spectra if scoring == 'cosine' else spectra, 0.02, 2,
+                                             scoring)
+        np.testing.assert_allclose(matrix.toarray(), expected, atol=1e-6)
+        assert np.all(matrix.data > 0)
+
+    r, c, v = score_pairs(mzs, spectra, [0, 1, 2], [5, 6, 7], 0.02, 2, scorings)
+    assert v.shape == (len(scorings), r.shape[0])
+    for k, matrix in enumerate(matrices):
+        np.testing.assert_allclose(v[k], matrix.toarray()[r, c], atol=1e-6)
+
+
+@pytest.mark.parametrize('scoring', ['cosine', 'entropy', 'weighted_entropy'])
+@pytest.mark.parametrize('min_matched_peaks', [1, 3])
+def test_libmetgem_parity(data, scoring, min_matched_peaks):
+    libmetgem_score = pytest.importorskip('libmetgem.score')
+
+    mzs, spectra = data
+    norm = np.linalg.norm if scoring == 'cosine' else np.sum
+    spectra = [np.ascontiguousarray(np.stack((s[:, 0], s[:, 1] / norm(s[:, 1])), axis=1), dtype=np.float32)
+               for s in spectra]
+
+    expected = libmetgem_score.compute_similarity_matrix(mzs, spectra, 0.02, min_matched_peaks, scoring)
+    matrix = compute_similarity_matrix(mzs, spectra, 0.02, min_matched_peaks, scoring)
+    np.testing.assert_allclose(matrix, expected, atol=1e-5)
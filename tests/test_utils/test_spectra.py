@@ -0,0 +1,59 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from metgem.utils.spectra import PackedSpectra
+
+
+@pytest.fixture
+def spectra():
+    return [np.array([[50., 1.], [60., 2.]], dtype=np.float32),
+            np.empty((0, 2), dtype=np.float32),
+            np.array([[70., 3.]], dtype=np.float32),
+            np.array([[80., 4.], [90., 5.], [100., 6.]], dtype=np.float32)]
+
+
+def test_from_list(spectra):
+    packed = PackedSpectra.from_list(spectra)
+
+    assert len(packed) == len(spectra)
+    assert packed.peaks.shape == (6, 2)
+    assert packed.offsets.tolist() == [0, 2, 2, 3, 6]
+    for a, b in zip(packed, spectra):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_getitem_returns_views(spectra):
+    packed = PackedSpectra.from_list(spectra)
+
+    assert np.shares_memory(packed[3], packed.peaks)
+    np.testing.assert_array_equal(packed[-1], spectra[-1])
+    with pytest.raises(IndexError):
+        _ = packed[4]
+
+
+@pytest.mark.parametrize("indices", [[3, 0], np.array([1, 2]), slice(1, None), [True, False, False, True]])
+def test_take(spectra, indices):
+    packed = PackedSpectra.from_list(spectra)
+    expected = np.arange(len(spectra))[np.asarray(indices) if not isinstance(indices, slice) else indices]
+
+    subset = packed[indices]
+    assert isinstance(subset, PackedSpectra)
+    assert len(subset) == len(expected)
+    for a, i in zip(subset, expected):
+        np.testing.assert_array_equal(a, spectra[i])
+
+
+def test_concatenate(spectra):
+    packed = PackedSpectra.concatenate([PackedSpectra.from_list(spectra[:2]), spectra[2:]])
+
+    assert packed.offsets.tolist() == [0, 2, 2, 3, 6]
+    np.testing.assert_array_equal(packed.peaks, PackedSpectra.from_list(spectra).peaks)
+
+
+def test_pickle(spectra):
+    packed = pickle.loads(pickle.dumps(PackedSpectra.from_list(spectra)))
+
+    assert len(packed) == len(spectra)
+    np.testing.assert_array_equal(packed[3], spectra[3])
@@ -0,0 +1,59 @@
+import random
+
+import numpy as np
+import pytest
+
+from metgem.utils.network import build_graph
+from metgem.workers.core import ForceDirectedWorker
+from metgem.workers.core.force_directed import ForceAtlas2, compute_component_layout, run_forceatlas2
+from metgem.workers.options import ForceDirectedVisualizationOptions
+
+
+@pytest.fixture
+def graph():
+    # A cluster of six vertices, a triangle, a pair and an isolated vertex
+    sources = [0, 0, 1, 2, 3, 4, 6, 6, 7, 9]
+    targets = [1, 2, 2, 3, 4, 5, 7, 8, 8, 10]
+    weights = [0.9, 0.8, 0.7, 0.95, 0.75, 0.85, 0.9, 0.7, 0.8, 0.99]
+    return build_graph(12, sources, targets, weights)
+
+
+def test_run_forceatlas2(graph):
+    adjacency = graph.subgraph(range(6)).get_adjacency_sparse(attribute='__weight')
+    forceatlas2 = ForceAtlas2(adjustSizes=False, scalingRatio=30., gravity=1., verbose=False)
+
+    # Same layout as ForceAtlas2's own loop if all iterations are run
+    random.seed(0)
+    expected = np.array(forceatlas2.forceatlas2(adjacency, iterations=120))
+    random.seed(0)
+    layout = run_forceatlas2(forceatlas2, adjacency, 120, chunk_size=50)
+    np.testing.assert_allclose(layout, expected)
+
+    assert run_forceatlas2(forceatlas2, adjacency, 120, chunk_size=50, should_stop=lambda: True) is None
+
+
+def test_compute_component_layout():
+    options = ForceDirectedVisualizationOptions()
+    options.update(ForceDirectedVisualizationOptions.ADAPTIVE_ITERATIONS)
+    layout = compute_component_layout(3, [(0, 1), (1, 2), (0, 2)], [0.9, 0.8, 0.7], options)
+    assert layout.shape == (3, 2)
+    assert np.all(np.isfinite(layout))
+
+
+def test_force_directed_worker(graph):
+    options = ForceDirectedVisualizationOptions()
+    options.max_iterations = options.min_iterations = 100
+    radii = np.zeros(graph.vcount())
+
+    layout, isolated = ForceDirectedWorker(graph, radii, options).run()
+    assert layout.shape == (graph.vcount(), 2)
+    assert np.all(np.isfinite(layout))
+    np.testing.assert_array_equal(isolated, [11])
+
+    # Vertices of different clusters don't overlap
+    assert np.unique(np.round(layout, 6), axis=0).shape[0] == graph.vcount()
+
+    # Only the cluster including vertex 6 is laid out again, others keep their position
+    new_layout, _ = ForceDirectedWorker(graph, radii, options, layout=layout, vertices=[6]).run()
+    others = [0, 1, 2, 3, 4, 5, 9, 10, 11]
+    np.testing.assert_allclose(new_layout[others], layout[others])
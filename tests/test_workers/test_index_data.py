@@ -0,0 +1,23 @@
+import gzip
+import shutil
+
+from metgem.utils.read_data import index_file
+from metgem.workers.core import IndexDataWorker
+
+
+def test_index_compressed(examples, tmp_path):
+    fn = str(examples / 'Stillingia SFE.mgf')
+    compressed = str(tmp_path / 'Stillingia SFE.mgf.gz')
+    with open(fn, 'rb') as f, gzip.open(compressed, 'wb') as dst:
+        shutil.copyfileobj(f, dst)
+
+    errors = []
+    worker = IndexDataWorker(compressed)
+    worker.error.connect(errors.append)
+    offsets = worker.run()
+    assert not errors
+
+    # Spectra of compressed files are counted in decompressed data
+    expected = index_file(fn, index_path=None)
+    assert len(offsets) == len(expected)
+    assert offsets[-1] == expected[-1]
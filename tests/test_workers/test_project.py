@@ -0,0 +1,106 @@
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from metgem.utils.network import Network
+from metgem.utils.spectra import PackedSpectra
+from metgem.workers.core import SaveProjectWorker, LoadProjectWorker
+from metgem.workers.core.project import save
+from metgem.workers.core.project.mnz import ARRAY_ALIGN, MnzFile, savez
+from metgem.workers.core.project.spectra_list import MappedSpectra
+from metgem.workers.options import AttrDict, ScoreComputationOptions
+
+
+@pytest.fixture
+def spectra():
+    rng = np.random.default_rng(0)
+    return PackedSpectra.from_list([rng.uniform(50, 500, (rng.integers(0, 20), 2)).astype(np.float32)
+                                    for _ in range(50)])
+
+
+def make_network(spectra):
+    n = len(spectra.offsets) - 1
+    scores = np.random.default_rng(1).uniform(0, 1, (n, n)).astype(np.float32)
+
+    network = Network()
+    network.mzs = pd.Series(np.linspace(100, 500, n))
+    network.spectra = spectra
+    network.set_scores((scores + scores.T) / 2, 'cosine')
+    network.options = AttrDict(score=ScoreComputationOptions())
+    network.interactions = pd.DataFrame()
+    return network
+
+
+# Names of different lengths to get all possible paddings of local headers
+@pytest.mark.parametrize('key', ['s', 'spectra', '0/spectra', 'abcdefghijklmnopqrstuvwxyz'])
+def test_savez_aligned(tmp_path, spectra, key):
+    fn = str(tmp_path / 'test.mnz')
+    savez(fn, 9, **{'0/options.json': {'a': 1}, '0/scores': np.eye(5), key: spectra})
+
+    with MnzFile(fn) as fid:
+        for prop in ('peaks', 'offsets'):
+            info = fid.zip.getinfo(f'{key}/{prop}.npy')
+            assert info.compress_type == zipfile.ZIP_STORED
+
+            array = fid.memmap(f'{key}/{prop}')
+            assert isinstance(array, np.memmap)
+            assert array.offset % ARRAY_ALIGN == 0
+            np.testing.assert_array_equal(array, getattr(spectra, prop))
+            del array
+        assert fid['0/options.json'] == {'a': 1}
+
+    with zipfile.ZipFile(fn) as zipf:
+        assert zipf.testzip() is None
+
+
+def test_save_project(tmp_path, spectra):
+    fn = str(tmp_path / 'test.mnz')
+    network = make_network(spectra)
+    peaks = spectra.peaks.copy()
+    offsets = spectra.offsets.copy()
+
+    assert SaveProjectWorker(fn, network, None, network.options, {}, {}).run()
+    loaded, *_ = LoadProjectWorker(fn).run()
+    assert isinstance(loaded.spectra, MappedSpectra)
+    np.testing.assert_array_equal(loaded.spectra.peaks, peaks)
+    np.testing.assert_array_equal(loaded.spectra.offsets, offsets)
+    pd.testing.assert_series_equal(loaded.mzs, network.mzs, check_names=False)
+    np.testing.assert_allclose(np.asarray(loaded.scores), np.asarray(network.scores))
+
+    # Save again over the file spectra are mapped from
+    assert loaded.lazyloaded
+    assert SaveProjectWorker(fn, loaded, None, loaded.options, {}, {}).run()
+    np.testing.assert_array_equal(loaded.spectra.peaks, peaks)
+
+    reloaded, *_ = LoadProjectWorker(fn).run()
+    np.testing.assert_array_equal(reloaded.spectra.peaks, peaks)
+    np.testing.assert_array_equal(reloaded.spectra.offsets, offsets)
+    np.testing.assert_allclose(np.asarray(reloaded.scores), np.asarray(network.scores))
+
+
+def test_save_project_replace_error(tmp_path, spectra, monkeypatch):
+    fn = str(tmp_path / 'test.mnz')
+    network = make_network(spectra)
+    peaks = spectra.peaks.copy()
+    assert SaveProjectWorker(fn, network, None, network.options, {}, {}).run()
+    loaded, *_ = LoadProjectWorker(fn).run()
+
+    def replace(src, dst):
+        raise PermissionError(dst)
+
+    # If file can't be replaced, spectra are still available from the original file
+    monkeypatch.setattr(save.os, 'replace', replace)
+    errors = []
+    worker = SaveProjectWorker(fn, loaded, None, loaded.options, {}, {})
+    worker.error.connect(errors.append)
+    assert worker.run() is None
+    assert len(errors) == 1 and isinstance(errors[0], PermissionError)
+    assert loaded.lazyloaded
+    np.testing.assert_array_equal(loaded.spectra.peaks, peaks)
+    np.testing.assert_array_equal(loaded.spectra[3], spectra[3])
+
+    monkeypatch.undo()
+    reloaded, *_ = LoadProjectWorker(fn).run()
+    np.testing.assert_array_equal(reloaded.spectra.peaks, peaks)
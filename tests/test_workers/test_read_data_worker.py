@@ -0,0 +1,144 @@
+import bz2
+import functools
+import gzip
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from metgem.utils.cache import SpectraCache
+from metgem.utils.read_data import index_file
+from metgem.workers.core import read_data
+from metgem.workers.core.read_data import get_filter_params, match_metadata
+from metgem.workers.core import ReadDataWorker
+from metgem.workers.options import ScoreComputationOptions
+
+
+@pytest.fixture
+def parallel_read(monkeypatch, tmp_path):
+    """Read files by byte ranges in a pool of processes, without saving their index. Returns scratch folder."""
+
+    monkeypatch.setattr(read_data, 'PARALLEL_READ_MIN_SIZE', 0)
+    monkeypatch.setattr(read_data, 'cpu_count', lambda: 4)
+    monkeypatch.setattr(read_data, 'index_file', functools.partial(index_file, index_path=None))
+    scratch_path = tmp_path / 'scratch'
+    monkeypatch.setattr(read_data, 'SCRATCH_PATH', str(scratch_path))
+    return scratch_path
+
+
+def test_read_parallel(examples, parallel_read):
+    fn = str(examples / 'Stillingia SFE.mgf')
+    options = ScoreComputationOptions()
+    expected_mzs, expected_spectra = ReadDataWorker(fn, options).read('mgf', get_filter_params(options))
+
+    worker = ReadDataWorker(fn, options)
+    assert worker.use_parallel_read('mgf')
+    mzs, spectra = worker.run()
+
+    pd.testing.assert_series_equal(mzs, expected_mzs)
+    np.testing.assert_array_equal(spectra.offsets, expected_spectra.offsets)
+    np.testing.assert_array_equal(spectra.peaks, expected_spectra.peaks)
+
+    # Byte ranges copied to scratch files are all removed
+    assert not os.listdir(parallel_read)
+
+
+def test_read_parallel_error(examples, parallel_read, monkeypatch):
+    def read(filename, *args, **kwargs):
+        raise ValueError(filename)
+
+    # Processes are forked so they get the patched reader
+    monkeypatch.setitem(read_data.READERS, 'mgf', read)
+
+    errors = []
+    worker = ReadDataWorker(str(examples / 'Stillingia SFE.mgf'), ScoreComputationOptions())
+    worker.error.connect(errors.append)
+    assert worker.run() is None
+    assert len(errors) == 1 and isinstance(errors[0], ValueError)
+    assert not os.listdir(parallel_read)
+
+
+def test_read_cached(examples, tmp_path):
+    fn = str(examples / 'Stillingia SFE.mgf')
+    options = ScoreComputationOptions()
+    cache = SpectraCache(path=str(tmp_path))
+
+    worker = ReadDataWorker(fn, options, cache=cache, keep_raw=True)
+    expected_mzs, expected_spectra = worker.run()
+    assert worker.raw_spectra is not None
+    assert len(cache.entries()) == 1
+
+    # Unfiltered spectra are not cached, they are not available if spectra are read from cache
+    worker = ReadDataWorker(fn, options, cache=cache, keep_raw=True)
+    mzs, spectra = worker.run()
+    assert worker.raw_spectra is None
+    pd.testing.assert_series_equal(mzs, expected_mzs)
+    np.testing.assert_array_equal(spectra.peaks, expected_spectra.peaks)
+
+    # Entries depend on filtering options
+    options.min_mz = 100
+    ReadDataWorker(fn, options, cache=cache).run()
+    assert len(cache.entries()) == 2
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'bz2'])
+def test_read_compressed(examples, tmp_path, monkeypatch, compression):
+    fn = str(examples / 'Stillingia SFE.mgf')
+    options = ScoreComputationOptions()
+    worker = ReadDataWorker(fn, options)
+    expected_mzs, expected_spectra = worker.run()
+
+    module = {'gzip': gzip, 'bz2': bz2}[compression]
+    compressed = str(tmp_path / f'Stillingia SFE.mgf.{"gz" if compression == "gzip" else "bz2"}')
+    with open(fn, 'rb') as f, module.open(compressed, 'wb') as dst:
+        shutil.copyfileobj(f, dst)
+
+    # Compressed files are parsed by the same reader as uncompressed ones
+    scratch_path = tmp_path / 'scratch'
+    scratch_path.mkdir()
+    monkeypatch.setattr(read_data, 'SCRATCH_PATH', str(scratch_path))
+    compressed_worker = ReadDataWorker(compressed, options)
+    mzs, spectra = compressed_worker.run()
+    pd.testing.assert_series_equal(mzs, expected_mzs)
+    np.testing.assert_array_equal(spectra.offsets, expected_spectra.offsets)
+    np.testing.assert_array_equal(spectra.peaks, expected_spectra.peaks)
+    np.testing.assert_array_equal(compressed_worker.rts, worker.rts)
+
+    # Same when several files are read in a pool of processes
+    mzs, spectra = ReadDataWorker([fn, compressed], options).run()
+    np.testing.assert_array_equal(mzs.values, np.concatenate((expected_mzs.values, expected_mzs.values)))
+    np.testing.assert_array_equal(spectra.peaks, np.concatenate((expected_spectra.peaks, expected_spectra.peaks)))
+
+    # Decompressed files are removed
+    assert not os.listdir(scratch_path)
+
+
+def test_match_metadata(examples, tmp_path):
+    fn = str(examples / 'Stillingia SFE.mgf')
+    other = str(tmp_path / 'batch2.mgf')
+    shutil.copyfile(fn, other)
+    worker = ReadDataWorker([fn, other], ScoreComputationOptions())
+    mzs, _ = worker.run()
+    n = mzs.shape[0] // 2
+    original_ids = worker.infos[ReadDataWorker.ID_COLUMN]
+    assert mzs.index[n] == f'batch2:{original_ids.iloc[n]}'
+
+    # Rows keyed by ids of spectra in their data file match spectra of all files
+    metadata = pd.DataFrame({'value': np.arange(n)}, index=[int(id_) for id_ in original_ids.iloc[:n]])
+    matched = match_metadata(metadata, worker.infos)
+    assert matched.index.tolist() == mzs.index.tolist()
+    np.testing.assert_array_equal(matched['value'], np.tile(np.arange(n), 2))
+
+    # Rows are matched by file name too if it is available
+    metadata[ReadDataWorker.SOURCE_COLUMN] = 'batch2.mgf'
+    matched = match_metadata(metadata.iloc[:10], worker.infos)
+    assert matched.index.tolist() == mzs.index[n:n+10].tolist()
+    assert matched.columns.tolist() == ['value']
+
+    # Spectra without id in their data file are matched by their id
+    infos = pd.DataFrame({ReadDataWorker.ID_COLUMN: ['1', None]}, index=['a:1', 'b'])
+    metadata = pd.DataFrame({'value': [1, 2, 3]}, index=['1', 'b', 'c'])
+    assert match_metadata(metadata, infos)['value'].to_dict() == {'a:1': 1, 'b': 2}
+    assert match_metadata(metadata.iloc[2:], infos).empty
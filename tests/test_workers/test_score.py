@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+from scipy.sparse import issparse
+
+from metgem.workers.core import ReadDataWorker, ComputeScoresWorker, AppendScoresWorker
+from metgem.workers.core.score import get_append_tiles, get_blocking_windows
+from metgem.workers.options import ScoreComputationOptions
+
+
+@pytest.fixture(scope="module")
+def data(examples):
+    mzs, spectra = ReadDataWorker(str(examples / 'Stillingia SFE.mgf'), ScoreComputationOptions()).run()
+    return mzs, spectra
+
+
+@pytest.fixture(scope="module")
+def full_scores(data):
+    mzs, spectra = data
+    return np.asarray(ComputeScoresWorker(mzs, spectra, ScoreComputationOptions()).run())
+
+
+def toarray(matrix):
+    return matrix.toarray() if issparse(matrix) else np.asarray(matrix)
+
+
+@pytest.mark.parametrize('delta', [0., 5., 50.])
+def test_get_blocking_windows(delta):
+    rng = np.random.default_rng(0)
+    keys = np.sort(np.round(rng.uniform(100, 1000, 1000)))
+
+    position = 0
+    for start, stop, end in get_blocking_windows(keys, delta, min_block_size=16):
+        assert start == position < stop <= end
+        assert stop - start >= min(16, keys.shape[0] - start)
+        # All rows close to a row of the block and after it are in the window
+        for i in range(start, stop):
+            close = np.flatnonzero(np.abs(keys - keys[i]) <= delta)
+            assert close.max() < end
+        position = stop
+    assert position == keys.shape[0]
+
+
+@pytest.mark.parametrize('n_scored,n', [(100, 150), (10, 300), (300, 301), (0, 40)])
+def test_get_append_tiles(n_scored, n):
+    pairs = []
+    for rows, cols in get_append_tiles(n_scored, n, 32, block_size=50):
+        r, c = np.meshgrid(np.arange(rows.start, rows.stop), np.arange(cols.start, cols.stop), indexing='ij')
+        mask = c > r
+        pairs.extend(zip(r[mask], c[mask]))
+
+    # Each pair involving an appended spectrum is scored once, and only these pairs
+    expected = {(i, j) for j in range(n_scored, n) for i in range(j)}
+    assert len(pairs) == len(expected)
+    assert set(pairs) == expected
+
+
+@pytest.mark.parametrize('dense_output', [True, False])
+def test_append_scores(data, full_scores, dense_output):
+    mzs, spectra = data
+    options = ScoreComputationOptions()
+    options.dense_output = dense_output
+
+    n_scored = 300
+    first = ComputeScoresWorker(mzs[:n_scored], spectra[:n_scored], options).run()
+    scores = AppendScoresWorker(first, mzs, spectra, options).run()
+    assert issparse(scores) != dense_output
+    np.testing.assert_allclose(toarray(scores), full_scores, atol=1e-6)
+
+
+def test_blocking_scores(data, full_scores):
+    mzs, spectra = data
+    options = ScoreComputationOptions()
+    options.use_mz_blocking = True
+    options.max_mz_delta = 20.
+
+    scores = ComputeScoresWorker(mzs, spectra, options).run()
+
+    values = np.asarray(mzs, dtype=np.float64)
+    mask = np.abs(values[:, None] - values[None, :]) <= 20.
+    np.testing.assert_allclose(toarray(scores), np.where(mask, full_scores, 0), atol=1e-6)
+
+
+def test_top_k_scores(data, full_scores):
+    mzs, spectra = data
+    options = ScoreComputationOptions()
+    options.dense_output = False
+    options.use_top_k = True
+    options.top_k = 5
+
+    scores = toarray(ComputeScoresWorker(mzs, spectra, options).run())
+
+    # Kept scores are exact and the best scores of each spectrum are all kept
+    mask = scores > 0
+    np.testing.assert_allclose(scores[mask], full_scores[mask], atol=1e-6)
+    expected = full_scores.copy()
+    np.fill_diagonal(expected, 0)
+    for i in range(expected.shape[0]):
+        best = np.sort(expected[i])[::-1][:5]
+        best = best[best > 0]
+        row = np.sort(np.where(np.arange(expected.shape[0]) != i, scores[i], 0))[::-1][:best.shape[0]]
+        np.testing.assert_allclose(row, best, atol=1e-6)